@@ -9,8 +9,52 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'task_manager.settings')
 
-application = get_asgi_application()
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django 4.0 iterates a streaming response on the event loop, where the
+    ORM refuses to run and any blocking stalls every connection. Pull each
+    part through the request's own thread instead, the one its view ran in,
+    so a streamed export keeps its database cursor on its connection.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        headers = [
+            (header.encode("ascii") if isinstance(header, str) else header,
+                value.encode("latin1") if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        headers += [(b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        parts = iter(response)
+        done = object()
+        while True:
+            part = await sync_to_async(next, thread_sensitive=True)(parts, done)
+            if part is done:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+django.setup(set_prefix=False)
+django_application = StreamingASGIHandler()
+
+from tasks.sse import EVENTS_PATH, events_application  # imports models, needs the app registry ready
+
+
+async def application(scope, receive, send):
+    # event streams are long-lived, serve them without a Django request thread
+    if scope["type"] == "http" and scope["path"] == EVENTS_PATH:
+        return await events_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -4,6 +4,7 @@ from datetime import timedelta
 from django.conf import settings
 
 from celery import Celery
+from celery.signals import task_postrun, task_prerun
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "task_manager.settings")
 app = Celery("task_manager")
@@ -11,3 +12,9 @@ app.config_from_object("django.conf:settings")
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 app.conf.timezone = 'UTC'
 CELERY_IMPORTS=("tasks")
+
+# record the queries of every task run and check them against its query_budget
+from tasks.querybudget import task_finished, task_started
+
+task_prerun.connect(task_started, weak=False)
+task_postrun.connect(task_finished, weak=False)
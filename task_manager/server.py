@@ -0,0 +1,30 @@
+"""
+gunicorn settings for serving task_manager.asgi with uvicorn workers:
+
+    gunicorn task_manager.asgi:application -c python:task_manager.server
+
+Every worker is one event loop; parked long-polls (/api/async/task/poll/)
+hold a connection there, not a worker, so a few workers take thousands.
+"""
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        # Django 4.0 does not implement the lifespan protocol
+        "lifespan": "off",
+        # open connections per worker before new ones get a 503
+        "limit_concurrency": int(os.environ.get("WEB_MAX_CONNECTIONS", 5000)),
+    }
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "task_manager.server.Worker"
+# longer than the longest long-poll (asyncviews.MAX_POLL_TIMEOUT)
+timeout = 90
+graceful_timeout = 65
+keepalive = 75
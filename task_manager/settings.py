@@ -33,7 +33,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'tasks.metrics.MetricsMiddleware',
+    'tasks.querybudget.QueryBudgetMiddleware',
+    'tasks.routers.ReplicaPinMiddleware',
+    'tasks.middleware.WhiteNoiseMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -49,8 +52,15 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': ["templates"],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # compiled templates are kept in memory; runserver's autoreloader
+            # still resets them when a template changes
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -139,7 +149,155 @@ BROKER_URL = "redis://localhost:6379"
 CELERY_RESULT_BACKEND = "redis://localhost:6379"
 
 EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
+# Outbound mail is queued in tasks.OutboundEmail and sent by
+# tasks.tasks.drain_outbound_email in batches over one connection, one drain
+# at a time and at most EMAIL_RATE_LIMIT a second, counted in the "throttle"
+# cache, so across every worker when REDIS_URL is set. A failed send is retried
+# after EMAIL_RETRY_DELAY seconds, doubling up to EMAIL_RETRY_MAX_DELAY, and
+# given up after EMAIL_MAX_ATTEMPTS.
+EMAIL_BATCH_SIZE = 100
+EMAIL_RATE_LIMIT = float(os.environ.get("EMAIL_RATE_LIMIT", 10))
+EMAIL_MAX_ATTEMPTS = 6
+EMAIL_RETRY_DELAY = 60
+EMAIL_RETRY_MAX_DELAY = 3600
+# how long a claimed email is left to its drain before another may send it
+EMAIL_LEASE_SECONDS = 300
+EMAIL_RUN_SECONDS = 60
+
+# Per-user task list cache: a bounded LRU in process memory by default, Redis
+# when REDIS_URL is set so every worker shares it.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "tasks": {
+        "BACKEND": "tasks.cache.CountingLocMemCache",
+        "LOCATION": "task-lists",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
+    # rendered task cards, see tasks/templatetags/task_cards.py
+    "fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "fragments",
+        "TIMEOUT": 86400,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # rate limits and locks of the Celery tasks, see tasks.tasks.RateLimiter
+    "throttle": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "throttle",
+    },
+}
+if os.environ.get("REDIS_URL"):
+    CACHES["tasks"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_URL"],
+        "TIMEOUT": 300,
+        "KEY_PREFIX": "tasks",
+    }
+    CACHES["fragments"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_URL"],
+        "TIMEOUT": 86400,
+        "KEY_PREFIX": "fragments",
+    }
+    CACHES["throttle"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_URL"],
+        "KEY_PREFIX": "throttle",
+    }
+
+# Task change events (/api/task/events/): replayed from a per-user buffer
+# of `replay` events, shared between processes through Redis when set.
+TASK_EVENTS = {"BACKEND": "tasks.events.LocalBroker", "OPTIONS": {"replay": 500}}
+if os.environ.get("REDIS_URL"):
+    TASK_EVENTS = {"BACKEND": "tasks.events.RedisBroker", "OPTIONS": {"url": os.environ["REDIS_URL"], "replay": 500}}
+
+# Query budgets declared on views (`query_budget`) and Celery tasks are
+# checked on every request/task; violations are logged unless strict.
+QUERY_BUDGET_STRICT = os.environ.get("QUERY_BUDGET_STRICT") == "1"
+QUERY_REPEAT_THRESHOLD = 5
+
+# tasks.tasks.archive_cold_rows moves tasks soft-deleted this many days ago,
+# and history this old, out of the hot tables; a run works in batches with
+# a pause in between and hands what is left to the next run after a while.
+ARCHIVE_DELETED_AFTER_DAYS = int(os.environ.get("ARCHIVE_DELETED_AFTER_DAYS", 30))
+ARCHIVE_HISTORY_AFTER_DAYS = int(os.environ.get("ARCHIVE_HISTORY_AFTER_DAYS", 365))
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_PAUSE = 0.2
+ARCHIVE_RUN_SECONDS = 60
+
+# POST /api/export/<name> writes the export here from a Celery worker (so it
+# has to be shared with the web servers) and returns a signed download link
+# valid for EXPORT_LINK_MAX_AGE seconds; older files are removed hourly.
+EXPORT_ROOT = os.environ.get("EXPORT_ROOT", str(BASE_DIR / "exports"))
+EXPORT_LINK_MAX_AGE = 86400
+
+# Set METRICS_TOKEN to require "Authorization: Bearer <token>" on /metrics.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Shared through Redis when set, so /metrics shows every web and Celery worker
+# process (labelled instance="<host>:<pid>"), each pushing every few seconds.
+METRICS_REDIS_URL = os.environ.get("REDIS_URL")
+METRICS_PUSH_SECONDS = 15
+
+# JSON lines on stderr; request logs are INFO, quiet them with LOG_LEVEL.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {"()": "tasks.metrics.JsonFormatter"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "json"},
+    },
+    "loggers": {
+        "tasks": {"handlers": ["console"], "level": LOG_LEVEL, "propagate": False},
+    },
+}
 
 import dj_database_url 
-prod_db  =  dj_database_url.config(conn_max_age=500)
-DATABASES['default'].update(prod_db)
\ No newline at end of file
+prod_db  =  dj_database_url.config(conn_max_age=int(os.environ.get("DB_CONN_MAX_AGE", 0)))
+DATABASES['default'].update(prod_db)
+
+# Connection reuse, see tasks/dbpool.py. Served over ASGI every request runs
+# in its own thread, so a connection kept per thread (DB_CONN_MAX_AGE) is
+# never reused there; DB_POOL_SIZE hands them on through a per-process pool
+# instead, for web and Celery workers alike. Behind PgBouncer in transaction
+# mode set DB_PGBOUNCER=1 and leave the pooling to it.
+DB_BACKENDS = {
+    "django.db.backends.postgresql": "tasks.backends.postgresql",
+    "django.db.backends.postgresql_psycopg2": "tasks.backends.postgresql",
+    "django.db.backends.sqlite3": "tasks.backends.sqlite3",
+}
+DATABASES['default']['ENGINE'] = DB_BACKENDS.get(DATABASES['default']['ENGINE'], DATABASES['default']['ENGINE'])
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+if os.environ.get("DB_POOL_SIZE"):
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['POOL'] = {
+        "SIZE": int(os.environ["DB_POOL_SIZE"]),
+        "MAX_OVERFLOW": int(os.environ.get("DB_POOL_MAX_OVERFLOW", 10)),
+        "TIMEOUT": float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+        "RECYCLE": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "CHECK_AFTER": int(os.environ.get("DB_POOL_CHECK_AFTER", 30)),
+    }
+if os.environ.get("DB_PGBOUNCER") == "1":
+    # server-side cursors (QuerySet.iterator()) do not survive transaction pooling
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Read replicas, comma-separated database URLs; tasks.routers.ReplicaRouter
+# sends the reads of GET requests there. Locally, a second alias for the same
+# file stands in for one: DATABASE_REPLICA_URLS=sqlite:///db.sqlite3
+DATABASE_REPLICAS = []
+for url in filter(None, os.environ.get("DATABASE_REPLICA_URLS", "").split(",")):
+    replica = dj_database_url.parse(url, conn_max_age=DATABASES['default'].get('CONN_MAX_AGE', 0))
+    replica['ENGINE'] = DB_BACKENDS.get(replica['ENGINE'], replica['ENGINE'])
+    DATABASE_REPLICAS.append(f"replica{len(DATABASE_REPLICAS) + 1}")
+    DATABASES[DATABASE_REPLICAS[-1]] = {**DATABASES['default'], **replica, "TEST": {"MIRROR": "default"}}
+DATABASE_ROUTERS = ["tasks.routers.ReplicaRouter"]
+# how long reads stay on the primary after a request wrote tasks
+REPLICA_PIN_SECONDS = 10
+
+# adds the replica stand-ins the router tests use
+TEST_RUNNER = "tasks.testrunner.TestRunner"
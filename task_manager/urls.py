@@ -2,6 +2,10 @@ from django.contrib import admin
 from django.contrib.auth.views import LogoutView
 from django.urls import path
 from tasks.views import *
+from tasks.metrics import metrics_view
+from tasks import asyncviews
+from tasks.sse import task_events
+from tasks.exports import ExportDownloadView, ExportView
 from tasks.apiviews import TaskViewSet, TaskHistoryViewSet
 from rest_framework.routers import SimpleRouter
 from rest_framework_nested import routers
@@ -14,15 +18,23 @@ task_router.register("history", TaskHistoryViewSet)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('',home_view),
-    path('tasks/', GenericAllTasksView.as_view()),
-    path('pending-tasks/', GenericPendingTasksView.as_view()),
-    path('completed-tasks/', GenericCompletedTasksView.as_view()),
-    path('create-task/', GenericTaskCreateView.as_view()),
-    path('delete-task/<pk>/', GenericTaskDeleteView.as_view()),
-    path('update-task/<pk>/', GenericTaskUpdateView.as_view()),
-    path('user/signup/', UserCreateView.as_view()),
-    path('user/login/', UserLoginView.as_view()),
-    path('user/logout/', LogoutView.as_view()),
-    path('report/', SetReportView.as_view())
+    path('',home_view, name='home'),
+    path('tasks/', GenericAllTasksView.as_view(), name='tasks'),
+    path('pending-tasks/', GenericPendingTasksView.as_view(), name='pending-tasks'),
+    path('completed-tasks/', GenericCompletedTasksView.as_view(), name='completed-tasks'),
+    path('create-task/', GenericTaskCreateView.as_view(), name='create-task'),
+    path('delete-task/<pk>/', GenericTaskDeleteView.as_view(), name='delete-task'),
+    path('update-task/<pk>/', GenericTaskUpdateView.as_view(), name='update-task'),
+    path('user/signup/', UserCreateView.as_view(), name='signup'),
+    path('user/login/', UserLoginView.as_view(), name='login'),
+    path('user/logout/', LogoutView.as_view(), name='logout'),
+    path('report/', SetReportView.as_view(), name='report'),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/task/events/', task_events, name='task-events'),
+    path('api/export/download/<str:token>/', ExportDownloadView.as_view(), name='export-download'),
+    path('api/export/<str:name>', ExportView.as_view(), name='export'),
+    path('api/async/task/', asyncviews.task_list, name='async-task-list'),
+    path('api/async/task/poll/', asyncviews.task_list_poll, name='async-task-poll'),
+    path('api/async/task/<int:pk>/', asyncviews.task_detail, name='async-task-detail'),
+    path('api/async/task/<int:task_pk>/history/', asyncviews.task_history, name='async-task-history'),
 ]+ router.urls + task_router.urls
@@ -1,13 +1,32 @@
+import base64
+import binascii
+
+from django.db import transaction
+from django.db.models import Max, Q
 from django.http import JsonResponse
 from django.views import View
 from django.http.response import HttpResponse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
 
-from tasks.models import Task, TaskHistory
+from tasks import events
+from tasks.models import ArchivedTask, ArchivedTaskHistory, Task, TaskChange, TaskHistory, TaskListVersion
 from tasks.models import STATUS_CHOICES
+from tasks.conditional import task_list_condition, task_list_version
+from tasks.dashboard import decode_cursor, encode_cursor
+from tasks.cache import cached_task_list
+from tasks.priorities import make_room, shift_priorities
+from tasks.search import search_tasks
 
-from rest_framework.serializers import ModelSerializer
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.serializers import ListSerializer, ModelSerializer
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework import mixins
+from rest_framework.pagination import BasePagination
+from rest_framework.utils.urls import replace_query_param
 
 from django.contrib.auth.models import User
 
@@ -25,26 +44,309 @@ class UserSerializer(ModelSerializer):
         fields = ["username",]
 
 
+class TaskListSerializer(ListSerializer):
+    def create(self, validated_data):
+        tasks = [Task(**attrs) for attrs in validated_data]
+        with transaction.atomic():
+            make_room(tasks[0].user, tasks)
+            return Task.objects.bulk_create(tasks)
+
+    def update(self, instances, validated_data):
+        now = timezone.now()
+        moved = []
+        fields = {"created_date"}
+        for task, attrs in zip(instances, validated_data):
+            if attrs.get("priority", task.priority) != task._loaded_values.get("priority"):
+                moved.append(task)
+            for name, value in attrs.items():
+                setattr(task, name, value)
+            # bulk_update() skips auto_now, keep the modified stamp honest
+            task.created_date = now
+            fields |= set(attrs)
+        with transaction.atomic():
+            make_room(instances[0].user, moved, [task for task in instances if task not in moved])
+            # priority only where it changed, an unchanged copy would undo a shift
+            fields.discard("priority")
+            reordered = [task for task in instances if task.priority != task._loaded_values.get("priority")]
+            unchanged = [task for task in instances if task not in reordered]
+            if reordered:
+                Task.objects.bulk_update(reordered, sorted(fields | {"priority"}))
+            if unchanged:
+                Task.objects.bulk_update(unchanged, sorted(fields))
+        return instances
+
+
 class TaskSerializer(ModelSerializer):
     user = UserSerializer(read_only=True)
     class Meta:
         model=Task
-        fields=['id', 'title','description','user', 'completed', 'status']
+        fields=['id', 'title','description','user', 'completed', 'status', 'priority']
+        list_serializer_class = TaskListSerializer
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # sparse fieldset, e.g. ?fields=id,title,status
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+def encode_sync_token(change_id):
+    return base64.urlsafe_b64encode(f"c{change_id}".encode()).decode().rstrip("=")
+
+def decode_sync_token(token):
+    try:
+        value = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError(token)
+    if not value.startswith("c"):
+        raise ValueError(token)
+    return int(value[1:])
+
+def sparse_fields(fields):
+    if not fields:
+        return None
+    return [name for name in fields.split(",") if name in TaskSerializer.Meta.fields] or None
+
+def project_tasks(queryset, fields=None):
+    # only read the columns that get serialized, plus what the cursor needs
+    fields = fields or TaskSerializer.Meta.fields
+    columns = {"id", "priority"} | set(fields) - {"user"}
+    if "user" in fields:
+        queryset = queryset.select_related("user")
+        columns |= {"user", "user__username"}
+    return queryset.only(*columns)
 
 class TaskFilter(FilterSet):
     completed = BooleanFilter()
 
+# cursor directions, "after.<priority>.<id>" for the next page
+AFTER = "after"
+BEFORE = "before"
+
+class TaskCursorPagination(BasePagination):
+    """
+    Keyset pagination on (priority, id), with cursors like the task list
+    pages': a page seeks past the last task of the one before, however many
+    tasks share its priority. DRF's CursorPagination only seeks on the
+    first ordering field and steps over ties with an OFFSET.
+    """
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            size = min(int(request.query_params.get(self.page_size_query_param, self.page_size)), self.max_page_size)
+        except ValueError:
+            size = self.page_size
+        size = size if size > 0 else self.page_size
+        cursor = request.query_params.get("cursor")
+        position = decode_cursor(cursor, (AFTER, BEFORE)) if cursor else (AFTER, None)
+        if position is None or (cursor and position[1] is None):
+            raise NotFound("Invalid cursor")
+        direction, key = position
+
+        if direction == BEFORE:
+            priority, pk = key
+            queryset = queryset.filter(Q(priority__lt=priority) | Q(priority=priority, id__lt=pk))
+            queryset = queryset.order_by("-priority", "-id")
+        else:
+            if key is not None:
+                priority, pk = key
+                queryset = queryset.filter(Q(priority__gt=priority) | Q(priority=priority, id__gt=pk))
+            queryset = queryset.order_by("priority", "id")
+        # one extra row tells whether the page has a neighbour that way
+        rows = list(queryset[:size + 1])
+        more = len(rows) > size
+        rows = rows[:size]
+        if direction == BEFORE:
+            rows.reverse()
+            self.next = rows[-1] if rows else None
+            self.previous = rows[0] if more else None
+        else:
+            self.next = rows[-1] if more else None
+            self.previous = rows[0] if key is not None and rows else None
+        return rows
+
+    def get_link(self, direction, task):
+        if task is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), "cursor", encode_cursor(direction, task))
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_link(AFTER, self.next),
+            "previous": self.get_link(BEFORE, self.previous),
+            "results": data,
+        })
+
+class TaskSearchPagination(BasePagination):
+    """
+    Ranked results have no stable key to seek on, so these go by page number;
+    one extra row tells whether there is a next page, rather than a COUNT
+    over every match.
+    """
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            self.page = int(request.query_params.get("page", 1))
+            self.size = min(int(request.query_params.get(self.page_size_query_param, self.page_size)), self.max_page_size)
+        except ValueError:
+            raise NotFound("Invalid page.")
+        if self.page < 1 or self.size < 1:
+            raise NotFound("Invalid page.")
+        offset = (self.page - 1) * self.size
+        rows = list(queryset[offset:offset + self.size + 1])
+        self.has_next = len(rows) > self.size
+        return rows[:self.size]
+
+    def get_link(self, page):
+        return replace_query_param(self.request.build_absolute_uri(), "page", page)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_link(self.page + 1) if self.has_next else None,
+            "previous": self.get_link(self.page - 1) if self.page > 1 else None,
+            "results": data,
+        })
+
+@method_decorator(task_list_condition, name="list")
+@method_decorator(task_list_condition, name="retrieve")
 class TaskViewSet(ModelViewSet):
     queryset= Task.objects.all()
     serializer_class= TaskSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = TaskFilter
+    pagination_class = TaskCursorPagination
+    # per action; bulk requests cost the same whatever their size
+    query_budget = {"list": 4, "retrieve": 4, "create": 14, "update": 10, "partial_update": 10, "destroy": 8, "bulk": 16, "sync": 8}
+
+    def get_fields(self):
+        return sparse_fields(self.request.query_params.get("fields"))
+
+    def get_search(self):
+        if self.action == "list":
+            return self.request.query_params.get("q", "").strip()
+        return ""
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            self._paginator = TaskSearchPagination() if self.get_search() else self.pagination_class()
+        return self._paginator
 
     def get_queryset(self):
-        return Task.objects.filter(user= self.request.user, deleted=False)
+        queryset = Task.objects.filter(user= self.request.user, deleted=False)
+        if self.action not in ("list", "retrieve"):
+            return queryset
+        queryset = project_tasks(queryset, self.get_fields())
+        if self.get_search():
+            queryset = search_tasks(queryset, self.get_search())
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # keyed on the absolute URL, the pagination links embed the host
+        data = cached_task_list(request.user.pk, task_list_version(request), request.build_absolute_uri(),
+            lambda: super(TaskViewSet, self).list(request, *args, **kwargs).data)
+        return Response(data)
+
+    def get_serializer(self, *args, **kwargs):
+        if self.request.method == "GET":
+            kwargs.setdefault("fields", self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    @action(detail=False, methods=["post", "patch", "delete"])
+    def bulk(self, request):
+        """
+        POST a list of tasks to create them, PATCH a list of partial tasks with
+        their "id" to update them, or DELETE a list of ids to soft-delete them,
+        each in one transaction.
+        """
+        if not isinstance(request.data, list) or not request.data:
+            raise ValidationError("Expected a non-empty list.")
+
+        if request.method == "POST":
+            serializer = self.get_serializer(data=request.data, many=True)
+            serializer.is_valid(raise_exception=True)
+            serializer.save(user=request.user)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        if request.method == "DELETE":
+            ids = self.get_bulk_ids(request.data)
+            return Response({"deleted": self.get_queryset().filter(id__in=ids).update(deleted=True)})
+
+        ids = self.get_bulk_ids(item.get("id") if isinstance(item, dict) else None for item in request.data)
+        tasks = self.get_queryset().in_bulk(ids)
+        missing = [pk for pk in ids if pk not in tasks]
+        if missing:
+            raise ValidationError({"id": [f"Unknown task ids: {missing}"]})
+        serializer = self.get_serializer([tasks[pk] for pk in ids], data=request.data, many=True, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data)
+
+    @action(detail=False)
+    def sync(self, request):
+        """
+        ?since=<token> returns the tasks created or changed since the token,
+        the ids deleted since, and the priority shifts to apply before the
+        upserts, with the token to send next time. A shift adds "by" to the
+        priority of the tasks from "from" to "to" that match its other keys
+        ("completed": false: pending tasks only). Without a token, or with
+        one older than the compacted change log, it returns every task with
+        "full": true.
+        """
+        since = request.query_params.get("since")
+        try:
+            since = decode_sync_token(since) if since else None
+        except ValueError:
+            raise ValidationError({"since": ["Invalid sync token."]})
+
+        user = request.user
+        with transaction.atomic():
+            # writers take this row lock before logging, so the token and
+            # the tasks read below describe the same state
+            horizon = (
+                TaskListVersion.objects.select_for_update().filter(user=user)
+                .values_list("sync_horizon", flat=True).first() or 0
+            )
+            token = TaskChange.objects.filter(user=user).aggregate(last=Max("id"))["last"] or 0
+            tasks = project_tasks(Task.objects.filter(user=user, deleted=False), self.get_fields())
+            tasks = tasks.order_by("priority", "id")
+
+            if since is None or since < horizon:
+                return Response({"token": encode_sync_token(token), "full": True,
+                    "tasks": self.get_serializer(tasks, many=True).data, "deleted": [], "shifts": []})
+
+            changes = list(
+                TaskChange.objects.filter(user=user, id__gt=since, id__lte=token)
+                .order_by("id").values_list("task_id", "kind", "changes")
+            )
+            changed = {task_id for task_id, _, _ in changes if task_id is not None}
+            live = list(tasks.filter(id__in=changed)) if changed else []
+        return Response({
+            "token": encode_sync_token(token),
+            "full": False,
+            "tasks": self.get_serializer(live, many=True).data,
+            "deleted": sorted(changed - {task.id for task in live}),
+            "shifts": [values for _, kind, values in changes if kind == events.SHIFTED],
+        })
+
+    def get_bulk_ids(self, values):
+        ids = list(values)
+        if not all(isinstance(pk, int) for pk in ids) or len(set(ids)) != len(ids):
+            raise ValidationError({"id": ["Expected distinct integer task ids."]})
+        return ids
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        with transaction.atomic():
+            shift_priorities(self.request.user, serializer.validated_data.get("priority", 0))
+            serializer.save(user=self.request.user)
 
 
 class TaskHistorySerializer(ModelSerializer):
@@ -68,14 +370,34 @@ class HistoryFilter(FilterSet):
         )
 
 
+@method_decorator(task_list_condition, name="list")
+@method_decorator(task_list_condition, name="retrieve")
 class TaskHistoryViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericViewSet):
     queryset = TaskHistory.objects.all()
     serializer_class = TaskHistorySerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = HistoryFilter
+    # ?archived=1 reads the archive table too
+    query_budget = 5
 
     def get_queryset(self):
         return TaskHistory.objects.filter(
             task_id=self.kwargs["task_pk"],
             task__user = self.request.user,
         )
+
+    def get_archived_queryset(self):
+        task_pk = self.kwargs["task_pk"]
+        # the task itself may be live or archived by now
+        owned = Task.objects.filter(pk=task_pk, user=self.request.user).values("id").union(
+            ArchivedTask.objects.filter(pk=task_pk, user=self.request.user).values("id"))
+        return ArchivedTaskHistory.objects.filter(task_id__in=owned)
+
+    def list(self, request, *args, **kwargs):
+        """?archived=1 adds the history moved to the archive (tasks.tasks.archive_cold_rows)."""
+        if request.query_params.get("archived") not in ("1", "true"):
+            return super().list(request, *args, **kwargs)
+        history = list(self.filter_queryset(self.get_queryset()))
+        history += self.filter_queryset(self.get_archived_queryset())
+        history.sort(key=lambda entry: (entry.change_date, entry.id))
+        return Response(self.get_serializer(history, many=True).data)
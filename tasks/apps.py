@@ -1,6 +1,27 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models.signals import post_migrate
+
+
+def install_search_index(using, **kwargs):
+    from tasks.search import install_search_index
+
+    connection = connections[using]
+    if ("tasks", "0020_task_search") not in MigrationRecorder(connection).applied_migrations():
+        return
+    # SQLite loses the search triggers whenever a migration rebuilds tasks_task
+    with connection.schema_editor() as schema_editor:
+        install_search_index(schema_editor)
 
 
 class TasksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tasks'
+
+    def ready(self):
+        post_migrate.connect(install_search_index, sender=self)
+
+        from tasks.metrics import start_metrics_push
+
+        start_metrics_push()
@@ -0,0 +1,212 @@
+"""
+Async variants of the task list, detail and history endpoints, and a
+long-poll on the task list version, served through task_manager/asgi.py.
+
+Django 4.0 has no async ORM yet, so the queries go through sync_to_async
+and run in the request's own thread; what is async is the waiting, so a
+parked long-poll costs a future, not a worker.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+
+from tasks.apiviews import TaskHistorySerializer, TaskSerializer, project_tasks, sparse_fields
+from tasks.cache import cached_task_list
+from tasks.conditional import task_list_version
+from tasks.models import STATUS_CHOICES, Task, TaskHistory, TaskListVersion
+from tasks.querybudget import unrecorded
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+POLL_INTERVAL = 1.0
+POLL_TIMEOUT = 30
+MAX_POLL_TIMEOUT = 60
+
+STATUSES = {status for status, _ in STATUS_CHOICES}
+
+
+def error(detail, status):
+    return JsonResponse({"detail": detail}, status=status)
+
+
+def authenticated_get(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return error(f'Method "{request.method}" not allowed.', 405)
+        # request.user is lazy and loads the session from the database
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return error("Authentication credentials were not provided.", 403)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def task_page(request):
+    params = request.GET
+    fields = sparse_fields(params.get("fields"))
+    page_size = min(int(params.get("page_size") or PAGE_SIZE), MAX_PAGE_SIZE)
+    if page_size < 1:
+        raise ValueError(page_size)
+
+    queryset = project_tasks(Task.objects.filter(user=request.user, deleted=False), fields)
+    if params.get("completed") in ("true", "false"):
+        queryset = queryset.filter(completed=params["completed"] == "true")
+    # keyset on (priority, id), like the cursor pagination of the sync API
+    if params.get("cursor"):
+        priority, pk = map(int, params["cursor"].split("."))
+        queryset = queryset.filter(Q(priority__gt=priority) | Q(priority=priority, id__gt=pk))
+    tasks = list(queryset.order_by("priority", "id")[:page_size + 1])
+
+    next_cursor = None
+    if len(tasks) > page_size:
+        tasks = tasks[:page_size]
+        next_cursor = f"{tasks[-1].priority}.{tasks[-1].pk}"
+    return {"results": TaskSerializer(tasks, many=True, fields=fields).data, "next_cursor": next_cursor}
+
+
+def cached_task_page(request):
+    variant = f"async:{request.get_full_path()}"
+    return cached_task_list(request.user.pk, task_list_version(request), variant, lambda: task_page(request))
+
+
+@authenticated_get
+async def task_list(request):
+    try:
+        data = await sync_to_async(cached_task_page)(request)
+    except ValueError:
+        return error("Invalid cursor or page size.", 400)
+    return JsonResponse(data)
+
+task_list.query_budget = 4
+
+
+def task_detail_data(request, pk):
+    fields = sparse_fields(request.GET.get("fields"))
+    task = project_tasks(Task.objects.filter(user=request.user, deleted=False, pk=pk), fields).first()
+    return TaskSerializer(task, fields=fields).data if task else None
+
+
+@authenticated_get
+async def task_detail(request, pk):
+    data = await sync_to_async(task_detail_data)(request, pk)
+    if data is None:
+        return error("Not found.", 404)
+    return JsonResponse(data)
+
+task_detail.query_budget = 3
+
+
+def task_history_data(request, task_pk):
+    history = TaskHistory.objects.filter(task_id=task_pk, task__user=request.user)
+    for name in ("old_status", "new_status"):
+        value = request.GET.get(name)
+        if value:
+            if value not in STATUSES:
+                raise ValueError(value)
+            history = history.filter(**{name: value})
+    return TaskHistorySerializer(history.order_by("change_date", "id"), many=True).data
+
+
+@authenticated_get
+async def task_history(request, task_pk):
+    try:
+        data = await sync_to_async(task_history_data)(request, task_pk)
+    except ValueError:
+        return error("Invalid status.", 400)
+    return JsonResponse(data, safe=False)
+
+task_history.query_budget = 3
+
+
+def current_versions(user_ids):
+    # the watcher is long-lived, let it drop connections past CONN_MAX_AGE
+    if not connection.in_atomic_block:
+        close_old_connections()
+    return dict(TaskListVersion.objects.filter(user_id__in=user_ids).values_list("user_id", "version"))
+
+
+class VersionWatcher:
+    """
+    Long-poll requests park a future here; one loop per process checks the
+    versions of every waiting user with a single query per interval, however
+    many clients are waiting.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.waiters = {}
+        self.task = None
+
+    async def wait(self, user_id, version, timeout):
+        future = asyncio.get_running_loop().create_future()
+        waiter = (version, future)
+        self.waiters.setdefault(user_id, []).append(waiter)
+        self.start()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiting = self.waiters.get(user_id, [])
+            if waiter in waiting:
+                waiting.remove(waiter)
+            if not waiting:
+                self.waiters.pop(user_id, None)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.task is not None and not self.task.done() and self.task.get_loop() is loop:
+            return
+        # started from an empty context, so the loop is not tied to (and
+        # does not run its queries in) the request that happened to start it
+        self.task = contextvars.Context().run(loop.create_task, self.run())
+
+    async def run(self):
+        unrecorded.set(True)
+        while self.waiters:
+            try:
+                versions = await sync_to_async(current_versions)(list(self.waiters))
+            except Exception:
+                logger.exception("task list version poll failed")
+            else:
+                for user_id, waiting in list(self.waiters.items()):
+                    current = versions.get(user_id, 0)
+                    for version, future in waiting:
+                        if current != version and not future.done():
+                            future.set_result(current)
+            await asyncio.sleep(self.interval)
+
+
+watcher = VersionWatcher()
+
+
+@authenticated_get
+async def task_list_poll(request):
+    """
+    ?version=<n>: answers as soon as the user's task list version differs
+    from n with {"version": <current>}, or 204 after ?timeout= seconds.
+    """
+    try:
+        timeout = min(float(request.GET.get("timeout") or POLL_TIMEOUT), MAX_POLL_TIMEOUT)
+        known = request.GET.get("version")
+        known = int(known) if known is not None else None
+    except ValueError:
+        return error("Invalid version or timeout.", 400)
+
+    current = (await sync_to_async(task_list_version)(request))[0]
+    if known is None or current != known:
+        return JsonResponse({"version": current})
+    current = await watcher.wait(request.user.pk, known, timeout)
+    if current is None:
+        return HttpResponse(status=204)
+    return JsonResponse({"version": current})
+
+task_list_poll.query_budget = 3
@@ -0,0 +1,11 @@
+from django.db.backends.postgresql import base
+
+from tasks.dbpool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        # the base class only sets it on the connections it opens itself
+        self.isolation_level = connection.isolation_level
+        return connection
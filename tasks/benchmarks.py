@@ -0,0 +1,443 @@
+"""
+Benchmark scenarios for `manage.py benchmark`. Each scenario seeds what it
+needs, times its operation `repeat` times and returns a JSON-serializable
+summary; the command runs everything in one transaction that is rolled back.
+"""
+import asyncio
+import json
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from itertools import count
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, connections
+from django.db.utils import load_backend
+from django.db.models import Q
+from asgiref.sync import async_to_sync, sync_to_async
+from django.template.loader import render_to_string
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from tasks.asyncviews import watcher
+from tasks.dashboard import COMPLETED, PENDING, TaskDashboard
+from tasks.dbpool import close_pools, get_pool
+from tasks.exports import COLUMNS, encode
+from tasks.metrics import metrics
+from tasks.models import OutboundEmail, Task, TaskHistory, Report, STATUS_CHOICES
+from tasks.priorities import shift_priorities
+from tasks.search import search_tasks
+from tasks.templatetags.task_cards import FRAGMENT_CACHE
+from tasks.tasks import drain_outbound_email, due_report_ids, periodic_emailer, send_email_report
+
+SCENARIOS = {}
+
+STATUSES = [status for status, _ in STATUS_CHOICES]
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def timed(func, *args, **kwargs):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return {"ms": round(elapsed * 1000, 3), "queries": len(queries)}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+def summarize(runs):
+    latencies = [run["ms"] for run in runs]
+    return {
+        "runs": len(runs),
+        "p50_ms": percentile(latencies, 0.5),
+        "p90_ms": percentile(latencies, 0.9),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": max(latencies),
+        "queries": max(run["queries"] for run in runs),
+    }
+
+
+def measure(func, repeat):
+    return summarize([timed(func) for _ in range(repeat)])
+
+
+def seed_tasks(user, count, batch_size=5000):
+    Task.objects.bulk_create(
+        (
+            Task(title=f"task {i}", description="benchmark", priority=i, user=user,
+                status=STATUSES[i % len(STATUSES)], completed=i % 4 == 0)
+            for i in range(1, count + 1)
+        ),
+        batch_size=batch_size,
+    )
+
+
+def seed(users, tasks, history, prefix="bench", batch_size=5000):
+    """
+    users x tasks x history rows: every user gets `tasks` tasks, every task
+    `history` status changes. Returns the seeded users.
+    """
+    seeded = User.objects.bulk_create(
+        (User(username=f"{prefix}-{i}", email=f"{prefix}-{i}@example.com") for i in range(users)),
+        batch_size=batch_size,
+    )
+    for user in seeded:
+        seed_tasks(user, tasks, batch_size)
+    if history:
+        TaskHistory.objects.bulk_create(
+            (
+                TaskHistory(task_id=task_id, old_status=STATUSES[i % len(STATUSES)],
+                    new_status=STATUSES[(i + 1) % len(STATUSES)])
+                for task_id in Task.objects.filter(user__in=seeded).values_list("id", flat=True).iterator()
+                for i in range(history)
+            ),
+            batch_size=batch_size,
+        )
+    return seeded
+
+
+def logged_in_client(user):
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def get(client, url):
+    def request():
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+    return request
+
+
+def post(client, url, data_factory, expected=201, **kwargs):
+    def request():
+        response = client.post(url, data_factory(), **kwargs)
+        assert response.status_code == expected, (url, response.status_code)
+    return request
+
+
+@scenario("views")
+def bench_views(users=10, tasks=1000, history=0, repeat=20, **options):
+    user = seed(users, tasks, history, prefix="bench-views")[0]
+    client = logged_in_client(user)
+    return {name: measure(get(client, url), repeat) for name, url in [
+        ("all_tasks", "/tasks/"),
+        ("pending_tasks", "/pending-tasks/"),
+        ("completed_tasks", "/completed-tasks/"),
+    ]}
+
+
+@scenario("create")
+def bench_create(users=10, tasks=1000, history=0, repeat=20, **options):
+    user = seed(users, tasks, history, prefix="bench-create")[0]
+    client = logged_in_client(user)
+    titles = count()
+    # priority 1 always collides and shifts the pending run behind it
+    form = lambda: {"title": f"new {next(titles)}", "description": "benchmark", "priority": 1, "status": "PENDING"}
+    def create_then_list():
+        post(client, "/create-task/", form, expected=302)()
+        get(client, "/tasks/")()
+
+    return {
+        "create_task_collision": measure(post(client, "/create-task/", form, expected=302), repeat),
+        # a browser follows the redirect and renders the whole page again,
+        # htmx only swaps in the new card and the counters
+        "create_and_reload_list": measure(create_then_list, repeat),
+        "create_htmx": measure(post(client, "/create-task/", form, expected=200, HTTP_HX_REQUEST="true"), repeat),
+    }
+
+
+@scenario("api")
+def bench_api(users=10, tasks=1000, history=5, repeat=20, **options):
+    user = seed(users, tasks, history, prefix="bench-api")[0]
+    client = logged_in_client(user)
+    task_id = Task.objects.filter(user=user).values_list("id", flat=True).first()
+    titles = count()
+    payload = lambda: {"title": f"api {next(titles)}", "description": "benchmark", "priority": 1}
+    return {
+        "task_list": measure(get(client, "/api/task/"), repeat),
+        "task_list_sparse": measure(get(client, "/api/task/?fields=id,title,status"), repeat),
+        "task_create": measure(post(client, "/api/task/", payload), repeat),
+        "task_history": measure(get(client, f"/api/task/{task_id}/history/"), repeat),
+    }
+
+
+@scenario("emails")
+def bench_emails(users=10, tasks=1000, history=0, repeat=20, **options):
+    seeded = seed(users, tasks, history, prefix="bench-emails")
+    reports = Report.objects.bulk_create(Report(user=user, confirmation=True) for user in seeded)
+
+    def run_emailer():
+        Report.objects.filter(id__in=[r.id for r in reports]).update(next_run_at=datetime.now(timezone.utc))
+        periodic_emailer()
+
+    # queued inside the benchmark's transaction, so drained by hand
+    with override_settings(EMAIL_RATE_LIMIT=0):
+        results = {
+            "send_email_report": measure(lambda: send_email_report(reports[0]), repeat),
+            "periodic_emailer": measure(run_emailer, repeat),
+            "queued": OutboundEmail.objects.count(),
+        }
+        results["drain"] = timed(drain_outbound_email)
+    results["emails_per_second"] = round(results["queued"] / (results["drain"]["ms"] / 1000))
+    return results
+
+
+@scenario("priorities")
+def bench_priorities(tasks=100000, repeat=5, **options):
+    user = User.objects.create_user(username="bench-priorities")
+    seed_tasks(user, tasks)
+    runs = []
+    for _ in range(repeat):
+        # every insert at priority 1 collides with the whole list
+        runs.append(timed(shift_priorities, user, 1))
+        Task.objects.create(title="inserted", description="benchmark", priority=1, user=user)
+    return {"tasks": tasks, "shift": summarize(runs)}
+
+
+@scenario("reports")
+def bench_reports(reports=100000, repeat=5, **options):
+    # grow the table in steps while keeping the same number of due reports,
+    # the tick should cost the same at every size
+    now = datetime.now(timezone.utc)
+    due = 100
+    steps = []
+    seeded = 0
+    for size in (reports // 100, reports // 10, reports):
+        users = User.objects.bulk_create(
+            (User(username=f"bench-report-{i}") for i in range(seeded, size)), batch_size=5000
+        )
+        Report.objects.bulk_create(
+            (
+                Report(user=user, confirmation=True, next_run_at=now + timedelta(minutes=1 + i % 1440))
+                for i, user in enumerate(users)
+            ),
+            batch_size=5000,
+        )
+        if not seeded:
+            Report.objects.filter(id__in=Report.objects.order_by("id").values("id")[:due]).update(next_run_at=now)
+        seeded = size
+        steps.append({"reports": size, **measure(lambda: due_report_ids(now), repeat)})
+    return {"due": due, "steps": steps}
+
+
+@scenario("instrumentation")
+def bench_instrumentation(users=10, tasks=1000, history=0, repeat=20, **options):
+    user = seed(users, tasks, history, prefix="bench-instrumentation")[0]
+    instrumented = ["tasks.metrics.MetricsMiddleware", "tasks.querybudget.QueryBudgetMiddleware"]
+    bare = [name for name in settings.MIDDLEWARE if name not in instrumented]
+    # a fresh client builds its middleware chain from the current settings
+    with override_settings(MIDDLEWARE=bare):
+        without = measure(get(logged_in_client(user), "/tasks/"), repeat)
+    with_metrics = measure(get(logged_in_client(user), "/tasks/"), repeat)
+
+    calls = 100000
+    start = time.perf_counter()
+    for _ in range(calls):
+        metrics.observe("benchmark_seconds", 0.001, view="benchmark")
+    per_call = (time.perf_counter() - start) / calls
+    return {
+        "tasks_view_bare": without,
+        "tasks_view_instrumented": with_metrics,
+        "p50_overhead_ms": round(with_metrics["p50_ms"] - without["p50_ms"], 3),
+        "observe_us": round(per_call * 1e6, 3),
+    }
+
+
+WORDS = ["invoice", "meeting", "groceries", "report", "dentist", "deploy", "garden", "taxes", "review", "travel"]
+
+
+@scenario("search")
+def bench_search(tasks=1000000, repeat=5, **options):
+    """
+    One page of ranked matches against the full-text index, next to the
+    icontains scan it replaces, for a common word (every tenth task), a rare
+    one (every thousandth) and two words.
+    """
+    user = User.objects.create_user(username="bench-search")
+    Task.objects.bulk_create(
+        (
+            Task(title=f"{WORDS[i % len(WORDS)]} {i}", description=f"{WORDS[i // 10 % len(WORDS)]} notes"
+                + (" quarterly" if i % 1000 == 0 else ""), priority=i, user=user)
+            for i in range(1, tasks + 1)
+        ),
+        batch_size=5000,
+    )
+    client = logged_in_client(user)
+    live = Task.objects.filter(user=user, deleted=False)
+    results = {"tasks": tasks}
+    for name, text in [("common", "invoice"), ("rare", "quarterly"), ("two_words", "invoice meeting")]:
+        results[name] = {
+            "index": measure(lambda: list(search_tasks(live, text)[:50]), repeat),
+            "icontains": measure(lambda: list(live.filter(
+                Q(title__icontains=text) | Q(description__icontains=text)).order_by("priority", "id")[:50]), repeat),
+            "api": measure(get(client, f"/api/task/?q={text.replace(' ', '+')}"), repeat),
+        }
+    return results
+
+
+@scenario("render")
+def bench_render(tasks=5000, repeat=5, **options):
+    """
+    Rendering user_tasks.html for pages of 50 up to `tasks` cards, with an
+    empty card cache (every card rendered and stored) and a warm one.
+    """
+    user = User.objects.create_user(username="bench-render")
+    seed_tasks(user, tasks)
+    fragments = caches[FRAGMENT_CACHE]
+    results = {}
+    for size in sorted({50, tasks // 10, tasks} - {0}):
+        rows, _ = TaskDashboard(user, (PENDING, COMPLETED), page_size=size).page()
+        context = {"tasks": rows[PENDING], "completed": rows[COMPLETED], "username": user, "q": ""}
+
+        def cold():
+            fragments.clear()
+            render_to_string("user_tasks.html", context)
+
+        results[size] = {
+            "cold": measure(cold, repeat),
+            "warm": measure(lambda: render_to_string("user_tasks.html", context), repeat),
+        }
+    fragments.clear()
+    return results
+
+
+def async_get(client, url):
+    def request():
+        response = async_to_sync(client.get)(url)
+        assert response.status_code == 200, (url, response.status_code)
+    return request
+
+
+@scenario("async")
+def bench_async(users=10, tasks=1000, history=5, repeat=20, pollers=200, **options):
+    """
+    The same reads through the sync DRF views and the async views, then
+    `pollers` long-polls parked at once and woken by a single write.
+    """
+    user = seed(users, tasks, history, prefix="bench-async")[0]
+    sync_client = logged_in_client(user)
+    async_client = AsyncClient()
+    async_client.force_login(user)
+    task_id = Task.objects.filter(user=user).values_list("id", flat=True).first()
+    results = {}
+    for name, url, async_url in [
+        ("task_list", "/api/task/", "/api/async/task/"),
+        ("task_detail", f"/api/task/{task_id}/", f"/api/async/task/{task_id}/"),
+        ("task_history", f"/api/task/{task_id}/history/", f"/api/async/task/{task_id}/history/"),
+    ]:
+        results[name] = {"sync": measure(get(sync_client, url), repeat), "async": measure(async_get(async_client, async_url), repeat)}
+
+    async def long_polls():
+        version = (await async_client.get("/api/async/task/poll/")).json()["version"]
+        polls = [
+            asyncio.ensure_future(async_client.get(f"/api/async/task/poll/?version={version}&timeout=30"))
+            for _ in range(pollers)
+        ]
+        while sum(len(waiting) for waiting in watcher.waiters.values()) < pollers:
+            await asyncio.sleep(0.01)
+        threads = threading.active_count()
+        start = time.perf_counter()
+        await sync_to_async(Task.objects.create)(title="wake", description="benchmark", priority=tasks + 1, user=user)
+        responses = await asyncio.gather(*polls)
+        assert all(response.status_code == 200 for response in responses)
+        return {"pollers": pollers, "threads_while_parked": threads,
+            "wake_all_ms": round((time.perf_counter() - start) * 1000, 3), "poll_interval_s": watcher.interval}
+
+    results["long_poll"] = async_to_sync(long_polls)()
+    return results
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        size = func()
+        elapsed = time.perf_counter() - start
+        return {"ms": round(elapsed * 1000, 3), "bytes": size, "peak_kb": round(tracemalloc.get_traced_memory()[1] / 1024)}
+    finally:
+        tracemalloc.stop()
+
+
+@scenario("export")
+def bench_export(users=1, tasks=10000, history=100, **options):
+    """
+    Exporting a user's history, users x tasks x history rows (a million by
+    default), streamed in every format next to loading the rows into a
+    list first; peak_kb is the most Python memory held at any point.
+    """
+    user = seed(users, tasks, history, prefix="bench-export")[0]
+    client = logged_in_client(user)
+
+    def streamed(url):
+        def request():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            return sum(len(part) for part in response.streaming_content)
+        return request
+
+    def loaded():
+        # what a plain HttpResponse would do: every row, then the whole file, in memory
+        rows = list(TaskHistory.objects.filter(task__user=user).order_by("id").values_list(*COLUMNS["history"]))
+        return len(b"".join(encode(iter(rows), COLUMNS["history"], "csv")))
+
+    results = {"rows": tasks * history, "list_then_csv": peak_memory(loaded)}
+    for name in ("history.csv", "history.jsonl", "history.csv.gz", "history.jsonl.gz"):
+        results[name] = peak_memory(streamed(f"/api/export/{name}"))
+    return results
+
+
+@scenario("connections")
+def bench_connections(repeat=200, **options):
+    """
+    One small query per simulated request, on a connection opened for the
+    request and closed after it (DB_CONN_MAX_AGE=0, and every request under
+    ASGI without a pool), on one kept open, and on one checked out of the
+    pool and handed back. Against a local PostgreSQL (DATABASE_URL) the
+    difference is the connection setup.
+    """
+    settings_dict = connections["default"].settings_dict
+    backend = load_backend(settings_dict["ENGINE"])
+
+    def wrapper(**changes):
+        return backend.DatabaseWrapper({**settings_dict, "CONN_MAX_AGE": 0, "POOL": None, **changes}, "benchmark")
+
+    def request(db, close):
+        def run():
+            with db.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM tasks_task WHERE id < 100")
+                cursor.fetchone()
+            if close:
+                db.close()
+        return run
+
+    results = {"database": connection.vendor}
+    fresh = wrapper()
+    results["connect_per_request"] = measure(request(fresh, close=True), repeat)
+    persistent = wrapper(CONN_MAX_AGE=None)
+    results["persistent"] = measure(request(persistent, close=False), repeat)
+    persistent.close()
+    pooled = wrapper(POOL={"SIZE": 1})
+    try:
+        results["pooled"] = measure(request(pooled, close=True), repeat)
+        results["pool"] = get_pool("benchmark").stats()
+    finally:
+        close_pools()
+    return results
+
+
+def dumps(results):
+    return json.dumps(results, indent=2, default=str)
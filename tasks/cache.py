@@ -0,0 +1,65 @@
+import hashlib
+import threading
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+TASK_LIST_CACHE = "tasks"
+
+
+class CacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+
+stats = CacheStats()
+
+
+class CountingLocMemCache(LocMemCache):
+    """
+    The local-memory backend is already an LRU bounded by MAX_ENTRIES with a
+    TTL; this only counts what it evicts.
+    """
+
+    def _cull(self):
+        size = len(self._cache)
+        super()._cull()
+        stats.incr("evictions", size - len(self._cache))
+
+
+def task_list_key(user_id, version, variant):
+    # the version (see tasks.conditional) moves whenever the user's tasks change,
+    # so bumping it is what invalidates; the timestamp keeps keys unique across
+    # database resets
+    number, modified = version
+    stamp = modified.timestamp() if modified else 0
+    digest = hashlib.md5(variant.encode()).hexdigest()
+    return f"tasks:{user_id}:{number}:{stamp}:{digest}"
+
+
+def cached_task_list(user_id, version, variant, build):
+    if version is None:
+        return build()
+    key = task_list_key(user_id, version, variant)
+    cache = caches[TASK_LIST_CACHE]
+    value = cache.get(key)
+    if value is not None:
+        stats.incr("hits")
+        return value
+    stats.incr("misses")
+    value = build()
+    cache.set(key, value)
+    return value
@@ -0,0 +1,50 @@
+import hashlib
+
+from django.middleware.csrf import get_token
+from django.views.decorators.http import condition
+
+from tasks.models import TaskListVersion
+
+
+def task_list_version(request):
+    # looked up once per request and shared by the ETag and Last-Modified checks
+    if not hasattr(request, "_task_list_version"):
+        version = None
+        if request.user.is_authenticated:
+            version = (
+                TaskListVersion.objects.filter(user=request.user).values_list("version", "modified").first()
+                or (0, None)
+            )
+        request._task_list_version = version
+    return request._task_list_version
+
+
+def task_list_etag(request, *args, **kwargs):
+    version = task_list_version(request)
+    if version is None:
+        return None
+    # the same data renders differently per page, filter and content type
+    key = f"{request.user.pk}:{version[0]}:{request.get_full_path()}:{request.META.get('HTTP_ACCEPT', '')}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def task_list_last_modified(request, *args, **kwargs):
+    version = task_list_version(request)
+    return version[1] if version else None
+
+
+task_list_condition = condition(etag_func=task_list_etag, last_modified_func=task_list_last_modified)
+
+
+def task_page_etag(request, *args, **kwargs):
+    etag = task_list_etag(request)
+    if etag is None:
+        return None
+    # the pages embed a CSRF token, which a login rotates; get_token() makes
+    # sure there is one before the first page, not after it
+    get_token(request)
+    return hashlib.md5(f"{etag}:{request.META['CSRF_COOKIE']}".encode()).hexdigest()
+
+
+# no Last-Modified: a login changes the page but not the tasks
+task_page_condition = condition(etag_func=task_page_etag)
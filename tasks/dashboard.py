@@ -0,0 +1,126 @@
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+
+from tasks.models import Task, task_stats
+from tasks.search import search_tasks
+
+PAGE_SIZE = 50
+
+PENDING = "pending"
+COMPLETED = "completed"
+# cursor prefix of search result pages, which go by offset
+SEARCH = "search"
+
+SECTIONS = {
+    PENDING: Q(completed=False),
+    COMPLETED: Q(completed=True),
+}
+
+
+def live_tasks(user):
+    return Task.objects.filter(deleted=False, user=user)
+
+
+def task_counts(user):
+    # kept up to date by the task writes, a primary key lookup
+    stats = task_stats([user.pk])[user.pk]
+    return {"total_cnt": stats["total"], "completed_cnt": stats["completed"]}
+
+
+def encode_cursor(section, task=None):
+    if task is None:
+        return section
+    return f"{section}.{task.priority}.{task.id}"
+
+
+def decode_cursor(cursor, sections):
+    # a malformed or foreign cursor just restarts from the first page
+    if not cursor:
+        return None
+    section, _, position = cursor.partition(".")
+    if section not in sections:
+        return None
+    if not position:
+        return section, None
+    try:
+        priority, pk = position.split(".")
+        return section, (int(priority), int(pk))
+    except ValueError:
+        return None
+
+
+def decode_search_cursor(cursor):
+    section, _, offset = (cursor or "").partition(".")
+    if section == SEARCH and offset.isdigit():
+        return int(offset)
+    return 0
+
+
+class TaskDashboard:
+    """
+    Data for the task list pages: the counters plus one page of the rendered
+    sections, keyset-paginated on (priority, id) so a page costs the same no
+    matter how many tasks come before it. With a search `query` the page
+    holds the best matches instead, in rank order.
+    """
+
+    def __init__(self, user, sections, cursor=None, page_size=PAGE_SIZE, query=None):
+        self.user = user
+        self.sections = sections
+        self.query = query
+        if query:
+            self.offset = decode_search_cursor(cursor)
+        else:
+            self.cursor = decode_cursor(cursor, sections)
+        self.page_size = page_size
+
+    def counts(self):
+        return task_counts(self.user)
+
+    def section_queryset(self, section, after=None):
+        queryset = live_tasks(self.user).filter(SECTIONS[section])
+        if after is not None:
+            priority, pk = after
+            queryset = queryset.filter(
+                Q(priority__gt=priority) | Q(priority=priority, id__gt=pk)
+            )
+        return queryset.order_by("priority", "id")
+
+    def search_page(self):
+        rows = {section: [] for section in self.sections}
+        queryset = live_tasks(self.user).filter(reduce(or_, (SECTIONS[section] for section in self.sections)))
+        fetched = list(search_tasks(queryset, self.query)[self.offset:self.offset + self.page_size + 1])
+        for task in fetched[:self.page_size]:
+            rows[COMPLETED if task.completed else PENDING].append(task)
+        next_cursor = None
+        if len(fetched) > self.page_size:
+            next_cursor = f"{SEARCH}.{self.offset + self.page_size}"
+        return rows, next_cursor
+
+    def page(self):
+        if self.query:
+            return self.search_page()
+        rows = {section: [] for section in self.sections}
+        next_cursor = None
+        remaining = self.page_size
+
+        sections = self.sections
+        after = None
+        if self.cursor is not None:
+            section, after = self.cursor
+            sections = sections[sections.index(section):]
+
+        for section in sections:
+            # one extra row tells whether anything follows this page
+            fetched = list(self.section_queryset(section, after)[: remaining + 1])
+            after = None
+            rows[section] = fetched[:remaining]
+            if len(fetched) > remaining:
+                last = rows[section][-1] if rows[section] else None
+                next_cursor = encode_cursor(section, last)
+                break
+            remaining -= len(fetched)
+
+        return rows, next_cursor
@@ -0,0 +1,246 @@
+"""
+Database connections kept between requests and Celery tasks.
+
+Django 4.0 only keeps a connection per thread (CONN_MAX_AGE), and under
+ASGI every request runs in a thread of its own, so nothing is ever reused
+there. The backends in tasks/backends hand connections back to a
+per-process pool instead when the database settings have a "POOL" dict:
+
+    "POOL": {"SIZE": 10, "MAX_OVERFLOW": 10, "TIMEOUT": 5, "RECYCLE": 1800, "CHECK_AFTER": 30}
+
+SIZE connections stay open, MAX_OVERFLOW more are opened under load and
+closed when returned, and a checkout waits TIMEOUT seconds for one to be
+returned before failing. A connection is replaced after RECYCLE seconds,
+and tested with SELECT 1 when it has been idle for more than CHECK_AFTER.
+CONN_HEALTH_CHECKS does the same test, for connections kept without a
+pool, on their first use in each request.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from django.db.utils import OperationalError
+
+from tasks.metrics import metrics
+
+DEFAULTS = {"SIZE": 10, "MAX_OVERFLOW": 10, "TIMEOUT": 5, "RECYCLE": 1800, "CHECK_AFTER": 30}
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+def ping(raw):
+    try:
+        cursor = raw.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+def discard(raw):
+    try:
+        raw.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    def __init__(self, alias, connect, size, max_overflow=0, timeout=5, recycle=None, check_after=None):
+        self.alias = alias
+        self.connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.check_after = check_after
+        self.lock = threading.Condition()
+        # (raw connection, opened at, returned at), most recently returned last
+        self.idle = deque()
+        self.opened = {}
+        self.waiting = 0
+
+    def stats(self):
+        with self.lock:
+            return {"open": len(self.opened), "idle": len(self.idle),
+                "in_use": len(self.opened) - len(self.idle), "waiting": self.waiting}
+
+    def checkout(self, connect=None):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self.lock:
+            while True:
+                if self.idle:
+                    raw, opened_at, returned_at = self.idle.pop()
+                    break
+                if len(self.opened) < self.size + self.max_overflow:
+                    raw = opened_at = returned_at = None
+                    # reserved while it connects outside the lock
+                    key = object()
+                    self.opened[key] = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.incr("db_pool_timeouts", alias=self.alias)
+                    raise PoolTimeout(
+                        f"No {self.alias} database connection free within {self.timeout}s "
+                        f"({self.size} + {self.max_overflow} overflow in use)."
+                    )
+                self.waiting += 1
+                try:
+                    self.lock.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+        if raw is not None:
+            now = time.monotonic()
+            if self.recycle is not None and now - opened_at >= self.recycle:
+                raw = self.replace(raw, "recycled", connect)
+            elif self.check_after is not None and now - returned_at >= self.check_after and not ping(raw):
+                raw = self.replace(raw, "unusable", connect)
+        else:
+            raw = self.open(key, connect)
+        metrics.incr("db_pool_checkouts", alias=self.alias)
+        metrics.observe("db_pool_wait_seconds", time.monotonic() - start, alias=self.alias)
+        return raw
+
+    def open(self, key=None, connect=None):
+        try:
+            raw = (connect or self.connect)()
+        except BaseException:
+            with self.lock:
+                self.opened.pop(key, None)
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.opened.pop(key, None)
+            self.opened[id(raw)] = time.monotonic()
+        metrics.incr("db_pool_connects", alias=self.alias)
+        return raw
+
+    def replace(self, raw, reason, connect=None):
+        metrics.incr("db_pool_discarded", alias=self.alias, reason=reason)
+        with self.lock:
+            key = object()
+            self.opened[key] = None
+            self.opened.pop(id(raw), None)
+        discard(raw)
+        return self.open(key, connect)
+
+    def checkin(self, raw, broken=False):
+        with self.lock:
+            opened_at = self.opened.get(id(raw))
+            keep = not broken and opened_at is not None and len(self.idle) < self.size
+            if keep:
+                self.idle.append((raw, opened_at, time.monotonic()))
+            else:
+                self.opened.pop(id(raw), None)
+            self.lock.notify()
+        if not keep:
+            if broken:
+                metrics.incr("db_pool_discarded", alias=self.alias, reason="broken")
+            discard(raw)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+            for raw, _, _ in idle:
+                self.opened.pop(id(raw), None)
+        for raw, _, _ in idle:
+            discard(raw)
+
+
+pools = {}
+pools_lock = threading.Lock()
+pools_pid = os.getpid()
+
+
+def get_pool(alias, connect=None, options=None):
+    global pools, pools_pid
+    with pools_lock:
+        if pools_pid != os.getpid():
+            # a forked worker (gunicorn, Celery prefork) must not share its
+            # parent's sockets: forget them without closing
+            pools, pools_pid = {}, os.getpid()
+        pool = pools.get(alias)
+        if pool is None and connect is not None:
+            options = {**DEFAULTS, **options}
+            pool = pools[alias] = ConnectionPool(
+                alias, connect, options["SIZE"], options["MAX_OVERFLOW"], options["TIMEOUT"],
+                options["RECYCLE"], options["CHECK_AFTER"],
+            )
+        return pool
+
+
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
+
+
+def pool_gauges():
+    with pools_lock:
+        current = list(pools.values())
+    gauges = {}
+    for pool in current:
+        for name, value in pool.stats().items():
+            gauges[(f"db_pool_{name}", (("alias", pool.alias),))] = value
+        gauges[("db_pool_size", (("alias", pool.alias),))] = pool.size
+    return gauges
+
+
+metrics.gauges(pool_gauges)
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    For a backend's DatabaseWrapper: takes its connections from the pool and
+    returns them on close(), and runs CONN_HEALTH_CHECKS.
+    """
+
+    health_check_needed = False
+
+    @property
+    def pool_options(self):
+        return self.settings_dict.get("POOL")
+
+    def get_new_connection(self, conn_params):
+        if not self.pool_options:
+            return super().get_new_connection(conn_params)
+        connect = lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params)
+        return get_pool(self.alias, connect, self.pool_options).checkout(connect)
+
+    def _close(self):
+        if self.connection is None or not self.pool_options:
+            return super()._close()
+        pool = get_pool(self.alias)
+        if pool is None:
+            return super()._close()
+        # what was left uncommitted, or broken, is not handed on
+        broken = self.in_atomic_block or self.errors_occurred
+        if not broken and not self.autocommit:
+            try:
+                self.connection.rollback()
+            except Exception:
+                broken = True
+        pool.checkin(self.connection, broken=broken)
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # runs as each request starts and ends; test on the next use
+        self.health_check_needed = self.settings_dict.get("CONN_HEALTH_CHECKS", False)
+
+    def ensure_connection(self):
+        if self.connection is not None and self.health_check_needed and not self.in_atomic_block:
+            self.health_check_needed = False
+            if not ping(self.connection):
+                metrics.incr("db_health_check_failures", alias=self.alias)
+                self.errors_occurred = True
+                self.close()
+        super().ensure_connection()
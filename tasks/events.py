@@ -0,0 +1,293 @@
+"""
+Incremental task change events for the /api/task/events/ stream.
+
+The save paths in tasks.models diff tasks against `_loaded_values`, the same
+state TaskHistory is written from, and publish one event per change once the
+transaction commits. A broker keeps a bounded replay buffer per user, so a
+reconnecting client resumes from its Last-Event-ID, and wakes the listeners
+of this process. LocalBroker is in-process only; RedisBroker shares events
+between processes through a Redis stream per user.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+CREATED = "created"
+UPDATED = "updated"
+STATUS_CHANGED = "status_changed"
+DELETED = "deleted"
+SHIFTED = "shifted"
+
+EVENT_FIELDS = ("title", "description", "completed", "status", "priority", "deleted", "created_date")
+
+
+def task_fields(task, names=EVENT_FIELDS):
+    deferred = task.get_deferred_fields()
+    return {name: getattr(task, name) for name in names if name not in deferred}
+
+
+def task_event(task, created=False, fields=None):
+    """The change a save made to `task`, or None if it changed nothing we send."""
+    if created:
+        return {"kind": CREATED, "id": task.pk, "fields": task_fields(task)}
+    names = [name for name in (fields or EVENT_FIELDS) if name in EVENT_FIELDS]
+    loaded = task._loaded_values
+    changed = {
+        name: value for name, value in task_fields(task, names).items()
+        if name not in loaded or loaded[name] != value
+    }
+    if not changed:
+        return None
+    if changed.get("deleted"):
+        return {"kind": DELETED, "id": task.pk}
+    event = {"kind": UPDATED, "id": task.pk, "fields": changed}
+    if "status" in changed and "status" in loaded:
+        event.update(kind=STATUS_CHANGED, old_status=loaded["status"])
+    return event
+
+
+def update_event(task_id, values, old_status=None):
+    """The change QuerySet.update(**values) made to one task."""
+    if values.get("deleted"):
+        return {"kind": DELETED, "id": task_id}
+    fields = {name: value for name, value in values.items() if name in EVENT_FIELDS}
+    if "status" in fields and old_status is None:
+        # its status already had this value
+        del fields["status"]
+    if not fields:
+        return None
+    event = {"kind": UPDATED, "id": task_id, "fields": fields}
+    if old_status is not None:
+        event.update(kind=STATUS_CHANGED, old_status=old_status)
+    return event
+
+
+def publish_on_commit(events):
+    """`events` is a list of (user_id, event); published per user after commit."""
+    by_user = {}
+    for user_id, event in events:
+        if user_id is not None and event is not None:
+            by_user.setdefault(user_id, []).append(event)
+    for user_id, user_events in by_user.items():
+        transaction.on_commit(lambda user_id=user_id, user_events=user_events: publish(user_id, user_events))
+
+
+def publish(user_id, events):
+    try:
+        get_broker().publish(user_id, [json.dumps(event, cls=DjangoJSONEncoder) for event in events])
+    except Exception:
+        # the write has committed already, clients fall back to resyncing
+        logger.exception("publishing task events failed", extra={"user_id": user_id})
+
+
+class Broker:
+    """
+    Replay storage is up to the subclass (publish/since); waking this
+    process's listeners, sync or async, is shared.
+    """
+
+    def __init__(self, replay=500):
+        self.replay = replay
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.async_waiters = {}
+
+    def since(self, user_id, last_id):
+        """
+        Events after `last_id` as (id, data) pairs, and whether they are
+        complete: False when last_id has already left the replay buffer.
+        """
+        raise NotImplementedError
+
+    async def async_since(self, user_id, last_id):
+        return self.since(user_id, last_id)
+
+    def latest_id(self, user_id):
+        raise NotImplementedError
+
+    def notify(self, user_id):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+            waiters = list(self.async_waiters.get(user_id, ()))
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def wait(self, user_id, last_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            generation = self.generation
+            entries, complete = self.since(user_id, last_id)
+            remaining = deadline - time.monotonic()
+            if entries or not complete or remaining <= 0:
+                return entries, complete
+            with self.condition:
+                if self.generation == generation:
+                    self.condition.wait(remaining)
+
+    async def async_wait(self, user_id, last_id, timeout):
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self.condition:
+            self.async_waiters.setdefault(user_id, set()).add(waiter)
+        try:
+            entries, complete = await self.async_since(user_id, last_id)
+            if entries or not complete:
+                return entries, complete
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return [], True
+            return await self.async_since(user_id, last_id)
+        finally:
+            with self.condition:
+                waiting = self.async_waiters.get(user_id, set())
+                waiting.discard(waiter)
+                if not waiting:
+                    self.async_waiters.pop(user_id, None)
+
+
+class EventBuffer(deque):
+    # id of the newest event no longer in the buffer
+    dropped = 0
+
+
+class LocalBroker(Broker):
+    """
+    Events stay in this process. Ids count up from the start time in
+    microseconds, so they keep increasing across restarts and an id from an
+    earlier process reads as a gap rather than as the future.
+    """
+
+    def __init__(self, replay=500, max_users=10000):
+        super().__init__(replay)
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.first_id = time.time_ns() // 1000
+        self.ids = itertools.count(self.first_id)
+        self.buffers = OrderedDict()
+        # everything up to here may be missing from a buffer created later
+        self.forgotten = self.first_id - 1
+
+    def publish(self, user_id, events):
+        with self.lock:
+            buffer = self.buffers.get(user_id)
+            if buffer is None:
+                buffer = self.buffers[user_id] = EventBuffer(maxlen=self.replay)
+                buffer.dropped = self.forgotten
+                if len(self.buffers) > self.max_users:
+                    _, evicted = self.buffers.popitem(last=False)
+                    self.forgotten = max(self.forgotten, evicted[-1][0])
+            self.buffers.move_to_end(user_id)
+            for data in events:
+                if len(buffer) == buffer.maxlen:
+                    buffer.dropped = buffer[0][0]
+                buffer.append((next(self.ids), data))
+        self.notify(user_id)
+
+    def since(self, user_id, last_id):
+        try:
+            last = int(last_id)
+        except (TypeError, ValueError):
+            return [], False
+        with self.lock:
+            buffer = self.buffers.get(user_id)
+            if buffer is None:
+                return [], last >= self.forgotten
+            entries = [(str(id), data) for id, data in buffer if id > last]
+            return entries, last >= buffer.dropped
+
+    def latest_id(self, user_id):
+        with self.lock:
+            buffer = self.buffers.get(user_id)
+            return str(buffer[-1][0]) if buffer else str(self.forgotten)
+
+
+class RedisBroker(Broker):
+    """
+    One capped stream per user holds the replay buffer (ids are the stream
+    ids); a pub/sub channel tells every process which user to wake.
+    """
+
+    CHANNEL = "tasks:events"
+
+    def __init__(self, url, replay=500):
+        import redis
+
+        super().__init__(replay)
+        self.redis = redis.Redis.from_url(url)
+        self.listener = None
+        self.listener_lock = threading.Lock()
+
+    def key(self, user_id):
+        return f"tasks:events:{user_id}"
+
+    def publish(self, user_id, events):
+        pipe = self.redis.pipeline()
+        for data in events:
+            pipe.xadd(self.key(user_id), {"data": data}, maxlen=self.replay, approximate=True)
+        pipe.publish(self.CHANNEL, user_id)
+        pipe.execute()
+
+    def since(self, user_id, last_id):
+        self.listen()
+        try:
+            last = stream_id(last_id)
+            streams = self.redis.xread({self.key(user_id): last_id}, count=self.replay)
+        except Exception:
+            return [], False
+        entries = [(id.decode(), fields[b"data"].decode()) for _, stream in streams for id, fields in stream]
+        # the stream is trimmed from the front; if the client's id is older
+        # than what is left, events in between may be gone
+        oldest = self.redis.xrange(self.key(user_id), count=1)
+        return entries, not oldest or stream_id(oldest[0][0].decode()) <= last
+
+    async def async_since(self, user_id, last_id):
+        # redis-py 4.1 has no asyncio client
+        return await sync_to_async(self.since, thread_sensitive=False)(user_id, last_id)
+
+    def latest_id(self, user_id):
+        self.listen()
+        latest = self.redis.xrevrange(self.key(user_id), count=1)
+        return latest[0][0].decode() if latest else "0-0"
+
+    def listen(self):
+        with self.listener_lock:
+            if self.listener is None or not self.listener.is_alive():
+                self.listener = threading.Thread(target=self.run_listener, name="task-events", daemon=True)
+                self.listener.start()
+
+    def run_listener(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                for message in pubsub.listen():
+                    self.notify(int(message["data"]))
+            except Exception:
+                logger.exception("task event listener lost Redis, reconnecting")
+                time.sleep(1)
+
+
+def stream_id(id):
+    milliseconds, _, sequence = id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    config = settings.TASK_EVENTS
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
@@ -0,0 +1,189 @@
+"""
+Exports of a user's tasks or task history as CSV or JSON lines, optionally
+gzipped: GET /api/export/<kind>.<csv|jsonl>[.gz] streams them, POST writes
+the same bytes to EXPORT_ROOT from a Celery task and answers with a signed
+download link, and `manage.py export_tasks` writes them to a file.
+
+Rows come from QuerySet.iterator() a chunk at a time and are encoded and
+sent on as they arrive, so memory stays flat however many there are.
+"""
+import csv
+import io
+import os
+import re
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.http import FileResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from tasks.metrics import metrics
+from tasks.models import ArchivedTask, ArchivedTaskHistory, Task, TaskHistory
+
+CHUNK_SIZE = 2000
+# bytes collected before a part is sent on
+PART_SIZE = 64 * 1024
+
+COLUMNS = {
+    "tasks": ["id", "title", "description", "status", "completed", "priority", "created_date"],
+    "history": ["id", "task_id", "old_status", "new_status", "change_date"],
+}
+CONTENT_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+EXPORT_NAME = re.compile(r"^(?P<kind>tasks|history)\.(?P<fmt>csv|jsonl)(?P<gzip>\.gz)?$")
+SIGNING_SALT = "tasks.exports"
+
+
+def export_rows(user_id, kind):
+    columns = COLUMNS[kind]
+    if kind == "tasks":
+        querysets = [Task.objects.filter(user_id=user_id, deleted=False)]
+    else:
+        # archived history first, it is the older part
+        querysets = [
+            ArchivedTaskHistory.objects.filter(
+                Q(task_id__in=Task.objects.filter(user_id=user_id).values("id"))
+                | Q(task_id__in=ArchivedTask.objects.filter(user_id=user_id).values("id"))
+            ),
+            TaskHistory.objects.filter(task__user_id=user_id),
+        ]
+    for queryset in querysets:
+        yield from queryset.order_by("id").values_list(*columns).iterator(chunk_size=CHUNK_SIZE)
+
+
+def encode(rows, columns, fmt):
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    else:
+        encoder = DjangoJSONEncoder()
+
+        def write(row):
+            buffer.write(encoder.encode(dict(zip(columns, row))))
+            buffer.write("\n")
+
+    for row in rows:
+        write(row)
+        if buffer.tell() >= PART_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def gzipped(parts):
+    compressor = zlib.compressobj(wbits=31)
+    for part in parts:
+        compressed = compressor.compress(part)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_parts(user_id, kind, fmt, gzip=False):
+    parts = encode(export_rows(user_id, kind), COLUMNS[kind], fmt)
+    return gzipped(parts) if gzip else parts
+
+
+def export_filename(kind, fmt, gzip=False):
+    return f"{kind}.{fmt}" + (".gz" if gzip else "")
+
+
+def failed_marker(path):
+    return f"{path}.failed"
+
+
+def write_export(user_id, kind, fmt, gzip, path):
+    # written under a temporary name, the download link finds it complete or not at all
+    partial = f"{path}.part"
+    size = 0
+    try:
+        with open(partial, "wb") as output:
+            for part in export_parts(user_id, kind, fmt, gzip):
+                output.write(part)
+                size += len(part)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        # so the download link stops answering "pending"
+        with open(failed_marker(path), "w"):
+            pass
+        raise
+    os.replace(partial, path)
+    return size
+
+
+class ExportNegotiation(BaseContentNegotiation):
+    # the body is CSV or JSON lines whatever is asked for, Accept only
+    # chooses how errors and links are rendered
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class ExportView(APIView):
+    permission_classes = (IsAuthenticated,)
+    content_negotiation_class = ExportNegotiation
+    # the rows are read while streaming, after the budget is checked
+    query_budget = 2
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        match = EXPORT_NAME.match(kwargs["name"])
+        if match is None:
+            raise NotFound("Unknown export, expected tasks or history as .csv or .jsonl, optionally .gz.")
+        self.kind, self.fmt, self.gzip = match["kind"], match["fmt"], bool(match["gzip"])
+
+    def get(self, request, name):
+        kind, fmt, gzip = self.kind, self.fmt, self.gzip
+        response = StreamingHttpResponse(export_parts(request.user.pk, kind, fmt, gzip),
+            content_type="application/gzip" if gzip else CONTENT_TYPES[fmt])
+        response["Content-Disposition"] = f'attachment; filename="{export_filename(kind, fmt, gzip)}"'
+        metrics.incr("exports", kind=kind, format=fmt, gzip=gzip, mode="stream")
+        return response
+
+    def post(self, request, name):
+        from tasks.tasks import export_to_file
+
+        kind, fmt, gzip = self.kind, self.fmt, self.gzip
+        stored = f"{uuid.uuid4().hex}-{export_filename(kind, fmt, gzip)}"
+        user_id = request.user.pk
+        transaction.on_commit(lambda: export_to_file.delay(user_id, kind, fmt, gzip, stored))
+        token = signing.dumps({"user": user_id, "file": stored}, salt=SIGNING_SALT)
+        url = request.build_absolute_uri(f"/api/export/download/{token}/")
+        return Response({"url": url}, status=status.HTTP_202_ACCEPTED)
+
+
+class ExportDownloadView(APIView):
+    permission_classes = (IsAuthenticated,)
+    content_negotiation_class = ExportNegotiation
+    query_budget = 2
+
+    def get(self, request, token):
+        try:
+            signed = signing.loads(token, salt=SIGNING_SALT, max_age=settings.EXPORT_LINK_MAX_AGE)
+        except signing.BadSignature:
+            raise NotFound("Invalid or expired link.")
+        if signed["user"] != request.user.pk:
+            raise NotFound("Invalid or expired link.")
+        path = os.path.join(settings.EXPORT_ROOT, signed["file"])
+        if os.path.exists(failed_marker(path)):
+            return Response({"status": "failed", "detail": "The export failed, request a new one."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if not os.path.exists(path):
+            # still being written
+            return Response({"status": "pending"}, status=status.HTTP_202_ACCEPTED)
+        return FileResponse(open(path, "rb"), as_attachment=True, filename=signed["file"].split("-", 1)[1])
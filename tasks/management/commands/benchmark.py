@@ -0,0 +1,72 @@
+import platform
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from tasks.benchmarks import SCENARIOS, dumps
+from tasks.cache import TASK_LIST_CACHE
+from task_manager.celery import app
+
+
+class Command(BaseCommand):
+    help = (
+        "Run benchmark scenarios against the configured database (SQLite, or PostgreSQL via "
+        "DATABASE_URL) and print or write the results as JSON. Seeded data is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenarios", nargs="*", help=f"Any of {', '.join(sorted(SCENARIOS))}; all by default.")
+        parser.add_argument("--users", type=int, help="Users to seed.")
+        parser.add_argument("--tasks", type=int, help="Tasks per user.")
+        parser.add_argument("--history", type=int, help="History rows per task.")
+        parser.add_argument("--reports", type=int, help="Report rows for the scheduler scenario.")
+        parser.add_argument("--repeat", type=int, help="Timed runs per measurement.")
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+        parser.add_argument("--cache", action="store_true", help="Keep the task list cache, measure warm reads.")
+
+    def handle(self, *args, **options):
+        names = options["scenarios"] or sorted(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        params = {
+            name: options[name]
+            for name in ("users", "tasks", "history", "reports", "repeat")
+            if options[name] is not None
+        }
+        results = {
+            "meta": {
+                "started": datetime.now(timezone.utc).isoformat(),
+                "database": connection.vendor,
+                "django": django.get_version(),
+                "python": platform.python_version(),
+                "params": params,
+                "cache": options["cache"],
+            },
+            "scenarios": {},
+        }
+
+        # run Celery tasks inline and keep mail in memory, so only our code is timed
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        caches = {**settings.CACHES}
+        if not options["cache"]:
+            caches[TASK_LIST_CACHE] = {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}
+        try:
+            with override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", CACHES=caches):
+                for name in names:
+                    with transaction.atomic():
+                        results["scenarios"][name] = SCENARIOS[name](**params)
+                        transaction.set_rollback(True)
+        finally:
+            app.conf.task_always_eager = eager
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(dumps(results))
+        else:
+            self.stdout.write(dumps(results))
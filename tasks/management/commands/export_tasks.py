@@ -0,0 +1,33 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from tasks.exports import COLUMNS, export_parts
+
+
+class Command(BaseCommand):
+    help = "Write a user's tasks or task history as CSV or JSON lines, streamed row by row, to a file or stdout."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", required=True, help="User id or username.")
+        parser.add_argument("--kind", choices=sorted(COLUMNS), default="tasks")
+        parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", dest="fmt")
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("--output", help="File to write; stdout by default.")
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(pk=options["user"]) if options["user"].isdigit() else User.objects.filter(username=options["user"])
+        user = users.first()
+        if user is None:
+            raise CommandError(f"No user {options['user']}")
+
+        parts = export_parts(user.pk, options["kind"], options["fmt"], options["gzip"])
+        if options["output"]:
+            with open(options["output"], "wb") as output:
+                for part in parts:
+                    output.write(part)
+        else:
+            for part in parts:
+                sys.stdout.buffer.write(part)
+            sys.stdout.buffer.flush()
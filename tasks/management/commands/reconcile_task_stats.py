@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from tasks.models import reconcile_task_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount UserTaskStats from the tasks and repair rows that drifted. "
+        "Also creates the rows of users that have none, e.g. after the migration that added them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--user", type=int, action="append", dest="users", help="Only this user id; repeatable.")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        users = User.objects.order_by("id")
+        if options["users"]:
+            users = users.filter(id__in=options["users"])
+
+        checked = 0
+        repaired = []
+        last_id = 0
+        while True:
+            batch = list(users.filter(id__gt=last_id).values_list("id", flat=True)[:batch_size])
+            if not batch:
+                break
+            repaired += reconcile_task_stats(batch)
+            checked += len(batch)
+            last_id = batch[-1]
+        self.stdout.write(f"Checked {checked} users, repaired {len(repaired)}")
+        if repaired and options["verbosity"] > 1:
+            self.stdout.write("Repaired users: " + ", ".join(map(str, repaired)))
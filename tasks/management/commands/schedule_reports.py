@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tasks.models import Report
+
+
+class Command(BaseCommand):
+    help = "Backfill Report.next_run_at from each report's send_time and confirmation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--all", action="store_true", help="Recompute reports that are already scheduled too.")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        reports = Report.objects.order_by("id")
+        if not options["all"]:
+            reports = reports.filter(next_run_at__isnull=True, confirmation=True)
+
+        now = timezone.now()
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(reports.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            for report in batch:
+                report.schedule(now)
+            Report.objects.bulk_update(batch, ["next_run_at"])
+            updated += len(batch)
+            last_id = batch[-1].id
+        self.stdout.write(f"Scheduled {updated} reports")
@@ -0,0 +1,242 @@
+"""
+In-process counters and timers, exported in the Prometheus text format by
+the /metrics view. Recording is a dict update under a lock, cheap enough to
+leave on. Every series carries the process it comes from as its `instance`
+label; with METRICS_REDIS_URL set each process (web worker, Celery worker)
+pushes its numbers there every METRICS_PUSH_SECONDS and /metrics exports
+them all, whichever worker the scrape reaches.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.deprecation import MiddlewareMixin
+
+from tasks.cache import stats as cache_stats
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = True
+        # callables returning {(name, labels): value}, read at export time
+        self.gauge_callbacks = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            # (name, labels) -> [count, sum, max]
+            self.timers = {}
+
+    def incr(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, value, value]
+            else:
+                timer[0] += 1
+                timer[1] += value
+                timer[2] = max(timer[2], value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauges(self, callback):
+        self.gauge_callbacks.append(callback)
+
+    def value(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key in self.counters:
+                return self.counters[key]
+            return list(self.timers.get(key, [0, 0, 0]))
+
+    def snapshot(self):
+        """This process's numbers, as JSON-able [name, labels, values...] rows."""
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {key: list(timer) for key, timer in self.timers.items()}
+        for name, value in cache_stats.snapshot().items():
+            counters[(f"task_list_cache_{name}", ())] = value
+        gauges = {}
+        for callback in self.gauge_callbacks:
+            gauges.update(callback())
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in sorted(counters.items())],
+            "gauges": [[name, labels, value] for (name, labels), value in sorted(gauges.items())],
+            "timers": [[name, labels, *timer] for (name, labels), timer in sorted(timers.items())],
+        }
+
+    def exposition(self, snapshots=None):
+        if snapshots is None:
+            snapshots = {instance(): self.snapshot()}
+        lines = []
+        for process, snapshot in sorted(snapshots.items()):
+            process = (("instance", process),)
+            for name, labels, value in snapshot["counters"]:
+                lines.append(f"tasks_{name}_total{format_labels(labels, process)} {value}")
+            for name, labels, value in snapshot["gauges"]:
+                lines.append(f"tasks_{name}{format_labels(labels, process)} {value}")
+            for name, labels, count, total, maximum in snapshot["timers"]:
+                lines.append(f"tasks_{name}_count{format_labels(labels, process)} {count}")
+                lines.append(f"tasks_{name}_sum{format_labels(labels, process)} {total:.6f}")
+                lines.append(f"tasks_{name}_max{format_labels(labels, process)} {maximum:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def push_every(self, store, seconds):
+        """Push this process's snapshot to `store` from a daemon thread, in forked children too."""
+
+        def push():
+            while True:
+                time.sleep(seconds)
+                try:
+                    store.push(instance(), self.snapshot())
+                except Exception:
+                    logger.warning("metrics push failed", exc_info=True)
+
+        def start():
+            threading.Thread(target=push, name="metrics-push", daemon=True).start()
+
+        start()
+        # threads do not survive a fork: gunicorn and Celery prefork workers start their own
+        os.register_at_fork(after_in_child=start)
+
+
+def instance():
+    # after the fork, each worker process is one
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def format_labels(labels, extra=()):
+    labels = [*labels, *extra]
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class RedisMetricsStore:
+    """Every process's last snapshot, expiring a while after the process stops pushing."""
+
+    PREFIX = "metrics:"
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def push(self, process, snapshot):
+        self.redis.set(self.PREFIX + process, json.dumps(snapshot), ex=self.ttl)
+
+    def collect(self):
+        keys = list(self.redis.scan_iter(self.PREFIX + "*"))
+        values = self.redis.mget(keys) if keys else []
+        return {
+            key.decode()[len(self.PREFIX):]: json.loads(value)
+            for key, value in zip(keys, values) if value is not None
+        }
+
+
+logger = logging.getLogger(__name__)
+metrics = Registry()
+metrics_store = None
+
+
+def start_metrics_push():
+    global metrics_store
+    url = getattr(settings, "METRICS_REDIS_URL", None)
+    if not url or metrics_store is not None:
+        return
+    seconds = settings.METRICS_PUSH_SECONDS
+    metrics_store = RedisMetricsStore(url, ttl=seconds * 4)
+    metrics.push_every(metrics_store, seconds)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: the message plus any `extra` fields."""
+
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RESERVED)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+request_logger = logging.getLogger("tasks.requests")
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Times each request per URL name. Sits outside QueryBudgetMiddleware and
+    reads the ORM time from the recorder it leaves on the request.
+    """
+
+    def process_request(self, request):
+        request.metrics_started = time.perf_counter()
+
+    def process_response(self, request, response):
+        duration = time.perf_counter() - request.metrics_started
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "unmatched"
+        metrics.observe("request_seconds", duration, view=view, method=request.method)
+        metrics.incr("responses", view=view, status=response.status_code)
+        recorder = getattr(request, "query_recorder", None)
+        if recorder is not None:
+            metrics.observe("db_seconds", recorder.duration, view=view)
+            metrics.incr("db_queries", recorder.count, view=view)
+        request_logger.info("request", extra={
+            "view": view, "method": request.method, "status": response.status_code,
+            "duration_ms": round(duration * 1000, 2),
+            "queries": recorder.count if recorder is not None else None,
+        })
+        return response
+
+
+def metrics_view(request):
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token and request.META.get("HTTP_AUTHORIZATION") != f"Bearer {token}":
+        return HttpResponseForbidden()
+    snapshots = None
+    if metrics_store is not None:
+        try:
+            snapshots = metrics_store.collect()
+        except Exception:
+            logger.warning("metrics collect failed", exc_info=True)
+            snapshots = {}
+        # this process's own numbers as they are now
+        snapshots[instance()] = metrics.snapshot()
+    return HttpResponse(metrics.exposition(snapshots), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0015_task_user_priority_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.0.1 on 2026-10-18 13:04
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tasks', '0018_tasklistversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasklistversion',
+            name='sync_horizon',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='TaskChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.BigIntegerField(null=True)),
+                ('kind', models.CharField(max_length=20)),
+                ('changes', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='taskchange',
+            index=models.Index(fields=['user', 'id'], name='taskchange_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='taskchange',
+            index=models.Index(fields=['task_id', 'id'], name='taskchange_task_id_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+from tasks.search import install_search_index, remove_search_index
+
+
+def install(apps, schema_editor):
+    install_search_index(schema_editor)
+
+
+def remove(apps, schema_editor):
+    remove_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0019_taskchange'),
+    ]
+
+    # the GIN index (PostgreSQL) or FTS5 table (SQLite) of tasks.search,
+    # neither of which the model state can describe
+    operations = [
+        migrations.RunPython(install, remove),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.1 on 2026-10-18 13:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('tasks', '0020_task_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTaskStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('pending_status', models.PositiveIntegerField(default=0)),
+                ('in_progress_status', models.PositiveIntegerField(default=0)),
+                ('completed_status', models.PositiveIntegerField(default=0)),
+                ('cancelled_status', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
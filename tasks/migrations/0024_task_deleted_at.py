@@ -0,0 +1,38 @@
+# Generated by Django 4.0.1 on 2026-10-18 14:25
+
+from django.db import migrations, models
+
+
+def backfill_deleted_at(apps, schema_editor):
+    # the best guess for tasks deleted before the field existed
+    Task = apps.get_model("tasks", "Task")
+    Task.objects.filter(deleted=True).update(deleted_at=models.F("created_date"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0023_outboundemail'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='task',
+            name='task_deleted_date_idx',
+        ),
+        migrations.AddField(
+            model_name='archivedtask',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_deleted_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('deleted', True)), fields=['deleted_at', 'id'], name='task_deleted_at_idx'),
+        ),
+    ]
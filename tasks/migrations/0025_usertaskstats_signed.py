@@ -0,0 +1,43 @@
+# Generated by Django 4.0.1 on 2026-10-18 14:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0024_task_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usertaskstats',
+            name='cancelled_status',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='usertaskstats',
+            name='completed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='usertaskstats',
+            name='completed_status',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='usertaskstats',
+            name='in_progress_status',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='usertaskstats',
+            name='pending_status',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='usertaskstats',
+            name='total',
+            field=models.IntegerField(default=0),
+        ),
+    ]
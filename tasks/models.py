@@ -1,9 +1,17 @@
 
 from django.contrib.auth.models import User
-from django.db import models
-from datetime import time
-from django.db.models.signals import pre_save, post_save
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, router, transaction
+from collections import Counter
+from datetime import time, timedelta
+from django.db.models import Case, Count, F
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
+
+from tasks import events
+from tasks.cache import stats as cache_stats
+from tasks.metrics import metrics
 
 STATUS_CHOICES = [
     ("PENDING", "PENDING"),
@@ -13,47 +21,537 @@ STATUS_CHOICES = [
 ]
 
 
+class TaskQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # bulk_update() reaches here with Case() expressions and does its own bookkeeping
+        if kwargs and all(isinstance(value, Case) for value in kwargs.values()):
+            return super().update(**kwargs)
+        if "deleted" in kwargs and "deleted_at" not in kwargs:
+            kwargs["deleted_at"] = timezone.now() if kwargs["deleted"] else None
+        # expressions (F("priority") + 1) have no value to send; their callers
+        # publish what they changed, see tasks.priorities.shift_priorities
+        plain = not any(hasattr(value, "resolve_expression") for value in kwargs.values())
+        values = {("user_id" if name == "user" else name): getattr(value, "pk", value) for name, value in kwargs.items()}
+        counted = not STATS_FIELDS.isdisjoint(values)
+        with transaction.atomic(using=self.db, savepoint=False):
+            if plain:
+                # the counted fields as they were, to adjust UserTaskStats by
+                # locked, so a concurrent writer of the same tasks waits and
+                # then counts from what this one left
+                tasks = list(self.order_by().select_for_update().values("id", *STATS_FIELDS) if counted else
+                    self.order_by().values("id", "user_id"))
+                user_ids = {task["user_id"] for task in tasks}
+            else:
+                user_ids = set(self.order_by().values_list("user_id", flat=True).distinct())
+            status = kwargs.get("status")
+            old_statuses = {}
+            if status is not None and plain:
+                old_statuses = {task["id"]: task["status"] for task in tasks if task["status"] != status}
+                history = TaskHistory.objects.bulk_create(
+                    TaskHistory(task_id=task_id, old_status=old_status, new_status=status)
+                    for task_id, old_status in old_statuses.items()
+                )
+                metrics.incr("history_writes", len(history))
+            rows = super().update(**kwargs)
+            if plain:
+                # tasks handed to another user change that user's list too
+                user_ids.add(values.get("user_id"))
+            touch_task_lists(user_ids)
+            if plain:
+                if counted:
+                    deltas = {}
+                    for task in tasks:
+                        count_task(deltas, task, -1)
+                        count_task(deltas, {**task, **values}, 1)
+                    update_task_stats(deltas)
+                record_changes(
+                    (task["user_id"], events.update_event(task["id"], kwargs, old_statuses.get(task["id"])))
+                    for task in tasks
+                )
+            elif counted:
+                # no values to count with, recount whom it may have touched;
+                # an expression moving tasks to other users is not supported
+                reconcile_task_stats(user_ids - {None})
+        return rows
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        objs = list(objs)
+        if "deleted" in fields and "deleted_at" not in fields:
+            for obj in objs:
+                if obj.deleted != (obj.deleted_at is not None):
+                    obj.deleted_at = timezone.now() if obj.deleted else None
+            fields = [*fields, "deleted_at"]
+        names = {"user_id" if name == "user" else name for name in fields}
+        with transaction.atomic(using=self.db, savepoint=False):
+            stored = stored_values(objs, STATS_FIELDS, lock=True) if not STATS_FIELDS.isdisjoint(names) else {}
+            if "status" in fields:
+                record_status_changes(objs, stored)
+            rows = super().bulk_update(objs, fields, batch_size=batch_size)
+            users = task_users(objs)
+            touch_task_lists(set(users.values()) | {values.get("user_id") for values in stored.values()})
+            if stored:
+                deltas = {}
+                for obj in objs:
+                    if obj.pk in stored:
+                        count_task(deltas, stored[obj.pk], -1)
+                        count_task(deltas, {**stored[obj.pk], **counted_values(obj, names)}, 1)
+                update_task_stats(deltas)
+            record_changes((users[obj.pk], events.task_event(obj, fields=fields)) for obj in objs)
+        for obj in objs:
+            obj.remember_loaded_values(fields)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            touch_task_lists(task.user_id for task in objs)
+            deltas = {}
+            for task in objs:
+                count_task(deltas, counted_values(task), 1)
+            update_task_stats(deltas)
+            # ids are only known on backends that return them (not SQLite < 3.35)
+            record_changes(
+                (task.user_id, events.task_event(task, created=True)) for task in objs if task.pk is not None
+            )
+        return objs
+
+
 class Task(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField()
     completed = models.BooleanField(default=False)
     created_date = models.DateTimeField(auto_now=True)
     deleted = models.BooleanField(default=False)
+    # when it was soft-deleted, the archive's clock; created_date moves on every save
+    deleted_at = models.DateTimeField(null=True, blank=True)
     priority= models.IntegerField(default=0)
     user = models.ForeignKey(User , on_delete=models.CASCADE , null=True,blank=True)
     status = models.CharField(
         max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0]
     )
 
+    objects = TaskQuerySet.as_manager()
+
+    # field values as last read from / written to the database, keyed by attname
+    _loaded_values = {}
+
+    class Meta:
+        # every hot query is scoped to one user's live (not deleted) tasks
+        indexes = [
+            # task lists and the API, ordered by (priority, id)
+            models.Index(fields=["user", "priority", "id"], name="task_live_priority_idx",
+                condition=models.Q(deleted=False)),
+            # pending list and the collision-run lookup in tasks.priorities
+            models.Index(fields=["user", "priority", "id"], name="task_pending_priority_idx",
+                condition=models.Q(deleted=False, completed=False)),
+            # status / completed counters, answered from the index alone
+            models.Index(fields=["user", "status", "completed"], name="task_live_status_idx",
+                condition=models.Q(deleted=False)),
+            # soft-deleted tasks due for the archive, oldest first
+            models.Index(fields=["deleted_at", "id"], name="task_deleted_at_idx",
+                condition=models.Q(deleted=True)),
+        ]
+
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def remember_loaded_values(self, fields=None):
+        deferred = self.get_deferred_fields()
+        loaded = dict(self._loaded_values)
+        for field in self._meta.concrete_fields:
+            if fields is not None and field.name not in fields and field.attname not in fields:
+                continue
+            if field.attname not in deferred:
+                loaded[field.attname] = getattr(self, field.attname)
+        self._loaded_values = loaded
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self.remember_loaded_values(fields)
+
+    def save(self, *args, **kwargs):
+        if self.deleted != (self.deleted_at is not None):
+            self.deleted_at = timezone.now() if self.deleted else None
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "deleted_at"}
+        # the signals' locked read, the row and the counters commit together
+        with transaction.atomic(using=kwargs.get("using") or router.db_for_write(Task, instance=self), savepoint=False):
+            super().save(*args, **kwargs)
+        self.remember_loaded_values(kwargs.get("update_fields"))
+
 class TaskHistory(models.Model):
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     old_status= models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
     new_status= models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])  
     change_date = models.DateTimeField(auto_now=True) 
-    
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["task", "change_date"], name="taskhistory_task_date_idx"),
+        ]
 
     def __str__(self):
         return self.task.title + " changed from " + self.old_status + " to " + self.new_status + " on " + str(self.change_date)
 
 
+class ArchivedTask(models.Model):
+    """
+    A soft-deleted task moved out of tasks_task by tasks.tasks.archive_cold_rows,
+    under its original id.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    title = models.CharField(max_length=100)
+    description = models.TextField()
+    completed = models.BooleanField(default=False)
+    created_date = models.DateTimeField()
+    deleted = models.BooleanField(default=True)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    priority = models.IntegerField(default=0)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
+    archived_at = models.DateTimeField(default=timezone.now)
+
+
+class ArchivedTaskHistory(models.Model):
+    # the task is live or archived, so no foreign key
+    id = models.BigIntegerField(primary_key=True)
+    task_id = models.BigIntegerField()
+    old_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
+    new_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
+    change_date = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["task_id", "change_date"], name="archivedhistory_task_date_idx"),
+        ]
+
+
 class Report(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE,)
     confirmation = models.BooleanField(blank=True, default=False, help_text="I want to receive daily reports")
     send_time = models.TimeField(default=time(0, 0, 0), help_text="Enter time in UTC format hh:mm:ss .")
     last_updated = models.DateTimeField(null=True)
-    
+    # next time the report is due, None while reports are switched off
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def schedule(self, now=None):
+        if not self.confirmation:
+            self.next_run_at = None
+            return
+        now = now or timezone.now()
+        run_at = now.replace(hour=self.send_time.hour, minute=self.send_time.minute,
+            second=self.send_time.second, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+        self.next_run_at = run_at
+
+
+class OutboundEmail(models.Model):
+    """
+    An email waiting to be sent by tasks.tasks.drain_outbound_email, deleted
+    once it is. A failed send is tried again at next_attempt_at, and marked
+    FAILED, with its last error, after EMAIL_MAX_ATTEMPTS.
+    """
+    QUEUED = "QUEUED"
+    FAILED = "FAILED"
+
+    status = models.CharField(max_length=10, choices=[(QUEUED, QUEUED), (FAILED, FAILED)], default=QUEUED)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    sender = models.CharField(max_length=254)
+    recipients = models.JSONField(default=list)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # the drain's scan: due emails, oldest first
+            models.Index(fields=["next_attempt_at", "id"], name="outboundemail_due_idx",
+                condition=models.Q(status="QUEUED")),
+        ]
+
+
+class TaskListVersion(models.Model):
+    # bumped on every change to the user's tasks or their history, drives ETags
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+    # TaskChange entries up to this id may have been pruned, older sync tokens get a full sync
+    sync_horizon = models.BigIntegerField(default=0)
+
+
+class UserTaskStats(models.Model):
+    """
+    A user's live (not deleted) task counts, adjusted in the transaction of
+    every task write so reading them is a primary key lookup. The
+    reconcile_task_stats command repairs any drift.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    # signed, so a drifted count can still be written, and repaired
+    total = models.IntegerField(default=0)
+    completed = models.IntegerField(default=0)
+    pending_status = models.IntegerField(default=0)
+    in_progress_status = models.IntegerField(default=0)
+    completed_status = models.IntegerField(default=0)
+    cancelled_status = models.IntegerField(default=0)
+
+
+# the task fields UserTaskStats counts by, and the counter of each status
+STATS_FIELDS = frozenset(["user_id", "status", "completed", "deleted"])
+STATUS_STATS = {status: f"{status.lower()}_status" for status, _ in STATUS_CHOICES}
+STATS_COUNTERS = ["total", "completed", *STATUS_STATS.values()]
+
+
+class TaskChange(models.Model):
+    """
+    Append-only log of every change to a task, in the shape of the events
+    sent by tasks.events, read by the delta sync API. Only the newest entry
+    per task matters to a client, so superseded ones are compacted away
+    (tasks.tasks.compact_task_changes), and entries past the retention are
+    pruned below TaskListVersion.sync_horizon.
+    """
+    # no constraints: entries outlive hard-deleted tasks and users until pruned
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    task_id = models.BigIntegerField(null=True)
+    kind = models.CharField(max_length=20)
+    changes = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"], name="taskchange_user_id_idx"),
+            models.Index(fields=["task_id", "id"], name="taskchange_task_id_idx"),
+        ]
+
+
+def record_changes(changes):
+    """
+    Log (user_id, event) changes and publish them once committed. Called
+    after touch_task_lists: its lock on the user's version row makes each
+    user's log ids follow commit order, which the sync token relies on.
+    """
+    changes = [(user_id, event) for user_id, event in changes if user_id is not None and event is not None]
+    if not changes:
+        return
+    TaskChange.objects.bulk_create(
+        TaskChange(user_id=user_id, task_id=event.get("id"), kind=event["kind"],
+            changes={name: value for name, value in event.items() if name not in ("kind", "id")})
+        for user_id, event in changes
+    )
+    events.publish_on_commit(changes)
+
+
+def touch_task_lists(user_ids):
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    now = timezone.now()
+    cache_stats.incr("invalidations", len(user_ids))
+    updated = TaskListVersion.objects.filter(user_id__in=user_ids).update(version=F("version") + 1, modified=now)
+    if updated < len(user_ids):
+        # not for users deleted along with their tasks
+        user_ids = User.objects.filter(pk__in=user_ids).values_list("id", flat=True)
+        TaskListVersion.objects.bulk_create(
+            [TaskListVersion(user_id=user_id, version=1, modified=now) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+
+
+def counted_values(task, names=STATS_FIELDS):
+    deferred = task.get_deferred_fields()
+    return {name: getattr(task, name) for name in names & STATS_FIELDS if name not in deferred}
+
+
+def stored_values(tasks, names, lock=False):
+    """
+    pk -> the stored values of `names`, looked up only where a task was not
+    loaded. With `lock`, always read, and under a row lock, as the counters
+    are adjusted from them: values loaded earlier may be stale by now.
+    """
+    stored = {}
+    unknown = []
+    for task in tasks:
+        if task.pk is None:
+            continue
+        if not lock and all(name in task._loaded_values for name in names):
+            stored[task.pk] = {name: task._loaded_values[name] for name in names}
+        else:
+            unknown.append(task.pk)
+    if unknown:
+        queryset = Task.objects.filter(pk__in=unknown)
+        if lock:
+            queryset = queryset.select_for_update()
+        stored.update((row["id"], row) for row in queryset.values("id", *names))
+    return stored
+
+
+def count_task(deltas, values, sign):
+    """Add (sign=1) or take away (sign=-1) a task's share of its user's counts."""
+    if not values or values.get("deleted") or values.get("user_id") is None:
+        return
+    counts = deltas.setdefault(values["user_id"], Counter())
+    counts["total"] += sign
+    counts["completed"] += sign * bool(values.get("completed"))
+    if values.get("status") in STATUS_STATS:
+        counts[STATUS_STATS[values["status"]]] += sign
+
+
+def update_task_stats(deltas):
+    """
+    Apply user id -> Counter deltas as `counter = counter + n`, one UPDATE
+    per distinct delta. Called after touch_task_lists, whose lock on the
+    version rows already orders concurrent writers.
+    """
+    groups = {}
+    for user_id, counts in deltas.items():
+        delta = tuple(sorted((name, n) for name, n in counts.items() if n))
+        if user_id is not None and delta:
+            groups.setdefault(delta, []).append(user_id)
+    missing = set()
+    for delta, user_ids in groups.items():
+        updated = UserTaskStats.objects.filter(user_id__in=user_ids).update(
+            **{name: F(name) + n for name, n in delta}
+        )
+        if updated < len(user_ids):
+            missing.update(user_ids)
+    if missing:
+        missing -= set(UserTaskStats.objects.filter(user_id__in=missing).values_list("user_id", flat=True))
+        # no row to adjust yet, count the tasks as they are now instead
+        reconcile_task_stats(missing)
+
+
+def count_tasks(user_ids, using=None):
+    """user id -> Counter of STATS_COUNTERS, counted from the tasks."""
+    counts = {user_id: Counter() for user_id in user_ids}
+    rows = (
+        Task.objects.using(using).filter(user_id__in=user_ids, deleted=False)
+        .values("user_id", "status", "completed")
+        .annotate(n=Count("id"))
+        .order_by()
+    )
+    for row in rows:
+        count_task(counts, row, row["n"])
+    return counts
+
+
+def task_stats(user_ids, using=None):
+    """user id -> {counter: value}, recounted for users without stats."""
+    stats = {
+        row.pop("user_id"): row
+        for row in UserTaskStats.objects.using(using).filter(user_id__in=user_ids).values("user_id", *STATS_COUNTERS)
+    }
+    missing = [user_id for user_id in user_ids if user_id not in stats]
+    if missing:
+        for user_id, counts in count_tasks(missing, using).items():
+            stats[user_id] = {name: counts[name] for name in STATS_COUNTERS}
+    return stats
+
+
+def reconcile_task_stats(user_ids):
+    """Recount the users' stats from their tasks and store them; returns the ids that were off."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return []
+    with transaction.atomic():
+        # locked before counting: a writer that has adjusted a row commits
+        # first and is counted, one that has not adjusts our recount
+        existing = UserTaskStats.objects.select_for_update().in_bulk(user_ids)
+        counts = count_tasks(user_ids)
+        changed, created = [], []
+        for user_id, counted in counts.items():
+            stats = existing.get(user_id) or UserTaskStats(user_id=user_id)
+            if user_id in existing and all(getattr(stats, name) == counted[name] for name in STATS_COUNTERS):
+                continue
+            for name in STATS_COUNTERS:
+                setattr(stats, name, counted[name])
+            (changed if user_id in existing else created).append(stats)
+        UserTaskStats.objects.bulk_update(changed, STATS_COUNTERS)
+        if created:
+            users = set(User.objects.filter(pk__in=[stats.user_id for stats in created]).values_list("id", flat=True))
+            UserTaskStats.objects.bulk_create([stats for stats in created if stats.user_id in users], ignore_conflicts=True)
+    return sorted(stats.user_id for stats in changed + created)
+
+
+def task_users(tasks):
+    # task id -> user id, looking up the user only where it was deferred
+    users = {task.pk: task.user_id for task in tasks if "user_id" not in task.get_deferred_fields()}
+    deferred = [task.pk for task in tasks if "user_id" in task.get_deferred_fields()]
+    if deferred:
+        users.update(Task.objects.filter(pk__in=deferred).values_list("id", "user_id"))
+    return users
+
+
+def record_status_changes(tasks, stored=None):
+    # only tasks that were never loaded need their stored status looked up
+    stored = stored_values(tasks, ["status"]) if stored is None else stored
+    history = []
+    for task in tasks:
+        old_status = stored.get(task.pk, {}).get("status")
+        if old_status is not None and old_status != task.status:
+            history.append(TaskHistory(task=task, old_status=old_status, new_status=task.status))
+    TaskHistory.objects.bulk_create(history)
+    metrics.incr("history_writes", len(history))
+
+
+def saved_fields(update_fields):
+    if update_fields is None:
+        return STATS_FIELDS
+    return {"user_id" if name == "user" else name for name in update_fields} & STATS_FIELDS
+
 
 @receiver(pre_save, sender=Task)
-def create_task_history(sender, instance, **kwargs):
-    try:
-        old_task = Task.objects.get(id=instance.id)
-        if old_task.status != instance.status:
-            print("Created history")
-            TaskHistory.objects.create(old_status=old_task.status, new_status=instance.status, task=instance).save()
-    except Exception as e:
-        print(e)        
-  
+def create_task_history(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._stored_counted = {}
+    if raw or instance.pk is None:
+        return
+    fields = saved_fields(update_fields)
+    if not fields:
+        return
+    # kept for touch_saved_task, which adjusts UserTaskStats by the difference
+    instance._stored_counted = stored_values([instance], STATS_FIELDS, lock=True).get(instance.pk, {})
+    if "status" in fields:
+        record_status_changes([instance], {instance.pk: instance._stored_counted})
+
+
+@receiver(post_save, sender=Task)
+def touch_saved_task(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    previous_user_id = instance._loaded_values.get("user_id", instance.user_id)
+    touch_task_lists([instance.user_id, previous_user_id])
+    fields = saved_fields(update_fields)
+    if fields:
+        stored = {} if created else getattr(instance, "_stored_counted", {})
+        deltas = {}
+        count_task(deltas, stored, -1)
+        count_task(deltas, {**stored, **counted_values(instance, fields)}, 1)
+        update_task_stats(deltas)
+    changes = [(instance.user_id, events.task_event(instance, created=created, fields=update_fields))]
+    if previous_user_id != instance.user_id:
+        changes.append((previous_user_id, {"kind": events.DELETED, "id": instance.pk}))
+    record_changes(changes)
+
+
+@receiver(post_delete, sender=Task)
+def touch_deleted_task(sender, instance, **kwargs):
+    touch_task_lists([instance.user_id])
+    deltas = {}
+    count_task(deltas, counted_values(instance), -1)
+    update_task_stats(deltas)
+    record_changes([(instance.user_id, {"kind": events.DELETED, "id": instance.pk})])
+
 
+@receiver(post_save, sender=User)
+def create_task_stats(sender, instance, created=False, raw=False, **kwargs):
+    # so the first task writes of a new user have a row to adjust
+    if created and not raw:
+        UserTaskStats.objects.get_or_create(user=instance)
@@ -0,0 +1,82 @@
+from django.db.models import Exists, F, Min, OuterRef
+
+from tasks import events
+from tasks.metrics import metrics
+from tasks.models import Task, record_changes
+
+
+def pending_tasks(user):
+    return Task.objects.filter(deleted=False, completed=False, user=user)
+
+
+def shift_priorities(user, priority_new):
+    """
+    Make room for a pending task at `priority_new` by moving the contiguous
+    run of priorities starting there down by one, in a single UPDATE.
+    Returns the number of shifted tasks.
+    """
+    tasks = pending_tasks(user)
+    if not tasks.filter(priority=priority_new).exists():
+        metrics.observe("priority_shift_size", 0)
+        return 0
+
+    # the run ends at the first occupied priority whose successor is free
+    successor = tasks.filter(priority=OuterRef("priority") + 1)
+    run_end = (
+        tasks.filter(priority__gte=priority_new)
+        .filter(~Exists(successor))
+        .aggregate(end=Min("priority"))["end"]
+    )
+    shifted = tasks.filter(priority__gte=priority_new, priority__lte=run_end).update(
+        priority=F("priority") + 1
+    )
+    metrics.observe("priority_shift_size", shifted)
+    # clients apply the UPDATE themselves rather than receive every moved
+    # task, to their pending tasks only, as `pending_tasks` does
+    record_changes([(user.pk, {
+        "kind": events.SHIFTED, "field": "priority", "from": priority_new, "to": run_end, "by": 1,
+        "completed": False,
+    })])
+    return shifted
+
+
+def make_room(user, tasks, others=()):
+    """
+    Bulk counterpart of shift_priorities: place `tasks` (new ones, or existing
+    ones moving to a new priority) one after another with the same collision
+    rules, then write every shifted task with one bulk_update. The placed tasks,
+    and `others`, tasks of the same request that keep their priority, are only
+    adjusted in memory. Returns the shifted tasks that were not passed in.
+    """
+    if not tasks:
+        return []
+    lowest = min(task.priority for task in tasks)
+    # in memory already, with the request's changes
+    passed = [task.pk for task in [*tasks, *others] if task.pk is not None]
+    existing = list(
+        pending_tasks(user)
+        .filter(priority__gte=lowest)
+        .exclude(pk__in=passed)
+        .only("id", "priority", "user")
+    )
+    occupied = {}
+    staying = [task for task in others if not task.completed and not task.deleted and task.priority >= lowest]
+    for task in [*existing, *staying]:
+        occupied.setdefault(task.priority, []).append(task)
+
+    for task in tasks:
+        if task.priority in occupied:
+            run_end = task.priority
+            while run_end + 1 in occupied:
+                run_end += 1
+            for priority in range(run_end, task.priority - 1, -1):
+                for other in occupied[priority]:
+                    other.priority += 1
+                occupied[priority + 1] = occupied.pop(priority)
+        if not task.completed and not task.deleted:
+            occupied.setdefault(task.priority, []).append(task)
+
+    shifted = [task for task in existing if task.priority != task._loaded_values["priority"]]
+    Task.objects.bulk_update(shifted, ["priority"])
+    metrics.observe("priority_shift_size", len(shifted))
+    return shifted
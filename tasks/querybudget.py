@@ -0,0 +1,172 @@
+"""
+Records the SQL sent during a request or Celery task, flags repeated query
+shapes (the signature of an N+1) and enforces the `query_budget` declared on
+views and tasks. Violations are logged, or raised with QUERY_BUDGET_STRICT.
+"""
+import logging
+import re
+import time
+from contextvars import ContextVar
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+from tasks.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# set by background work that shares a connection (and thread) with requests
+# but is not part of any, e.g. the long-poll version watcher
+unrecorded = ContextVar("unrecorded", default=False)
+
+IN_LIST = re.compile(r"IN \((%s(, )?)+\)")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_shape(sql):
+    # parameters are already placeholders, only IN lists vary in length
+    return IN_LIST.sub("IN (...)", sql)
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if unrecorded.get():
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    @contextmanager
+    def record(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.queries)
+
+    def repeated(self, threshold=None):
+        threshold = threshold or getattr(settings, "QUERY_REPEAT_THRESHOLD", 5)
+        shapes = Counter(query_shape(sql) for sql, _ in self.queries)
+        return {shape: seen for shape, seen in shapes.items() if seen >= threshold}
+
+    def problems(self, budget=None):
+        problems = []
+        if budget is not None and self.count > budget:
+            problems.append(f"{self.count} queries, budget is {budget}")
+        for shape, seen in self.repeated().items():
+            problems.append(f"same query {seen} times (N+1?): {shape}")
+        return problems
+
+
+def report(name, recorder, budget=None):
+    problems = recorder.problems(budget)
+    if not problems:
+        return
+    metrics.incr("query_budget_violations", view=name)
+    message = f"{name}: " + "; ".join(problems)
+    if getattr(settings, "QUERY_BUDGET_STRICT", False):
+        raise QueryBudgetExceeded(message)
+    logger.warning(message, extra={"queries": recorder.count, "budget": budget})
+
+
+@contextmanager
+def query_budget(budget=None, name="block"):
+    """
+    Test helper: fails when the wrapped block exceeds `budget` queries or
+    repeats a query shape, whatever QUERY_BUDGET_STRICT says.
+    """
+    recorder = QueryRecorder()
+    with recorder.record():
+        yield recorder
+    problems = recorder.problems(budget)
+    if problems:
+        raise QueryBudgetExceeded(f"{name}: " + "; ".join(problems))
+
+
+def view_budget(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return None, None
+    func = match.func
+    view = getattr(func, "view_class", None) or getattr(func, "cls", None) or func
+    budget = getattr(view, "query_budget", None)
+    # viewsets may declare one budget per action
+    if isinstance(budget, dict):
+        action = (getattr(func, "actions", None) or {}).get(request.method.lower())
+        budget = budget.get(action)
+    return match.view_name or match.route, budget
+
+
+class QueryBudgetMiddleware(MiddlewareMixin):
+    # hooks rather than __call__, so under ASGI they run in the request's own
+    # thread, which is also where its sync_to_async() queries run
+    def process_request(self, request):
+        request.query_recorder = QueryRecorder()
+        request.query_recording = ExitStack()
+        request.query_recording.enter_context(request.query_recorder.record())
+        request.render_timing = None
+        request.query_budget_started = time.perf_counter()
+
+    def process_response(self, request, response):
+        request.query_recording.close()
+        recorder = request.query_recorder
+        total = time.perf_counter() - request.query_budget_started
+
+        timings = [f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries"']
+        if request.render_timing is not None:
+            label, duration = request.render_timing
+            timings.append(f'{label};dur={duration * 1000:.1f}')
+        timings.append(f"total;dur={total * 1000:.1f}")
+        response["Server-Timing"] = ", ".join(timings)
+
+        name, budget = view_budget(request)
+        report(name or request.path, recorder, budget)
+        return response
+
+    def process_template_response(self, request, response):
+        # runs right before the response is rendered, the callback right after
+        label = "serialize" if hasattr(response, "accepted_renderer") else "template"
+        start = time.perf_counter()
+
+        def rendered(response):
+            request.render_timing = (label, time.perf_counter() - start)
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+running_tasks = {}
+
+
+def task_started(task_id=None, task=None, **kwargs):
+    recorder = QueryRecorder()
+    stack = ExitStack()
+    stack.enter_context(recorder.record())
+    running_tasks[task_id] = (recorder, stack)
+
+
+def task_finished(task_id=None, task=None, **kwargs):
+    recorder, stack = running_tasks.pop(task_id, (None, None))
+    if recorder is None:
+        return
+    stack.close()
+    metrics.observe("celery_db_seconds", recorder.duration, task=task.name)
+    report(task.name, recorder, getattr(task, "query_budget", None))
@@ -0,0 +1,95 @@
+"""
+Reads go to the read replicas in settings.DATABASE_REPLICAS, writes to the
+primary.
+
+Only reads of this app's tables made while serving a safe (GET/HEAD/OPTIONS)
+request are sent to a replica, and only outside transactions. Everything
+else stays on the primary: sessions and users, so a login never races the
+replication, unsafe requests, which read what they are about to change,
+Celery tasks, which mostly write, and management commands. Report
+generation asks for a replica explicitly, see `replica()`.
+
+Each request picks its replica once, so everything it reads, the list
+version included, comes from the same point in the replication stream.
+
+A request that writes tasks leaves a cookie pinning that browser to the
+primary for REPLICA_PIN_SECONDS, so the list it is redirected to already
+shows the change however far the replicas lag behind.
+"""
+import random
+from contextvars import ContextVar
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.deprecation import MiddlewareMixin
+
+PIN_COOKIE = "primary_pin"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# the current request's routing state, None outside requests
+routing = ContextVar("routing", default=None)
+
+
+def replica():
+    replicas = settings.DATABASE_REPLICAS
+    return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = routing.get()
+        if state is None or state.pinned or model._meta.app_label != "tasks":
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = routing.get()
+        if state is not None and model._meta.app_label == "tasks":
+            state.pinned = state.wrote = True
+        # explicitly, or Django writes an instance back where it was read from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+def reset(token):
+    try:
+        routing.reset(token)
+    except ValueError:
+        # under ASGI the response can be sent from another context
+        routing.set(None)
+
+
+def reset_after(content, token):
+    try:
+        yield from content
+    finally:
+        reset(token)
+
+
+class ReplicaPinMiddleware(MiddlewareMixin):
+    def process_request(self, request):
+        pinned = request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES
+        request.replica_routing = SimpleNamespace(pinned=pinned, wrote=False, replica=replica())
+        request.replica_token = routing.set(request.replica_routing)
+
+    def process_response(self, request, response):
+        state = getattr(request, "replica_routing", None)
+        if state is None:
+            return response
+        if response.streaming:
+            # a streamed export reads its rows after this, as it is sent
+            response.streaming_content = reset_after(response.streaming_content, request.replica_token)
+        else:
+            reset(request.replica_token)
+        if state.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE, "1", max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite="Lax")
+        return response
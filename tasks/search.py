@@ -0,0 +1,112 @@
+"""
+Full-text search over task titles and descriptions, best matches first.
+
+PostgreSQL matches against a GIN index on the tsvector of both fields.
+SQLite matches against an FTS5 table that triggers on tasks_task keep up to
+date, so every write path (save, update(), the bulk methods) is covered.
+SQLite drops a table's triggers when a migration rebuilds it, so
+`install_search_index` runs again after every migrate.
+"""
+import re
+
+from django.db import connection
+
+SEARCH_CONFIG = "english"
+SEARCH_INDEX = "task_search_idx"
+FTS_TABLE = "tasks_task_fts"
+
+SQLITE_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON tasks_task BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON tasks_task BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF title, description ON tasks_task BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+
+def search_vector():
+    from django.contrib.postgres.search import SearchVector
+
+    # the index and the queries must build the very same expression
+    return SearchVector("title", "description", config=SEARCH_CONFIG)
+
+
+def search_index():
+    from django.contrib.postgres.indexes import GinIndex
+
+    return GinIndex(search_vector(), name=SEARCH_INDEX)
+
+
+def install_search_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE '{FTS_TABLE}_%'")
+            if cursor.fetchone()[0] == len(SQLITE_TRIGGERS):
+                return
+        # an external content table: the text stays in tasks_task only
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"title, description, content='tasks_task', content_rowid='id', tokenize='porter unicode61')"
+        )
+        for trigger in SQLITE_TRIGGERS:
+            schema_editor.execute(trigger)
+        # writes made while the triggers were missing
+        schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    elif vendor == "postgresql":
+        from tasks.models import Task
+
+        with schema_editor.connection.cursor() as cursor:
+            indexes = schema_editor.connection.introspection.get_constraints(cursor, Task._meta.db_table)
+        if SEARCH_INDEX not in indexes:
+            schema_editor.add_index(Task, search_index())
+
+
+def remove_search_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        for name in ("insert", "delete", "update"):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{name}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif vendor == "postgresql":
+        from tasks.models import Task
+
+        schema_editor.remove_index(Task, search_index())
+
+
+def fts_query(text):
+    # every word as a quoted prefix term, user input never reaches FTS5 syntax
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+
+def search_tasks(queryset, text):
+    """`queryset` narrowed to tasks matching `text`, annotated with `rank` and ordered by it."""
+    if connection.vendor == "postgresql":
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        return (
+            queryset.alias(search=search_vector()).filter(search=query)
+            .annotate(rank=SearchRank(search_vector(), query))
+            .order_by("-rank", "id")
+        )
+
+    match = fts_query(text)
+    if not match:
+        return queryset.none()
+    table = queryset.model._meta.db_table
+    # a join, so SQLite walks the FTS matches and looks the tasks up by id;
+    # bm25() is only defined there and is lower for better matches
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[f"{FTS_TABLE}.rowid = {table}.id", f"{FTS_TABLE} MATCH %s"],
+        params=[match],
+        select={"rank": f"-bm25({FTS_TABLE})"},
+    ).order_by("-rank", "id")
@@ -0,0 +1,154 @@
+"""
+GET /api/task/events/: the signed-in user's task changes (see tasks.events)
+as server-sent events. Browsers send Last-Event-ID when they reconnect and
+get what they missed replayed; `event: resync` means it is no longer
+buffered and the list has to be fetched again. A stream lasts ?timeout=
+seconds (STREAM_TIMEOUT at most), then the client reconnects.
+
+Under ASGI, task_manager/asgi.py routes the path to `events_application`,
+which holds no thread while idle; the Django view is the blocking fallback
+for WSGI and runserver.
+"""
+import asyncio
+import time
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.db import close_old_connections, connection
+from django.http import JsonResponse, StreamingHttpResponse
+from django.http.cookie import parse_cookie
+
+from tasks.events import get_broker
+from tasks.metrics import metrics
+
+EVENTS_PATH = "/api/task/events/"
+STREAM_TIMEOUT = 300
+HEARTBEAT = 15
+RETRY_MS = 3000
+
+
+def stream_timeout(value):
+    try:
+        return max(0.0, min(float(value), STREAM_TIMEOUT))
+    except (TypeError, ValueError):
+        return STREAM_TIMEOUT
+
+
+def stream_start(broker, user_id, last_id):
+    # without an id the client has just loaded the list: start from now
+    if last_id:
+        return f"retry: {RETRY_MS}\n\n", last_id
+    last_id = broker.latest_id(user_id)
+    return f"retry: {RETRY_MS}\nid: {last_id}\n\n", last_id
+
+
+def stream_frames(broker, user_id, last_id, entries, complete):
+    """SSE frames for one wait() result, and the id to continue from."""
+    if not complete:
+        last_id = broker.latest_id(user_id)
+        return f"id: {last_id}\nevent: resync\ndata: {{}}\n\n", last_id
+    if not entries:
+        return ": keepalive\n\n", last_id
+    frames = "".join(f"id: {id}\nevent: task\ndata: {data}\n\n" for id, data in entries)
+    return frames, entries[-1][0]
+
+
+def event_stream(user_id, last_id, timeout):
+    broker = get_broker()
+    deadline = time.monotonic() + timeout
+    frames, last_id = stream_start(broker, user_id, last_id)
+    yield frames
+    while True:
+        remaining = max(0, min(deadline - time.monotonic(), HEARTBEAT))
+        frames, last_id = stream_frames(broker, user_id, last_id, *broker.wait(user_id, last_id, remaining))
+        yield frames
+        if time.monotonic() >= deadline:
+            return
+
+
+async def async_event_stream(user_id, last_id, timeout):
+    broker = get_broker()
+    deadline = time.monotonic() + timeout
+    frames, last_id = await sync_to_async(stream_start, thread_sensitive=False)(broker, user_id, last_id)
+    yield frames
+    while True:
+        remaining = max(0, min(deadline - time.monotonic(), HEARTBEAT))
+        entries, complete = await broker.async_wait(user_id, last_id, remaining)
+        if complete:
+            frames, last_id = stream_frames(broker, user_id, last_id, entries, complete)
+        else:
+            frames, last_id = await sync_to_async(stream_frames, thread_sensitive=False)(
+                broker, user_id, last_id, entries, complete)
+        yield frames
+        if time.monotonic() >= deadline:
+            return
+
+
+def task_events(request):
+    if not request.user.is_authenticated:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=403)
+    last_id = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
+    stream = event_stream(request.user.pk, last_id, stream_timeout(request.GET.get("timeout", STREAM_TIMEOUT)))
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    metrics.incr("event_streams", transport="wsgi")
+    return response
+
+
+def session_user_id(cookie_header):
+    # what AuthenticationMiddleware would do, for a request that bypasses Django
+    try:
+        session_key = parse_cookie(cookie_header).get(settings.SESSION_COOKIE_NAME)
+        if not session_key:
+            return None
+        session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        user = auth.get_user(SimpleNamespace(session=session))
+        return user.pk if user.is_authenticated else None
+    finally:
+        if not connection.in_atomic_block:
+            close_old_connections()
+
+
+async def events_application(scope, receive, send):
+    headers = {name.decode("latin1").lower(): value.decode("latin1") for name, value in scope["headers"]}
+    user_id = await sync_to_async(session_user_id)(headers.get("cookie", ""))
+    if user_id is None:
+        body = b'{"detail": "Authentication credentials were not provided."}'
+        await send({"type": "http.response.start", "status": 403,
+            "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    params = parse_qs(scope.get("query_string", b"").decode("latin1"))
+    last_id = headers.get("last-event-id") or params.get("last_event_id", [None])[0]
+    timeout = stream_timeout(params.get("timeout", [STREAM_TIMEOUT])[0])
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ]})
+    metrics.incr("event_streams", transport="asgi")
+
+    async def stream():
+        async for frames in async_event_stream(user_id, last_id, timeout):
+            await send({"type": "http.response.body", "body": frames.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    # whichever ends first: the stream's timeout or the client going away
+    done, pending = await asyncio.wait(
+        [asyncio.ensure_future(stream()), asyncio.ensure_future(disconnected())],
+        return_when=asyncio.FIRST_COMPLETED,
+    )
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
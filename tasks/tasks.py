@@ -1,53 +1,438 @@
-from datetime import datetime, time
-from django.core.mail import send_mail
-from tasks.models import Task, Report
+import logging
+import os
 from datetime import datetime, timedelta, timezone
+from math import ceil
+from time import monotonic, sleep
+
+from celery import group
+from django.conf import settings
+from django.core.cache import caches
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+
+from tasks.exports import write_export
+from tasks.metrics import metrics
+from tasks.routers import replica
+from tasks.models import (
+    ArchivedTask, ArchivedTaskHistory, OutboundEmail, Report, STATUS_STATS, Task, TaskChange, TaskHistory,
+    TaskListVersion, task_stats,
+)
 from task_manager.celery import app
-from django.db import transaction
 
-@app.task
-def send_email_report(report):
-    user = report.user
-    valid_user_tasks = Task.objects.filter(user=user, deleted=False)
-    pending_tasks = valid_user_tasks.filter(status="PENDING").count()
-    in_progress_tasks = valid_user_tasks.filter(status="IN_PROGRESS").count()
-    completed_tasks = valid_user_tasks.filter(status="COMPLETED").count() 
-    cancelled_tasks = valid_user_tasks.filter(status="CANCELLED").count()
-    email_content = f"""
+logger = logging.getLogger(__name__)
+
+REPORT_SENDER = "taskmanager@gdc.com"
+# reports handled by one send_report_batch subtask
+REPORT_CHUNK_SIZE = 500
+# how long the delta sync API can answer an old token, and rows deleted per statement
+SYNC_RETENTION = timedelta(days=30)
+COMPACTION_BATCH_SIZE = 1000
+
+
+def status_counts(user_ids):
+    # reports can be a replication lag behind
+    return {
+        user_id: {status: stats[field] for status, field in STATUS_STATS.items()}
+        for user_id, stats in task_stats(user_ids, using=replica()).items()
+    }
+
+
+def report_content(user, counts):
+    return f"""
         Hi {user.username},
         \n\nYour tasks report: \n
-        Pending tasks =   {pending_tasks} \n
-        In-progress tasks = {in_progress_tasks} \n
-        Completed tasks = {completed_tasks} \n
-        Cancelled tasks = {cancelled_tasks} 
+        Pending tasks =   {counts["PENDING"]} \n
+        In-progress tasks = {counts["IN_PROGRESS"]} \n
+        Completed tasks = {counts["COMPLETED"]} \n
+        Cancelled tasks = {counts["CANCELLED"]} 
         
         \n\nRegards,\nYour Wonderful Task Manager App
     """
 
-    
-    send_mail("Tasks Report", email_content, "taskmanager@gdc.com", user.email )
+
+def queue_emails(emails):
+    """
+    Queue (subject, body, recipients) emails from REPORT_SENDER. They are
+    sent by drain_outbound_email, which is started when the transaction
+    commits, so a rollback sends nothing and a failing mail server fails
+    nothing here.
+    """
+    queued = OutboundEmail.objects.bulk_create(
+        OutboundEmail(subject=subject, body=body, sender=REPORT_SENDER, recipients=list(recipients))
+        for subject, body, recipients in emails
+        if any(recipients)
+    )
+    if queued:
+        metrics.incr("emails_queued", len(queued))
+        transaction.on_commit(drain_outbound_email.delay)
+    return len(queued)
+
+
+@app.task(query_budget=3)
+def send_email_report(report):
+    user = report.user
+    email_content = report_content(user, status_counts([user.id])[user.id])
+    queue_emails([("Tasks Report", email_content, [user.email])])
     return email_content
-    
+
+
+def due_report_ids(now):
+    # an index range scan over next_run_at, so a tick only reads what is due
+    return list(
+        Report.objects.filter(next_run_at__lte=now)
+        .order_by("next_run_at")
+        .values_list("id", flat=True)
+    )
+
+
+@app.task(query_budget=6)
+def send_report_batch(report_ids):
+    with metrics.timer("report_batch_seconds"):
+        queued = deliver_report_batch(report_ids)
+    metrics.incr("report_emails_queued", queued)
+    logger.info("report batch queued", extra={"reports": len(report_ids), "queued": queued})
+    return queued
+
+
+def deliver_report_batch(report_ids):
+    now = datetime.now(timezone.utc)
+    # claim the chunk, reschedule it and queue its mail in one short
+    # transaction; rows another worker holds are skipped
+    with transaction.atomic():
+        reports = list(
+            Report.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("user")
+            .filter(id__in=report_ids, next_run_at__lte=now)
+        )
+        for r in reports:
+            r.last_updated = now
+            r.schedule(now)
+        Report.objects.bulk_update(reports, ["last_updated", "next_run_at"])
+        counts = status_counts([r.user_id for r in reports])
+        return queue_emails(
+            ("Tasks Report", report_content(r.user, counts[r.user_id]), [r.user.email]) for r in reports
+        )
 
 
 @app.task
 def periodic_emailer():
-    currentTime = datetime.now()
-    start = currentTime(timezone.utc) - timedelta(days=1)
+    report_ids = due_report_ids(datetime.now(timezone.utc))
+    chunks = [report_ids[i:i + REPORT_CHUNK_SIZE] for i in range(0, len(report_ids), REPORT_CHUNK_SIZE)]
+    if chunks:
+        group(send_report_batch.s(chunk) for chunk in chunks).apply_async()
+    return len(report_ids)
+
+
+class RateLimiter:
+    """
+    Spaces out calls to at most `rate` a second across every process sharing
+    the THROTTLE_CACHE: time is cut into 1/rate second slots, and each call
+    takes a free one with cache.add(), atomic in Redis as in memory.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def wait(self, rate):
+        if not rate:
+            return
+        cache = caches[THROTTLE_CACHE]
+        interval = 1 / rate
+        while True:
+            now = datetime.now(timezone.utc).timestamp()
+            slot = int(now / interval)
+            if cache.add(f"{self.name}:{slot}", 1, timeout=ceil(2 * interval)):
+                return
+            sleep((slot + 1) * interval - now)
+
+
+THROTTLE_CACHE = "throttle"
+DRAIN_LOCK = "drain_outbound_email"
+email_rate = RateLimiter("email_rate")
+
+
+def claim_emails(now, batch_size):
     with transaction.atomic():
-        reports = Report.objects.select_for_update().filter(
-            last_updated__lt=start,
-            confirmation=True
+        emails = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboundEmail.QUEUED, next_attempt_at__lte=now)
+            .order_by("next_attempt_at", "id")[:batch_size]
         )
-        for r in reports:
-            send_email_report(r)
-            r.last_updated = datetime.now(timezone.utc).replace(hour=r.time.hour, minute=r.time.minute,
-                second=r.time.second)
-            r.save()
+        # leased: other drains skip them, and a crashed one's are retried once it runs out
+        OutboundEmail.objects.filter(id__in=[email.id for email in emails]).update(
+            next_attempt_at=now + timedelta(seconds=settings.EMAIL_LEASE_SECONDS))
+    return emails
+
+
+def send_emails(emails):
+    """Sends over one connection; returns the ids sent and the (email, error) pairs that failed."""
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        return [], [(email, error) for email in emails]
+    sent, failed = [], []
+    try:
+        for email in emails:
+            email_rate.wait(settings.EMAIL_RATE_LIMIT)
+            message = EmailMessage(email.subject, email.body, email.sender, email.recipients, connection=connection)
+            try:
+                message.send()
+            except Exception as error:
+                failed.append((email, error))
+            else:
+                sent.append(email.id)
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def retry_emails(failed, now):
+    """Backs the failed emails off, or gives up on them; returns how many were given up."""
+    given_up = 0
+    for email, error in failed:
+        email.attempts += 1
+        email.last_error = f"{type(error).__name__}: {error}"
+        if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+            email.status = OutboundEmail.FAILED
+            given_up += 1
+        else:
+            delay = min(settings.EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1), settings.EMAIL_RETRY_MAX_DELAY)
+            email.next_attempt_at = now + timedelta(seconds=delay)
+    OutboundEmail.objects.bulk_update([email for email, _ in failed],
+        ["attempts", "last_error", "status", "next_attempt_at"])
+    return given_up
+
+
+@app.task
+def drain_outbound_email():
+    """
+    Sends the queued emails that are due, EMAIL_BATCH_SIZE at a time over one
+    connection each, and queues a new run for the rest after
+    EMAIL_RUN_SECONDS. Started whenever emails are queued, and every minute
+    for the retries. Returns None, sending nothing, while another drain runs.
+    """
+    # one at a time; a crashed drain's lock runs out with its emails' lease
+    lock = caches[THROTTLE_CACHE]
+    if not lock.add(DRAIN_LOCK, 1, timeout=settings.EMAIL_LEASE_SECONDS):
+        metrics.incr("email_drains_skipped")
+        return None
+    try:
+        totals = drain_emails()
+    finally:
+        lock.delete(DRAIN_LOCK)
+    if totals["continued"]:
+        # only once the lock is free, or it finds it taken
+        drain_outbound_email.delay()
+    return totals
+
+
+def drain_emails():
+    deadline = monotonic() + settings.EMAIL_RUN_SECONDS
+    totals = {"sent": 0, "retried": 0, "failed": 0, "continued": False}
+    while True:
+        now = datetime.now(timezone.utc)
+        emails = claim_emails(now, settings.EMAIL_BATCH_SIZE)
+        if not emails:
+            break
+        with metrics.timer("email_batch_seconds"):
+            sent, failed = send_emails(emails)
+        OutboundEmail.objects.filter(id__in=sent).delete()
+        given_up = retry_emails(failed, now) if failed else 0
+        sent_ids = set(sent)
+        for email in emails:
+            if email.id in sent_ids:
+                metrics.observe("email_queue_seconds", (now - email.created_at).total_seconds())
+        totals["sent"] += len(sent)
+        totals["retried"] += len(failed) - given_up
+        totals["failed"] += given_up
+        if len(emails) < settings.EMAIL_BATCH_SIZE:
+            break
+        if monotonic() >= deadline:
+            totals["continued"] = True
+            break
+    metrics.incr("emails_sent", totals["sent"])
+    metrics.incr("emails_retried", totals["retried"])
+    metrics.incr("emails_failed", totals["failed"])
+    if totals["sent"] or totals["retried"] or totals["failed"]:
+        logger.info("outbound email drained", extra=totals)
+    return totals
+
+
+def superseded_changes():
+    # a client syncing from before either entry only needs the newer one
+    newer = TaskChange.objects.filter(user_id=OuterRef("user_id"), task_id=OuterRef("task_id"), id__gt=OuterRef("id"))
+    return TaskChange.objects.filter(task_id__isnull=False).filter(Exists(newer))
+
+
+@app.task
+def compact_task_changes(now=None):
+    now = now or datetime.now(timezone.utc)
+    compacted = pruned = 0
+    while True:
+        ids = list(superseded_changes().order_by("id").values_list("id", flat=True)[:COMPACTION_BATCH_SIZE])
+        if not ids:
+            break
+        compacted += TaskChange.objects.filter(id__in=ids).delete()[0]
+
+    cutoff = now - SYNC_RETENTION
+    while True:
+        expired = list(
+            TaskChange.objects.filter(created_at__lt=cutoff)
+            .order_by("id").values_list("id", "user_id")[:COMPACTION_BATCH_SIZE]
+        )
+        if not expired:
+            break
+        horizons = {}
+        for id, user_id in expired:
+            horizons[user_id] = max(horizons.get(user_id, 0), id)
+        with transaction.atomic():
+            # tokens below the horizon get a full sync instead of a delta
+            # that would miss the pruned entries
+            versions = list(TaskListVersion.objects.select_for_update().filter(user_id__in=horizons).order_by("user_id"))
+            for version in versions:
+                version.sync_horizon = max(version.sync_horizon, horizons[version.user_id])
+            TaskListVersion.objects.bulk_update(versions, ["sync_horizon"])
+            pruned += TaskChange.objects.filter(id__in=[id for id, _ in expired]).delete()[0]
+
+    metrics.incr("task_changes_compacted", compacted)
+    metrics.incr("task_changes_pruned", pruned)
+    return compacted, pruned
+
+
+def archive_deleted_tasks(cutoff, now, batch_size):
+    """Move one batch of tasks soft-deleted before `cutoff`, with their history."""
+    with transaction.atomic():
+        tasks = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(deleted=True, deleted_at__lt=cutoff)
+            .order_by("deleted_at", "id")[:batch_size]
+        )
+        if not tasks:
+            return 0, 0
+        ids = [task.id for task in tasks]
+        history = list(TaskHistory.objects.filter(task_id__in=ids))
+        ArchivedTask.objects.bulk_create(
+            ArchivedTask(archived_at=now, **{field.attname: getattr(task, field.attname)
+                for field in Task._meta.concrete_fields})
+            for task in tasks
+        )
+        ArchivedTaskHistory.objects.bulk_create(archived_history(history, now))
+        TaskHistory.objects.filter(id__in=[entry.id for entry in history]).delete()
+        # the tasks left every list when they were soft-deleted: no signals,
+        # version bumps or change log entries for them now
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {connection.ops.quote_name(Task._meta.db_table)} WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                ids,
+            )
+    return len(tasks), len(history)
+
+
+def archive_old_history(cutoff, now, batch_size):
+    """Move one batch of history recorded before `cutoff`."""
+    with transaction.atomic():
+        # ids follow change_date, so walking the primary key finds the
+        # oldest rows first without an index on change_date
+        history = list(
+            TaskHistory.objects.select_for_update(skip_locked=True)
+            .filter(change_date__lt=cutoff)
+            .order_by("id")[:batch_size]
+        )
+        ArchivedTaskHistory.objects.bulk_create(archived_history(history, now))
+        TaskHistory.objects.filter(id__in=[entry.id for entry in history]).delete()
+    return len(history)
+
+
+def archived_history(history, now):
+    return [
+        ArchivedTaskHistory(id=entry.id, task_id=entry.task_id, old_status=entry.old_status,
+            new_status=entry.new_status, change_date=entry.change_date, archived_at=now)
+        for entry in history
+    ]
+
+
+@app.task
+def archive_cold_rows(now=None):
+    """
+    Moves soft-deleted tasks and old history into the archive tables. Every
+    batch commits on its own, so an interrupted run loses nothing and the
+    next one carries on; between batches it sleeps ARCHIVE_PAUSE, and after
+    ARCHIVE_RUN_SECONDS it queues a new run for the rest.
+    """
+    now = now or datetime.now(timezone.utc)
+    batch_size = settings.ARCHIVE_BATCH_SIZE
+    deadline = monotonic() + settings.ARCHIVE_RUN_SECONDS
+    moved = {"tasks": 0, "history": 0, "continued": False}
+
+    def deleted_tasks():
+        tasks, history = archive_deleted_tasks(now - timedelta(days=settings.ARCHIVE_DELETED_AFTER_DAYS), now, batch_size)
+        moved["tasks"] += tasks
+        moved["history"] += history
+        return tasks
+
+    def old_history():
+        history = archive_old_history(now - timedelta(days=settings.ARCHIVE_HISTORY_AFTER_DAYS), now, batch_size)
+        moved["history"] += history
+        return history
+
+    for step in (deleted_tasks, old_history):
+        while step() == batch_size:
+            if monotonic() >= deadline:
+                moved["continued"] = True
+                break
+            sleep(settings.ARCHIVE_PAUSE)
+        if moved["continued"]:
+            archive_cold_rows.apply_async(countdown=settings.ARCHIVE_PAUSE)
+            break
+    metrics.incr("archived_tasks", moved["tasks"])
+    metrics.incr("archived_history", moved["history"])
+    logger.info("archived cold rows", extra=moved)
+    return moved
+
+
+@app.task(query_budget=3)
+def export_to_file(user_id, kind, fmt, gzip, filename):
+    os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+    size = write_export(user_id, kind, fmt, gzip, os.path.join(settings.EXPORT_ROOT, filename))
+    metrics.incr("exports", kind=kind, format=fmt, gzip=gzip, mode="file")
+    logger.info("exported tasks", extra={"user": user_id, "file": filename, "bytes": size})
+    return filename
+
+
+@app.task
+def remove_old_exports():
+    # download links stop working after EXPORT_LINK_MAX_AGE, the files can go then
+    if not os.path.isdir(settings.EXPORT_ROOT):
+        return 0
+    cutoff = datetime.now().timestamp() - settings.EXPORT_LINK_MAX_AGE
+    removed = 0
+    for entry in os.scandir(settings.EXPORT_ROOT):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+            removed += 1
+    return removed
 
 
 app.conf.beat_schedule={"send-task-report" : {
     'task': 'tasks.tasks.periodic_emailer',
     'schedule': 60.0,
 },
+"compact-task-changes": {
+    'task': 'tasks.tasks.compact_task_changes',
+    'schedule': 3600.0,
+},
+"archive-cold-rows": {
+    'task': 'tasks.tasks.archive_cold_rows',
+    'schedule': 86400.0,
+},
+"drain-outbound-email": {
+    'task': 'tasks.tasks.drain_outbound_email',
+    'schedule': 60.0,
+},
+"remove-old-exports": {
+    'task': 'tasks.tasks.remove_old_exports',
+    'schedule': 3600.0,
+},
 }
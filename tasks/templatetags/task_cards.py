@@ -0,0 +1,45 @@
+"""
+{% task_cards tasks %} renders the cards of a task list, each from
+task_card.html once and then from the "fragments" cache. A card's key holds
+everything the card shows, so a task changed through save() or update()
+simply gets a new key and its old card ages out. The whole list is one
+get_many and at most one set_many, not a cache round trip per card.
+"""
+from django import template
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from tasks.metrics import metrics
+
+FRAGMENT_CACHE = "fragments"
+# part of every key: bump it when task_card.html changes
+CARD_VERSION = 3
+
+register = template.Library()
+
+
+def card_key(task, struck):
+    return make_template_fragment_key("task_card", [CARD_VERSION, task.id, task.created_date, task.title, struck])
+
+
+@register.simple_tag
+def task_cards(tasks, struck=False):
+    if not tasks:
+        return ""
+    keys = {card_key(task, struck): task for task in tasks}
+    cache = caches[FRAGMENT_CACHE]
+    cards = cache.get_many(list(keys))
+    missing = {}
+    if len(cards) < len(keys):
+        card = get_template("task_card.html")
+        missing = {
+            key: card.render({"task": task, "struck": struck})
+            for key, task in keys.items() if key not in cards
+        }
+        cache.set_many(missing)
+        cards.update(missing)
+    metrics.incr("task_card_cache_hits", len(keys) - len(missing))
+    metrics.incr("task_card_cache_misses", len(missing))
+    return mark_safe("".join(cards[key] for key in keys))
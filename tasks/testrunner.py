@@ -0,0 +1,22 @@
+import logging
+import os
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+# stand-ins for read replicas, for the router tests, which switch them on
+# with DATABASE_REPLICAS
+TEST_REPLICAS = ("replica1", "replica2")
+
+
+class TestRunner(DiscoverRunner):
+    """Sets up what only the tests need, so the settings stay as deployed."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        for alias in TEST_REPLICAS:
+            # the connection handler reads this same dict
+            settings.DATABASES.setdefault(alias, {**settings.DATABASES["default"], "TEST": {"MIRROR": "default"}})
+        if "LOG_LEVEL" not in os.environ:
+            # request logs would drown the test output
+            logging.getLogger("tasks").setLevel(logging.WARNING)
@@ -1,11 +1,48 @@
-from datetime import datetime, timedelta
-from django.test import TestCase, RequestFactory
+from datetime import datetime, timedelta, timezone
+from django.test import TestCase, TransactionTestCase, RequestFactory
 from django.contrib.auth.models import User, AnonymousUser
 from tasks.views import *
 from tasks.apiviews import *
 from tasks.models import *
 from tasks.tasks import *
+from tasks.dashboard import *
+from tasks.priorities import shift_priorities
 from django.http.response import Http404
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Value
+import base64
+import csv
+import gzip
+import io
+import re
+import sqlite3
+import json
+import os
+import tempfile
+import time as time_module
+from django.core.management import call_command
+from django.core.cache import caches
+from tasks.cache import TASK_LIST_CACHE, CountingLocMemCache, stats as cache_stats
+from tasks.querybudget import QueryBudgetExceeded, query_budget
+from tasks.metrics import metrics, JsonFormatter, instance
+from tasks import metrics as metrics_module
+import logging
+import asyncio
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from tasks.asyncviews import watcher
+from tasks.querybudget import unrecorded
+from tasks.events import LocalBroker, get_broker
+from tasks.sse import events_application
+from tasks.exports import COLUMNS, SIGNING_SALT
+from django.core import signing
+from tasks.dbpool import ConnectionPool, PoolTimeout, close_pools
+from django.db.utils import ConnectionHandler
+from tasks.routers import PIN_COOKIE, routing
+from django.test import override_settings
 
 class AuthTests(TestCase):
     def test_authenticated(self):
@@ -195,7 +232,7 @@ class CRUD_tests(TestCase):
         self.assertEqual(response.status_code, 200)
         response_content = response.json()
         # print(response_content)
-        self.assertEqual(f"{self.user.username}", response_content[0]['user']['username']) 
+        self.assertEqual(f"{self.user.username}", response_content['results'][0]['user']['username']) 
 
 
 class Celery_tests(TestCase): 
@@ -240,4 +277,1362 @@ class Celery_tests(TestCase):
         
         \n\nRegards,\nYour Wonderful Task Manager App
     """
-        self.assertEqual(email_content, report) 
\ No newline at end of file
+        self.assertEqual(email_content, report) 
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="dashuser", password="test@123")
+        for i in range(1, 6):
+            Task.objects.create(priority=i, title=f"pending {i}", description="d", user=self.user)
+        for i in range(1, 4):
+            Task.objects.create(priority=i, title=f"done {i}", description="d", user=self.user, completed=True)
+        Task.objects.create(priority=1, title="gone", description="d", user=self.user, deleted=True)
+
+    def get(self, view, **params):
+        request = self.factory.get("/", params)
+        request.user = self.user
+        return view.as_view()(request).render()
+
+    def test_counts_single_query(self):
+        request = self.factory.get("/")
+        request.user = self.user
+        # the ETag version, one aggregate for the counters and one page query per section
+        with self.assertNumQueries(4):
+            response = GenericAllTasksView.as_view()(request)
+        self.assertEqual(response.context_data["completed_cnt"], 3)
+        self.assertEqual(response.context_data["total_cnt"], 8)
+        request = self.factory.get("/")
+        request.user = self.user
+        with self.assertNumQueries(3):
+            GenericPendingTasksView.as_view()(request)
+
+    def test_keyset_pages(self):
+        seen = []
+        cursor = None
+        while True:
+            dashboard = TaskDashboard(self.user, (PENDING, COMPLETED), cursor, page_size=3)
+            rows, cursor = dashboard.page()
+            seen += [task.title for task in rows[PENDING] + rows[COMPLETED]]
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f"pending {i}" for i in range(1, 6)] + [f"done {i}" for i in range(1, 4)])
+
+    def test_completed_view(self):
+        response = self.get(GenericCompletedTasksView)
+        self.assertEqual([t.title for t in response.context_data["tasks"]], ["done 1", "done 2", "done 3"])
+        self.assertEqual(response.context_data["completed"], [])
+        self.assertIsNone(response.context_data["next_cursor"])
+
+    def test_bad_cursor_restarts(self):
+        response = self.get(GenericPendingTasksView, cursor="completed.x.y")
+        self.assertEqual(len(response.context_data["tasks"]), 5)
+
+
+class PriorityTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="prio", password="testpass")
+        for priority in [1, 2, 3, 5, 6]:
+            Task.objects.create(priority=priority, title=f"p{priority}", description="d", user=self.user)
+        Task.objects.create(priority=2, title="done", description="d", user=self.user, completed=True)
+
+    def priorities(self, **filters):
+        return list(Task.objects.filter(user=self.user, **filters).order_by("priority").values_list("title", "priority"))
+
+    def test_shift_contiguous_run_only(self):
+        # probe, run end, affected users, the UPDATE itself, the version bump and the change log
+        with self.assertNumQueries(6):
+            self.assertEqual(shift_priorities(self.user, 2), 2)
+        self.assertEqual(self.priorities(completed=False), [("p1", 1), ("p2", 3), ("p3", 4), ("p5", 5), ("p6", 6)])
+        self.assertEqual(self.priorities(completed=True), [("done", 2)])
+
+    def test_no_collision(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(shift_priorities(self.user, 4), 0)
+
+    def test_api_create_shifts(self):
+        self.client.login(username="prio", password="testpass")
+        response = self.client.post("/api/task/", {"title": "new", "description": "d", "priority": 5})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.priorities(completed=False)[-3:], [("new", 5), ("p5", 6), ("p6", 7)])
+
+
+class TaskHistoryTrackingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="history", password="testpass")
+        for i in range(1, 4):
+            Task.objects.create(priority=i, title=f"t{i}", description="d", user=self.user)
+
+    def test_new_task_no_lookup(self):
+        # the insert, the user's version bump, stats and change log, no history lookup
+        with self.assertNumQueries(4):
+            Task.objects.create(priority=9, title="fresh", description="d", user=self.user)
+        self.assertFalse(TaskHistory.objects.exists())
+
+    def test_status_change_one_locked_lookup(self):
+        task = Task.objects.get(title="t1")
+        task.title = "renamed"
+        # the counted fields read under lock, the update, version bump and change log
+        with self.assertNumQueries(4):
+            task.save()
+        task.status = "IN_PROGRESS"
+        with self.assertNumQueries(6):
+            task.save()
+        task.save()
+        history = TaskHistory.objects.get(task=task)
+        self.assertEqual((history.old_status, history.new_status), ("PENDING", "IN_PROGRESS"))
+
+    def test_bulk_paths(self):
+        tasks = list(Task.objects.filter(user=self.user))
+        for task in tasks:
+            task.status = "COMPLETED"
+        with self.assertNumQueries(6):
+            Task.objects.bulk_update(tasks, ["status"])
+        self.assertEqual(TaskHistory.objects.filter(new_status="COMPLETED").count(), 3)
+
+        Task.objects.filter(title="t1").update(status="COMPLETED")
+        Task.objects.filter(user=self.user).update(status="CANCELLED")
+        self.assertEqual(TaskHistory.objects.filter(new_status="CANCELLED").count(), 3)
+        self.assertEqual(TaskHistory.objects.count(), 6)
+
+
+class ReportPipelineTests(TestCase):
+    def setUp(self):
+        yesterday = datetime.now(timezone.utc) - timedelta(days=2)
+        self.reports = []
+        for i in range(3):
+            user = User.objects.create_user(username=f"reader{i}", email=f"reader{i}@example.com")
+            Task.objects.create(title="t", description="d", user=user, status="COMPLETED")
+            self.reports.append(Report.objects.create(user=user, confirmation=True, next_run_at=yesterday))
+        Report.objects.create(user=User.objects.create_user(username="optout"), last_updated=yesterday)
+
+    def test_batch_queries_do_not_grow_per_user(self):
+        # claim, stamp, one GROUP BY for every user's counts and the queued mail (plus the savepoint pair)
+        with self.assertNumQueries(6):
+            queued = send_report_batch([r.id for r in self.reports])
+        self.assertEqual(queued, 3)
+        self.assertEqual(mail.outbox, [])
+        drain_outbound_email()
+        self.assertEqual([m.to for m in mail.outbox], [[f"reader{i}@example.com"] for i in range(3)])
+        self.assertIn("Completed tasks = 1", mail.outbox[0].body)
+        # rescheduled for tomorrow, a second run sends nothing
+        self.assertEqual(send_report_batch([r.id for r in self.reports]), 0)
+
+    def test_periodic_emailer_fans_out(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(periodic_emailer(), 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_schedule(self):
+        report = Report(confirmation=True, send_time=time(9, 30))
+        report.schedule(datetime(2022, 3, 1, 8, 0, tzinfo=timezone.utc))
+        self.assertEqual(report.next_run_at, datetime(2022, 3, 1, 9, 30, tzinfo=timezone.utc))
+        report.schedule(datetime(2022, 3, 1, 9, 30, tzinfo=timezone.utc))
+        self.assertEqual(report.next_run_at, datetime(2022, 3, 2, 9, 30, tzinfo=timezone.utc))
+        report.confirmation = False
+        report.schedule()
+        self.assertIsNone(report.next_run_at)
+
+    def test_report_view_schedules(self):
+        user = User.objects.create_user(username="scheduler", password="testpass")
+        self.client.login(username="scheduler", password="testpass")
+        self.client.post("/report/", {"send_time": "10:15:00", "confirmation": "on"})
+        report = Report.objects.get(user=user)
+        self.assertEqual(report.next_run_at.time(), time(10, 15))
+        self.assertNotIn(report.id, due_report_ids(datetime.now(timezone.utc)))
+        self.assertIn(report.id, due_report_ids(report.next_run_at))
+
+
+class QueryPlanTests(TestCase):
+    """
+    Runs each hot path, EXPLAINs every statement it sends and fails if any of
+    them falls back to a full scan of the task or history tables.
+    """
+
+    # anywhere in a plan line: PostgreSQL indents nested nodes and appends
+    # costs, SQLite names subquery tables by alias and scans whole indexes
+    FULL_SCAN = re.compile(r'Seq Scan on "?tasks_task(history)?"?\b|\bSCAN (tasks_task\w*|U\d+)\b')
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="planner", password="testpass")
+        self.task = Task.objects.create(priority=1, title="t", description="d", user=self.user)
+        self.task.status = "COMPLETED"
+        self.task.save()
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # tiny test tables would always be seq scanned otherwise
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql)
+            else:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return "\n".join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertIndexed(self, func, *args):
+        with CaptureQueriesContext(connection) as queries:
+            func(*args)
+        plans = [
+            (query["sql"], self.explain(query["sql"]))
+            for query in queries
+            if query["sql"].startswith(("SELECT", "UPDATE")) and "tasks_task" in query["sql"]
+        ]
+        self.assertTrue(plans)
+        for sql, plan in plans:
+            self.assertIsNone(self.FULL_SCAN.search(plan), f"{sql}\n{plan}")
+
+    def test_full_scans_fail(self):
+        for line in ["Seq Scan on tasks_task  (cost=0.00..1.01 rows=1 width=4)",
+                "  ->  Seq Scan on tasks_taskhistory  (cost=0.00..1.01 rows=1 width=4)",
+                "SCAN tasks_task", "SCAN U0", "SCAN tasks_task USING INDEX task_live_priority_idx"]:
+            self.assertTrue(self.FULL_SCAN.search(line), line)
+        for line in ["Index Scan using task_live_priority_idx on tasks_task  (cost=0.15..8.17 rows=1 width=4)",
+                "SEARCH tasks_task USING INDEX task_live_priority_idx (user_id=?)"]:
+            self.assertFalse(self.FULL_SCAN.search(line), line)
+        # no index on description
+        with self.assertRaises(AssertionError):
+            self.assertIndexed(lambda: list(Task.objects.filter(description="d")))
+
+    def test_dashboard(self):
+        for sections in [(PENDING, COMPLETED), (PENDING,), (COMPLETED,)]:
+            self.assertIndexed(TaskDashboard(self.user, sections).page)
+
+    def test_priority_shift(self):
+        self.assertIndexed(shift_priorities, self.user, 1)
+
+    def test_archive_batch(self):
+        Task.objects.filter(pk=self.task.pk).update(deleted=True)
+        now = datetime.now(timezone.utc)
+        self.assertIndexed(archive_deleted_tasks, now + timedelta(days=1), now, 10)
+
+    def test_stats_recount(self):
+        self.assertIndexed(count_tasks, [self.user.id])
+
+    def test_api(self):
+        self.client.login(username="planner", password="testpass")
+        self.assertIndexed(self.client.get, "/api/task/")
+        self.assertIndexed(self.client.get, f"/api/task/{self.task.id}/history/")
+
+
+class TaskAPITests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="apiuser", password="testpass")
+        Task.objects.bulk_create(
+            Task(title=f"task {i}", description="d", priority=i % 7, user=self.user) for i in range(120)
+        )
+        self.client.login(username="apiuser", password="testpass")
+
+    def test_cursor_pages(self):
+        seen = []
+        url = "/api/task/"
+        while url:
+            response = self.client.get(url).json()
+            self.assertLessEqual(len(response["results"]), 50)
+            seen += [(task["priority"], task["id"]) for task in response["results"]]
+            url = response["next"]
+        self.assertEqual(len(seen), 120)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_equal_priorities_seek(self):
+        # the API's default priority, shared by hundreds of tasks
+        Task.objects.bulk_create(Task(title=f"same {i}", description="d", user=self.user) for i in range(300))
+        pages = []
+        url = "/api/task/?page_size=50"
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                response = self.client.get(url).json()
+                pages.append(response)
+                url = response["next"]
+        self.assertFalse([query["sql"] for query in queries if "OFFSET" in query["sql"].upper()])
+        seen = [(task["priority"], task["id"]) for page in pages for task in page["results"]]
+        self.assertEqual((len(seen), seen), (420, sorted(seen)))
+
+        self.assertIsNone(pages[0]["previous"])
+        previous = self.client.get(pages[3]["previous"]).json()
+        self.assertEqual(previous["results"], pages[2]["results"])
+        self.assertEqual(previous["next"], pages[2]["next"])
+        self.assertEqual(self.client.get("/api/task/?cursor=after.x").status_code, 404)
+
+    def test_user_not_fetched_per_task(self):
+        # session, user, ETag version and one page query, however many tasks are listed
+        with self.assertNumQueries(4):
+            response = self.client.get("/api/task/")
+        self.assertEqual(response.json()["results"][0]["user"], {"username": "apiuser"})
+
+    def test_sparse_fieldset(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/task/?fields=id,title,status")
+        self.assertEqual(set(response.json()["results"][0]), {"id", "title", "status"})
+        self.assertNotIn("description", queries[-1]["sql"])
+        self.assertNotIn("auth_user", queries[-1]["sql"])
+
+
+class BulkAPITests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="bulkuser", password="testpass")
+        for priority in [1, 2, 4]:
+            Task.objects.create(title=f"p{priority}", description="d", priority=priority, user=self.user)
+        self.client.login(username="bulkuser", password="testpass")
+
+    def send(self, method, data):
+        return getattr(self.client, method)("/api/task/bulk/", json.dumps(data), content_type="application/json")
+
+    def pending(self):
+        return list(Task.objects.filter(user=self.user, completed=False, deleted=False)
+            .order_by("priority", "id").values_list("title", "priority"))
+
+    def test_bulk_create_follows_collision_rules(self):
+        tasks = [{"title": f"new{i}", "description": "d", "priority": 1} for i in range(3)]
+        # one read of the colliding priorities, one write each for shifts and inserts
+        # and their change log entries and the user's stats
+        with self.assertNumQueries(12):
+            response = self.send("post", tasks)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.json()), 3)
+        # the same result as three single inserts at priority 1
+        self.assertEqual(self.pending(), [("new2", 1), ("new1", 2), ("new0", 3), ("p1", 4), ("p2", 5), ("p4", 6)])
+
+    def test_bulk_update_writes_history_in_bulk(self):
+        ids = list(Task.objects.filter(user=self.user).order_by("id").values_list("id", flat=True))
+        response = self.send("patch", [{"id": pk, "status": "COMPLETED"} for pk in ids])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TaskHistory.objects.filter(new_status="COMPLETED").count(), 3)
+
+        response = self.send("patch", [{"id": ids[2], "priority": 1}])
+        self.assertEqual(self.pending(), [("p4", 1), ("p1", 2), ("p2", 3)])
+
+    def test_bulk_update_mixed_payload(self):
+        tasks = dict(Task.objects.filter(user=self.user).values_list("title", "id"))
+        response = self.send("patch", [{"id": tasks["p4"], "priority": 1}, {"id": tasks["p1"], "title": "x"}])
+        self.assertEqual(response.status_code, 200)
+        # the renamed task is shifted along, not written back where it was
+        self.assertEqual(self.pending(), [("p4", 1), ("x", 2), ("p2", 3)])
+
+    def test_bulk_soft_delete(self):
+        ids = list(Task.objects.filter(user=self.user).values_list("id", flat=True))
+        other = Task.objects.create(title="other", description="d", user=User.objects.create_user(username="x"))
+        response = self.send("delete", ids + [other.id])
+        self.assertEqual(response.json(), {"deleted": 3})
+        self.assertFalse(Task.objects.get(id=other.id).deleted)
+        self.assertEqual(self.pending(), [])
+
+    def test_bulk_validation(self):
+        self.assertEqual(self.send("post", {"title": "x"}).status_code, 400)
+        self.assertEqual(self.send("patch", [{"id": 999, "title": "x"}]).status_code, 400)
+        self.assertEqual(self.send("delete", ["a"]).status_code, 400)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="etag", password="testpass")
+        self.task = Task.objects.create(title="t", description="d", priority=1, user=self.user)
+        self.client.login(username="etag", password="testpass")
+
+    def test_not_modified_skips_task_table(self):
+        for url in ["/api/task/", f"/api/task/{self.task.id}/history/", "/tasks/", "/pending-tasks/"]:
+            etag = self.client.get(url)["ETag"]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertFalse([q for q in queries if '"tasks_task"' in q["sql"]])
+
+    def test_changes_bump_etag(self):
+        etag = self.client.get("/api/task/")["ETag"]
+        self.task.status = "COMPLETED"
+        self.task.save()
+        response = self.client.get("/api/task/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response["ETag"]
+        Task.objects.filter(id=self.task.id).update(title="renamed")
+        self.assertEqual(self.client.get("/api/task/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_login_changes_page_etag(self):
+        etag = self.client.get("/tasks/")["ETag"]
+        self.assertEqual(self.client.get("/tasks/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.logout()
+        self.client.login(username="etag", password="testpass")
+        # a cached page would post the old, rotated CSRF token
+        response = self.client.get("/tasks/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Last-Modified", response)
+
+    def test_etag_per_user_and_page(self):
+        etag = self.client.get("/api/task/")["ETag"]
+        self.assertNotEqual(etag, self.client.get("/api/task/?completed=true")["ETag"])
+        User.objects.create_user(username="other", password="testpass")
+        self.client.login(username="other", password="testpass")
+        self.assertEqual(self.client.get("/api/task/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class TaskListCacheTests(TestCase):
+    def setUp(self):
+        caches[TASK_LIST_CACHE].clear()
+        cache_stats.reset()
+        self.user = User.objects.create_user(username="cached", password="testpass")
+        self.task = Task.objects.create(title="t", description="d", priority=1, user=self.user)
+        self.client.login(username="cached", password="testpass")
+
+    def test_hit_then_invalidate(self):
+        for url in ["/tasks/", "/api/task/"]:
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            self.assertFalse([q for q in queries if '"tasks_task"' in q["sql"]])
+        self.assertEqual(cache_stats.snapshot()["hits"], 2)
+
+        self.task.title = "renamed"
+        self.task.save()
+        self.assertEqual(self.client.get("/api/task/").json()["results"][0]["title"], "renamed")
+        self.assertEqual(self.client.get("/tasks/").context["tasks"][0].title, "renamed")
+        Task.objects.bulk_update([self.task], ["title"])
+        self.assertGreaterEqual(cache_stats.snapshot()["invalidations"], 2)
+
+    def test_variants_are_separate(self):
+        Task.objects.create(title="done", description="d", priority=1, user=self.user, completed=True)
+        self.assertEqual(len(self.client.get("/pending-tasks/").context["tasks"]), 1)
+        self.assertEqual(self.client.get("/completed-tasks/").context["tasks"][0].title, "done")
+        self.assertEqual(len(self.client.get("/api/task/?completed=true").json()["results"]), 1)
+
+    def test_lru_evictions_counted(self):
+        cache = CountingLocMemCache("test-lru", {"OPTIONS": {"MAX_ENTRIES": 3, "CULL_FREQUENCY": 3}})
+        for i in range(5):
+            cache.set(f"k{i}", i)
+        self.assertEqual(cache_stats.snapshot()["evictions"], 2)
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_suite_runs_and_rolls_back(self):
+        output = os.path.join(tempfile.mkdtemp(), "bench.json")
+        call_command("benchmark", "views", "create", "api", "emails", users=2, tasks=5, history=1,
+            repeat=2, output=output)
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual(set(results["scenarios"]), {"views", "create", "api", "emails"})
+        self.assertEqual(results["scenarios"]["api"]["task_list"]["runs"], 2)
+        self.assertFalse(Task.objects.exists())
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="budget", password="testpass", email="budget@example.com")
+        for i in range(1, 21):
+            Task.objects.create(title=f"t{i}", description="d", priority=i, user=self.user, completed=i % 3 == 0)
+        self.task = Task.objects.filter(user=self.user).first()
+        self.client.login(username="budget", password="testpass")
+
+    def test_views_stay_within_budget(self):
+        # strict mode turns any violation into an exception out of the client
+        for url in ["/tasks/", "/pending-tasks/", "/completed-tasks/", "/api/task/", "/tasks/?q=t1", "/api/task/?q=t1",
+                f"/api/task/{self.task.id}/", f"/api/task/{self.task.id}/history/",
+                f"/api/task/{self.task.id}/history/?archived=1"]:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.post("/api/task/", {"title": "new", "description": "d", "priority": 1})
+        self.client.patch(f"/api/task/{self.task.id}/", {"status": "COMPLETED"}, content_type="application/json")
+        self.client.post("/api/task/bulk/", [{"title": f"b{i}", "description": "d", "priority": 1} for i in range(30)],
+            content_type="application/json")
+        self.client.post("/create-task/", {"title": "x", "description": "y", "priority": 2, "status": "PENDING"})
+        token = self.client.get("/api/task/sync/").json()["token"]
+        self.client.get(f"/api/task/sync/?since={token}")
+
+    def test_budget_exceeded(self):
+        with mock.patch.dict(TaskViewSet.query_budget, {"list": 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get("/api/task/")
+
+    def test_repeated_queries_detected(self):
+        TaskHistory.objects.bulk_create(TaskHistory(task=task, old_status="PENDING", new_status="COMPLETED")
+            for task in Task.objects.all())
+        with self.assertRaisesRegex(QueryBudgetExceeded, "N\\+1"):
+            with query_budget():
+                for task in TaskHistory.objects.all():
+                    task.task.title
+        with query_budget(2) as recorder:
+            list(TaskHistory.objects.select_related("task"))
+        self.assertEqual(recorder.count, 1)
+
+    def test_celery_task_budget(self):
+        report = Report.objects.create(user=self.user, confirmation=True)
+        send_email_report.apply(args=[Report.objects.get(pk=report.pk)]).get()
+
+    def test_server_timing(self):
+        timing = self.client.get("/tasks/")["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", template;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertIn("serialize;dur=", self.client.get("/api/task/")["Server-Timing"])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.user = User.objects.create_user(username="metrics", password="testpass", email="metrics@example.com")
+        self.client.login(username="metrics", password="testpass")
+
+    def test_hot_paths_recorded(self):
+        self.client.get("/tasks/")
+        self.client.post("/create-task/", {"title": "a", "description": "d", "priority": 1, "status": "PENDING"})
+        self.client.post("/create-task/", {"title": "b", "description": "d", "priority": 1, "status": "PENDING"})
+        task = Task.objects.get(title="a")
+        self.client.patch(f"/api/task/{task.id}/", {"status": "COMPLETED"}, content_type="application/json")
+        report = Report.objects.create(user=self.user, confirmation=True, next_run_at=datetime.now(timezone.utc))
+        send_report_batch([report.id])
+
+        self.assertEqual(metrics.value("request_seconds", view="tasks", method="GET")[0], 1)
+        self.assertEqual(metrics.value("responses", view="create-task", status=302), 2)
+        self.assertGreater(metrics.value("db_queries", view="task-detail"), 0)
+        self.assertEqual(metrics.value("priority_shift_size"), [2, 1, 1])
+        self.assertEqual(metrics.value("history_writes"), 1)
+        self.assertEqual(metrics.value("report_emails_queued"), 1)
+        self.assertEqual(metrics.value("report_batch_seconds")[0], 1)
+
+        body = self.client.get("/metrics").content.decode()
+        process = f'instance="{instance()}"'
+        self.assertIn(f'tasks_request_seconds_count{{method="GET",view="tasks",{process}}} 1', body)
+        self.assertIn(f"tasks_report_emails_queued_total{{{process}}} 1", body)
+        self.assertIn("tasks_task_list_cache_hits_total", body)
+
+    def test_other_processes_exported(self):
+        # what a Celery worker pushed, next to this web worker's own numbers
+        store = MemoryMetricsStore()
+        store.push("worker:7", {"counters": [["emails_sent", [], 3]], "gauges": [],
+            "timers": [["report_batch_seconds", [], 1, 0.5, 0.5]]})
+        self.addCleanup(setattr, metrics_module, "metrics_store", None)
+        metrics_module.metrics_store = store
+        metrics.incr("history_writes")
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn('tasks_emails_sent_total{instance="worker:7"} 3', body)
+        self.assertIn('tasks_report_batch_seconds_count{instance="worker:7"} 1', body)
+        self.assertIn(f'tasks_history_writes_total{{instance="{instance()}"}} 1', body)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    def test_json_log_lines(self):
+        record = logging.LogRecord("tasks.requests", logging.INFO, "", 0, "request", (), None)
+        record.view = "tasks"
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual((entry["message"], entry["view"], entry["level"]), ("request", "tasks", "INFO"))
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class AsyncAPITests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="async", password="testpass")
+        self.other = User.objects.create_user(username="other", password="testpass")
+        for i in range(1, 6):
+            Task.objects.create(title=f"t{i}", description="d", priority=i, user=self.user, completed=i == 5)
+        self.foreign = Task.objects.create(title="foreign", description="d", priority=1, user=self.other)
+        self.task = Task.objects.filter(user=self.user).first()
+        self.task.status = "COMPLETED"
+        self.task.save()
+        self.async_client.force_login(self.user)
+
+    async def test_list_pages(self):
+        response = await self.async_client.get("/api/async/task/?page_size=3&fields=id,title")
+        body = response.json()
+        self.assertEqual([task["title"] for task in body["results"]], ["t1", "t2", "t3"])
+        self.assertEqual(set(body["results"][0]), {"id", "title"})
+        body = (await self.async_client.get(f"/api/async/task/?page_size=3&cursor={body['next_cursor']}")).json()
+        self.assertEqual([task["title"] for task in body["results"]], ["t4", "t5"])
+        self.assertIsNone(body["next_cursor"])
+        self.assertEqual(len((await self.async_client.get("/api/async/task/?completed=false")).json()["results"]), 4)
+        self.assertEqual((await self.async_client.get("/api/async/task/?cursor=x")).status_code, 400)
+        self.assertEqual((await self.async_client.post("/api/async/task/")).status_code, 405)
+
+    async def test_detail_and_history(self):
+        response = await self.async_client.get(f"/api/async/task/{self.task.id}/")
+        self.assertEqual(response.json()["user"], {"username": "async"})
+        self.assertEqual((await self.async_client.get(f"/api/async/task/{self.foreign.id}/")).status_code, 404)
+        history = (await self.async_client.get(f"/api/async/task/{self.task.id}/history/")).json()
+        self.assertEqual(history[0]["new_status"], "COMPLETED")
+        self.assertEqual((await self.async_client.get(f"/api/async/task/{self.foreign.id}/history/")).json(), [])
+
+    async def test_anonymous(self):
+        await sync_to_async(self.async_client.logout)()
+        self.assertEqual((await self.async_client.get("/api/async/task/")).status_code, 403)
+
+    async def test_long_poll(self):
+        watcher.interval = 0.01
+        self.addCleanup(setattr, watcher, "interval", 1.0)
+        version = (await self.async_client.get("/api/async/task/poll/")).json()["version"]
+        self.assertEqual((await self.async_client.get(f"/api/async/task/poll/?version={version}&timeout=0.05")).status_code, 204)
+
+        poll = asyncio.ensure_future(self.async_client.get(f"/api/async/task/poll/?version={version}&timeout=5"))
+        await asyncio.sleep(0.05)
+        self.assertFalse(poll.done())
+        # the test shares its connection with the parked request, keep this write off its budget
+        token = unrecorded.set(True)
+        await sync_to_async(Task.objects.create)(title="new", description="d", priority=9, user=self.user)
+        unrecorded.reset(token)
+        response = await poll
+        self.assertEqual(response.json(), {"version": version + 1})
+        self.assertEqual(watcher.waiters, {})
+
+
+class TaskEventTests(TestCase):
+    def setUp(self):
+        get_broker.cache_clear()
+        self.addCleanup(get_broker.cache_clear)
+        self.user = User.objects.create_user(username="events", password="testpass")
+        self.client.login(username="events", password="testpass")
+
+    def received(self):
+        broker = get_broker()
+        entries, complete = broker.since(self.user.pk, str(broker.first_id - 1))
+        self.assertTrue(complete)
+        return [json.loads(data) for _, data in entries]
+
+    def test_save_paths_publish_diffs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            task = Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/create-task/", {"title": "b", "description": "d", "priority": 1, "status": "PENDING"})
+        task.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            task.status = "COMPLETED"
+            task.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch("/api/task/bulk/", [{"id": task.id, "title": "renamed"}], content_type="application/json")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete("/api/task/bulk/", [task.id], content_type="application/json")
+
+        events = self.received()
+        self.assertEqual([event["kind"] for event in events],
+            ["created", "shifted", "created", "status_changed", "updated", "deleted"])
+        self.assertEqual(events[0]["fields"]["title"], "a")
+        self.assertEqual(events[1], {"kind": "shifted", "field": "priority", "from": 1, "to": 1, "by": 1,
+            "completed": False})
+        self.assertEqual((events[3]["old_status"], events[3]["fields"]["status"]), ("PENDING", "COMPLETED"))
+        self.assertEqual(events[4]["fields"]["title"], "renamed")
+        self.assertEqual(events[5], {"kind": "deleted", "id": task.id})
+
+    def test_nothing_published_on_rollback(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.received(), [])
+
+    def test_replay_buffer_is_bounded(self):
+        broker = LocalBroker(replay=2)
+        broker.publish(1, ["a", "b", "c"])
+        first = str(broker.first_id)
+        self.assertEqual(broker.since(1, first), ([(str(broker.first_id + 1), "b"), (str(broker.first_id + 2), "c")], True))
+        self.assertEqual(broker.since(1, str(broker.first_id - 1))[1], False)
+        self.assertEqual(broker.since(1, "garbage"), ([], False))
+        self.assertEqual(broker.since(2, first), ([], True))
+
+    def test_stream_resumes_from_last_event_id(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        start = get_broker().latest_id(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.create(title="b", description="d", priority=2, user=self.user)
+
+        response = self.client.get("/api/task/events/?timeout=0", HTTP_LAST_EVENT_ID=start)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join(response.streaming_content).decode()
+        self.assertEqual(body.count("event: task"), 1)
+        self.assertIn('"title": "b"', body)
+
+        body = b"".join(self.client.get("/api/task/events/?timeout=0", HTTP_LAST_EVENT_ID="1").streaming_content).decode()
+        self.assertIn("event: resync", body)
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/task/events/").status_code, 403)
+
+    def test_failed_export(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, root)
+        with self.settings(EXPORT_ROOT=root):
+            with self.captureOnCommitCallbacks() as callbacks:
+                url = self.client.post("/api/export/tasks.csv").json()["url"]
+            stored = signing.loads(url.rsplit("/", 2)[1], salt=SIGNING_SALT)["file"]
+            with self.assertRaises(KeyError):
+                # fails once the partial file is open
+                export_to_file(self.user.pk, "nothing", "csv", False, stored)
+            self.assertEqual(len(callbacks), 1)
+            response = self.client.get(url)
+            self.assertEqual((response.status_code, response.json()["status"]), (500, "failed"))
+            self.assertEqual(os.listdir(root), [f"{stored}.failed"])
+            os.remove(os.path.join(root, f"{stored}.failed"))
+
+    async def test_asgi_stream(self):
+        cookie = f"sessionid={self.client.cookies['sessionid'].value}".encode()
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(10)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        async def publish():
+            await asyncio.sleep(0.05)
+            await sync_to_async(get_broker().publish)(self.user.pk, ['{"kind": "deleted", "id": 1}'])
+
+        scope = {"type": "http", "path": "/api/task/events/", "query_string": b"timeout=0.2", "headers": [(b"cookie", cookie)]}
+        await asyncio.gather(events_application(scope, receive, send), publish())
+        self.assertEqual(sent[0]["status"], 200)
+        body = b"".join(message.get("body", b"") for message in sent[1:]).decode()
+        self.assertIn('event: task\ndata: {"kind": "deleted", "id": 1}', body)
+
+        sent.clear()
+        await events_application({**scope, "headers": []}, receive, send)
+        self.assertEqual(sent[0]["status"], 403)
+
+
+class TaskSyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="sync", password="testpass", email="sync@example.com")
+        self.tasks = [Task.objects.create(title=f"t{i}", description="d", priority=i, user=self.user)
+            for i in range(1, 6)]
+        self.client.login(username="sync", password="testpass")
+
+    def sync(self, token=None):
+        response = self.client.get("/api/task/sync/" + (f"?since={token}" if token else ""))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_full_then_delta(self):
+        data = self.sync()
+        self.assertTrue(data["full"])
+        self.assertEqual(len(data["tasks"]), 5)
+
+        first, second = self.tasks[:2]
+        first.title = "renamed"
+        first.save()
+        second.deleted = True
+        second.save()
+        shift_priorities(self.user, 3)
+        delta = self.sync(data["token"])
+        self.assertFalse(delta["full"])
+        self.assertEqual([task["title"] for task in delta["tasks"]], ["renamed"])
+        self.assertEqual(delta["deleted"], [second.id])
+        self.assertEqual(delta["shifts"], [{"field": "priority", "from": 3, "to": 5, "by": 1, "completed": False}])
+
+        self.assertEqual(self.sync(delta["token"])["tasks"], [])
+
+    def test_shift_skips_completed(self):
+        # completed tasks share priorities with pending ones
+        done = Task.objects.create(title="done", description="d", priority=4, completed=True, user=self.user)
+        data = self.sync()
+        local = {task["id"]: task for task in data["tasks"]}
+
+        shift_priorities(self.user, 3)
+        delta = self.sync(data["token"])
+        self.assertEqual(delta["tasks"], [])
+        for shift in delta["shifts"]:
+            scope = {name: value for name, value in shift.items() if name not in ("field", "from", "to", "by")}
+            for task in local.values():
+                if shift["from"] <= task[shift["field"]] <= shift["to"] and \
+                        all(task[name] == value for name, value in scope.items()):
+                    task[shift["field"]] += shift["by"]
+        self.assertEqual({pk: task["priority"] for pk, task in local.items()},
+            dict(Task.objects.filter(user=self.user).values_list("id", "priority")))
+        self.assertEqual(local[done.id]["priority"], 4)
+
+    def test_invalid_token(self):
+        self.assertEqual(self.client.get("/api/task/sync/?since=nope!").status_code, 400)
+
+    def test_compaction(self):
+        token = self.sync()["token"]
+        task = self.tasks[0]
+        for title in ("a", "b", "c"):
+            task.title = title
+            task.save()
+        compact_task_changes()
+        self.assertEqual(TaskChange.objects.filter(task_id=task.id).count(), 1)
+        self.assertEqual([task["title"] for task in self.sync(token)["tasks"]], ["c"])
+
+        # past the retention, an old token gets everything again
+        compact_task_changes(now=datetime.now(timezone.utc) + SYNC_RETENTION + timedelta(days=1))
+        self.assertFalse(TaskChange.objects.exists())
+        self.assertTrue(self.sync(token)["full"])
+
+
+class TaskSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="search", password="testpass", email="search@example.com")
+        other = User.objects.create_user(username="other", password="testpass", email="other@example.com")
+        Task.objects.create(title="buy milk", description="two litres of milk", priority=1, user=self.user)
+        Task.objects.create(title="walk the dog", description="before it rains", priority=2, user=self.user)
+        Task.objects.create(title="errands", description="milk, bread", priority=3, user=self.user, completed=True)
+        Task.objects.create(title="milk", description="someone else's", priority=1, user=other)
+        self.client.login(username="search", password="testpass")
+
+    def search(self, q, **params):
+        response = self.client.get("/api/task/", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_ranked_api_results(self):
+        data = self.search("milk")
+        self.assertEqual([task["title"] for task in data["results"]], ["buy milk", "errands"])
+        self.assertIsNone(data["next"])
+        self.assertEqual([task["title"] for task in self.search("walking")["results"]], ["walk the dog"])
+        self.assertEqual(self.search('"); DROP')["results"], [])
+        page = self.search("milk", page_size=1)
+        self.assertEqual([task["title"] for task in page["results"]], ["buy milk"])
+        self.assertIn("page=2", page["next"])
+        page = self.search("milk", page_size=1, page=2)
+        self.assertEqual([task["title"] for task in page["results"]], ["errands"])
+        self.assertIsNone(page["next"])
+        self.assertEqual(self.search("milk", completed="false")["results"][0]["title"], "buy milk")
+
+    def test_index_follows_writes(self):
+        def titles(q):
+            return sorted(task["title"] for task in self.search(q)["results"])
+
+        Task.objects.filter(title="walk the dog").update(title="walk the cat")
+        self.assertEqual(titles("cat"), ["walk the cat"])
+        self.assertEqual(titles("dog"), [])
+        tasks = list(Task.objects.filter(user=self.user))
+        for task in tasks:
+            task.description = "groceries"
+        Task.objects.bulk_update(tasks, ["description"])
+        self.assertEqual(titles("groceries"), ["buy milk", "errands", "walk the cat"])
+        Task.objects.bulk_create([Task(title="groceries again", description="", priority=9, user=self.user)])
+        Task.objects.filter(title="buy milk").update(deleted=True)
+        Task.objects.filter(title="errands").delete()
+        self.assertEqual(titles("groceries"), ["groceries again", "walk the cat"])
+
+    def test_html_search(self):
+        response = self.client.get("/tasks/", {"q": "milk"})
+        self.assertContains(response, "buy milk")
+        self.assertContains(response, "errands")
+        self.assertNotContains(response, "walk the dog")
+        response = self.client.get("/pending-tasks/", {"q": "milk"})
+        self.assertContains(response, "buy milk")
+        self.assertNotContains(response, "errands")
+
+
+class UserTaskStatsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="stats", password="testpass", email="stats@example.com")
+        self.other = User.objects.create_user(username="stats2", password="testpass", email="stats2@example.com")
+        for i in range(1, 5):
+            Task.objects.create(title=f"t{i}", description="d", priority=i, user=self.user)
+
+    def assertCounted(self, *users):
+        # the maintained counters match a fresh count
+        for user_id, counts in count_tasks([user.pk for user in users]).items():
+            stats = UserTaskStats.objects.get(user_id=user_id)
+            self.assertEqual({name: getattr(stats, name) for name in STATS_COUNTERS},
+                {name: counts[name] for name in STATS_COUNTERS})
+
+    def test_stale_copies_counted_once(self):
+        # two requests that loaded the task before either deleted or completed it
+        first, second = Task.objects.get(title="t1"), Task.objects.get(title="t1")
+        for task in (first, second):
+            task.deleted = True
+            task.save()
+        first, second = Task.objects.get(title="t2"), Task.objects.get(title="t2")
+        for task in (first, second):
+            task.completed = True
+        Task.objects.bulk_update([first], ["completed"])
+        Task.objects.bulk_update([second], ["completed"])
+        self.assertCounted(self.user)
+
+    def test_drift_below_zero_repairable(self):
+        UserTaskStats.objects.filter(user=self.user).update(total=0, pending_status=0)
+        Task.objects.filter(title="t1").update(deleted=True)
+        self.assertEqual(UserTaskStats.objects.get(user=self.user).total, -1)
+        self.assertEqual(reconcile_task_stats([self.user.pk]), [self.user.pk])
+        self.assertCounted(self.user)
+
+    def test_write_paths(self):
+        task = Task.objects.get(title="t1")
+        task.status = "COMPLETED"
+        task.completed = True
+        task.save()
+        task.title = "renamed"
+        with self.assertNumQueries(4):
+            task.save()
+        Task.objects.filter(title="t2").update(status="CANCELLED")
+        Task.objects.filter(title="t3").update(deleted=True)
+        Task.objects.filter(title="t4").update(user=self.other)
+        tasks = list(Task.objects.filter(user=self.user))
+        for task in tasks:
+            task.status = "IN_PROGRESS"
+        Task.objects.bulk_update(tasks, ["status"])
+        Task.objects.bulk_create([Task(title="b", description="d", priority=9, user=self.other, completed=True)])
+        Task.objects.filter(title="t2").delete()
+        # an expression is recounted rather than adjusted
+        Task.objects.filter(user=self.other).update(completed=Value(False))
+        self.assertCounted(self.user, self.other)
+        stats = UserTaskStats.objects.get(user=self.user)
+        self.assertEqual((stats.total, stats.completed, stats.in_progress_status), (1, 1, 1))
+        self.assertEqual(UserTaskStats.objects.get(user=self.other).completed, 0)
+
+    def test_counts_read_from_stats(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(task_counts(self.user), {"total_cnt": 4, "completed_cnt": 0})
+        with self.assertNumQueries(1):
+            self.assertEqual(status_counts([self.user.id])[self.user.id]["PENDING"], 4)
+
+    def test_reconcile(self):
+        UserTaskStats.objects.filter(user=self.user).update(total=99)
+        UserTaskStats.objects.filter(user=self.other).delete()
+        # without a row the counts are recounted
+        self.assertEqual(task_counts(self.other), {"total_cnt": 0, "completed_cnt": 0})
+        out = io.StringIO()
+        call_command("reconcile_task_stats", stdout=out)
+        self.assertIn("repaired 2", out.getvalue())
+        self.assertCounted(self.user, self.other)
+
+    def test_user_deleted_with_tasks(self):
+        user_id = self.user.pk
+        self.user.delete()
+        self.assertFalse(UserTaskStats.objects.filter(user_id=user_id).exists())
+        self.assertFalse(TaskListVersion.objects.filter(user_id=user_id).exists())
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="archive", password="testpass", email="archive@example.com")
+        self.old = datetime.now(timezone.utc) - timedelta(days=400)
+        self.live = Task.objects.create(title="live", description="d", priority=1, user=self.user)
+        self.gone = Task.objects.create(title="gone", description="d", priority=2, user=self.user)
+        self.recent = Task.objects.create(title="recent", description="d", priority=3, user=self.user)
+        for task in (self.live, self.gone):
+            task.status = "IN_PROGRESS"
+            task.save()
+        self.gone.deleted = self.recent.deleted = True
+        self.gone.save()
+        self.recent.save()
+        # auto_now fields, backdated behind the ORM's back
+        Task.objects.filter(pk=self.gone.pk).update(created_date=self.old, deleted_at=self.old)
+        TaskHistory.objects.update(change_date=self.old)
+        self.client.login(username="archive", password="testpass")
+
+    def history(self, task, **params):
+        response = self.client.get(f"/api/task/{task.pk}/history/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_archive_and_read_back(self):
+        with self.settings(ARCHIVE_BATCH_SIZE=1, ARCHIVE_PAUSE=0):
+            moved = archive_cold_rows()
+        self.assertEqual(moved, {"tasks": 1, "history": 2, "continued": False})
+        self.assertEqual(set(Task.objects.values_list("title", flat=True)), {"live", "recent"})
+        self.assertEqual(ArchivedTask.objects.get().title, "gone")
+        self.assertFalse(TaskHistory.objects.exists())
+
+        self.assertEqual(self.history(self.live), [])
+        self.assertEqual([entry["new_status"] for entry in self.history(self.live, archived=1)], ["IN_PROGRESS"])
+        self.assertEqual(len(self.history(self.gone, archived=1)), 1)
+        self.assertEqual(len(self.history(self.gone, archived=1, new_status="PENDING")), 0)
+
+        other = User.objects.create_user(username="archive2", password="testpass")
+        self.client.force_login(other)
+        self.assertEqual(self.history(self.gone, archived=1), [])
+
+    def test_bulk_delete_waits(self):
+        # last edited long ago, deleted just now
+        old = Task.objects.create(title="old", description="d", priority=4, user=self.user)
+        Task.objects.filter(pk=old.pk).update(created_date=self.old)
+        response = self.client.delete("/api/task/bulk/", [old.id], content_type="application/json")
+        self.assertEqual(response.json(), {"deleted": 1})
+        self.assertIsNotNone(Task.objects.get(pk=old.pk).deleted_at)
+        with self.settings(ARCHIVE_PAUSE=0):
+            archive_cold_rows()
+        self.assertEqual(list(ArchivedTask.objects.values_list("title", flat=True)), ["gone"])
+        self.assertTrue(Task.objects.filter(pk=old.pk).exists())
+
+        # restored tasks lose the date
+        self.recent.deleted = False
+        self.recent.save(update_fields=["deleted"])
+        self.assertIsNone(Task.objects.get(pk=self.recent.pk).deleted_at)
+
+    def test_run_continues_later(self):
+        # every batch runs out of time, each follow-up run (inline here) picks up the rest
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        with self.settings(ARCHIVE_BATCH_SIZE=1, ARCHIVE_PAUSE=0, ARCHIVE_RUN_SECONDS=0):
+            self.assertTrue(archive_cold_rows()["continued"])
+        self.assertEqual(ArchivedTask.objects.count(), 1)
+        self.assertEqual(ArchivedTaskHistory.objects.count(), 2)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="export", password="testpass")
+        self.task = Task.objects.create(title="write, \"quoted\"", description="d", priority=1, user=self.user)
+        self.task.status = "COMPLETED"
+        self.task.save()
+        Task.objects.create(title="gone", description="d", priority=2, user=self.user, deleted=True)
+        Task.objects.create(title="other", description="d", priority=1,
+            user=User.objects.create_user(username="export2"))
+        self.client.login(username="export", password="testpass")
+
+    def export(self, name):
+        response = self.client.get(f"/api/export/{name}")
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def test_stream_formats(self):
+        rows = list(csv.reader(io.StringIO(self.export("tasks.csv").decode())))
+        self.assertEqual(rows[0], COLUMNS["tasks"])
+        self.assertEqual([row[1] for row in rows[1:]], ['write, "quoted"'])
+
+        lines = self.export("history.jsonl").decode().splitlines()
+        self.assertEqual([json.loads(line)["new_status"] for line in lines], ["COMPLETED"])
+        self.assertEqual(gzip.decompress(self.export("history.jsonl.gz")).decode().splitlines(), lines)
+
+        self.assertEqual(self.client.get("/api/export/tasks.xml").status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/export/tasks.csv").status_code, 403)
+
+    def test_basic_auth(self):
+        self.client.logout()
+        credentials = base64.b64encode(b"export:testpass").decode()
+        response = self.client.get("/api/export/tasks.csv", HTTP_AUTHORIZATION=f"Basic {credentials}",
+            HTTP_ACCEPT="text/csv")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"quoted", b"".join(response.streaming_content))
+        response = self.client.post("/api/export/tasks.csv", HTTP_AUTHORIZATION=f"Basic {credentials}")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.client.get(response.json()["url"], HTTP_AUTHORIZATION=f"Basic {credentials}").json(),
+            {"status": "pending"})
+
+    def test_history_includes_archive(self):
+        archived = ArchivedTaskHistory.objects.create(id=TaskHistory.objects.get().id + 1000, task_id=self.task.id,
+            old_status="PENDING", new_status="IN_PROGRESS", change_date=datetime.now(timezone.utc),
+            archived_at=datetime.now(timezone.utc))
+        rows = list(csv.reader(io.StringIO(self.export("history.csv").decode())))
+        self.assertEqual([row[3] for row in rows[1:]], ["IN_PROGRESS", "COMPLETED"])
+        self.assertEqual(rows[1][0], str(archived.id))
+
+    def test_export_to_file(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        root = tempfile.mkdtemp()
+        with self.settings(EXPORT_ROOT=root):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post("/api/export/tasks.csv.gz")
+            self.assertEqual(response.status_code, 202)
+            url = response.json()["url"]
+            download = self.client.get(url)
+            self.assertEqual(download.status_code, 200)
+            self.assertEqual(download["Content-Disposition"], 'attachment; filename="tasks.csv.gz"')
+            self.assertEqual(gzip.decompress(b"".join(download.streaming_content)), self.export("tasks.csv"))
+            download.close()
+
+            self.assertEqual(self.client.get(url.replace("/download/", "/download/x")).status_code, 404)
+            self.client.force_login(User.objects.get(username="export2"))
+            self.assertEqual(self.client.get(url).status_code, 404)
+            for entry in os.scandir(root):
+                os.utime(entry.path, (0, 0))
+            self.assertEqual(remove_old_exports(), 1)
+        os.rmdir(root)
+
+    async def test_asgi_stream(self):
+        from task_manager.asgi import django_application
+
+        await sync_to_async(self.client.login)(username="export", password="testpass")
+        cookie = f"sessionid={self.client.cookies['sessionid'].value}".encode()
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/api/export/tasks.jsonl", "query_string": b"",
+            "headers": [(b"cookie", cookie)], "server": ("testserver", 80)}
+        with self.settings(ALLOWED_HOSTS=["testserver"]):
+            await django_application.handle(scope, receive, send)
+        self.assertEqual(sent[0]["status"], 200)
+        body = b"".join(message.get("body", b"") for message in sent[1:]).decode()
+        self.assertEqual([json.loads(line)["id"] for line in body.splitlines()], [self.task.id])
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(close_pools)
+
+    def wrapper(self, **options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "pool.sqlite3")
+        handler = ConnectionHandler({"default": {}, "pooled": {"ENGINE": "tasks.backends.sqlite3", "NAME": path, **options}})
+        return handler, handler["pooled"]
+
+    def test_checkout_reuse_overflow_and_timeout(self):
+        pool = ConnectionPool("test", lambda: sqlite3.connect(":memory:"), size=1, max_overflow=1, timeout=0.05)
+        first = pool.checkout()
+        second = pool.checkout()
+        self.assertEqual(pool.stats(), {"open": 2, "idle": 0, "in_use": 2, "waiting": 0})
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+        pool.checkin(first)
+        # over SIZE, the overflow connection is closed on return
+        pool.checkin(second)
+        self.assertEqual(pool.stats()["open"], 1)
+        self.assertIs(pool.checkout(), first)
+        self.assertEqual(metrics.value("db_pool_timeouts", alias="test"), 1)
+        self.assertEqual(metrics.value("db_pool_connects", alias="test"), 2)
+
+    def test_idle_connection_checked(self):
+        pool = ConnectionPool("test", lambda: sqlite3.connect(":memory:"), size=1, check_after=0)
+        raw = pool.checkout()
+        raw.close()
+        pool.checkin(raw)
+        self.assertIsNot(pool.checkout(), raw)
+        self.assertEqual(metrics.value("db_pool_discarded", alias="test", reason="unusable"), 1)
+
+    def test_backend_returns_connections(self):
+        handler, connection = self.wrapper(POOL={"SIZE": 1})
+        connection.ensure_connection()
+        raw = connection.connection
+        connection.close()
+
+        def other_thread():
+            # a thread of its own, like every ASGI request
+            other = handler.create_connection("pooled")
+            with other.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            reused = other.connection is raw
+            other.close()
+            return reused
+
+        self.assertTrue(async_to_sync(sync_to_async(other_thread, thread_sensitive=False))())
+        self.assertIn(f'tasks_db_pool_idle{{alias="pooled",instance="{instance()}"}} 1', metrics.exposition())
+
+    def test_health_check(self):
+        _, connection = self.wrapper(CONN_MAX_AGE=None, CONN_HEALTH_CHECKS=True)
+        connection.ensure_connection()
+        connection.connection.close()
+        connection.close_if_unusable_or_obsolete()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.assertEqual(metrics.value("db_health_check_failures", alias="pooled"), 1)
+        connection.close()
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"])
+class ReplicaRoutingTests(TransactionTestCase):
+    # committed rows, so the replica connection sees them
+    databases = {"default", "replica1", "replica2"}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="replica", password="testpass")
+        self.client.login(username="replica", password="testpass")
+
+    def replica_queries(self, func):
+        with CaptureQueriesContext(connections["replica1"]) as queries:
+            response = func()
+        return response, len(queries)
+
+    def test_reads_pinned_after_write(self):
+        response, queries = self.replica_queries(lambda: self.client.get("/api/task/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(queries, 0)
+
+        response, queries = self.replica_queries(lambda: self.client.post("/api/task/",
+            {"title": "a", "description": "d", "priority": 1, "status": "PENDING"}))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(queries, 0)
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        response, queries = self.replica_queries(lambda: self.client.get("/tasks/"))
+        self.assertEqual(queries, 0)
+        self.assertContains(response, "a")
+
+        del self.client.cookies[PIN_COOKIE]
+        response, queries = self.replica_queries(lambda: self.client.get("/api/task/"))
+        self.assertGreater(queries, 0)
+        self.assertEqual([task["title"] for task in response.json()["results"]], ["a"])
+
+    @override_settings(DATABASE_REPLICAS=["replica1", "replica2"])
+    def test_one_replica_per_request(self):
+        Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        for _ in range(10):
+            with CaptureQueriesContext(connections["replica1"]) as first, \
+                    CaptureQueriesContext(connections["replica2"]) as second:
+                response = self.client.get("/tasks/")
+            self.assertContains(response, "a")
+            # the list version and the rows it is cached under come from the same replica
+            self.assertEqual(sorted([len(first) > 0, len(second) > 0]), [False, True])
+
+    def test_streamed_export_reads_replica(self):
+        Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        with CaptureQueriesContext(connections["replica1"]) as queries:
+            response = self.client.get("/api/export/tasks.csv")
+            content = b"".join(response.streaming_content)
+        self.assertIn(b"a,d", content)
+        self.assertTrue(any("tasks_task" in query["sql"] for query in queries))
+        # and once it is sent the routing is back to what it was
+        self.assertIsNone(routing.get())
+
+    def test_reports_and_background_reads(self):
+        Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        counts, queries = self.replica_queries(lambda: status_counts([self.user.id]))
+        self.assertEqual((counts[self.user.id]["PENDING"], queries), (1, 1))
+        # outside requests everything else stays on the primary
+        _, queries = self.replica_queries(lambda: list(Task.objects.all()))
+        self.assertEqual(queries, 0)
+
+
+class MemoryMetricsStore:
+    # RedisMetricsStore's interface, for one process
+    def __init__(self):
+        self.snapshots = {}
+
+    def push(self, process, snapshot):
+        self.snapshots[process] = json.loads(json.dumps(snapshot))
+
+    def collect(self):
+        return dict(self.snapshots)
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        if any("flaky" in address for message in messages for address in message.to):
+            raise ConnectionError("mailbox unavailable")
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND="tasks.tests.FlakyEmailBackend", EMAIL_RATE_LIMIT=0)
+class OutboundEmailTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_drain(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            queued = queue_emails([("a", "body", ["one@example.com"]), ("b", "body", ["two@example.com"]),
+                ("c", "body", [""])])
+        self.assertEqual((queued, len(callbacks)), (2, 1))
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(drain_outbound_email()["sent"], 2)
+        self.assertEqual([m.to for m in mail.outbox], [["one@example.com"], ["two@example.com"]])
+        self.assertFalse(OutboundEmail.objects.exists())
+        self.assertEqual(metrics.value("emails_sent"), 2)
+
+    def test_retry_with_backoff(self):
+        queue_emails([("a", "body", ["flaky@example.com"]), ("b", "body", ["ok@example.com"])])
+        with self.settings(EMAIL_MAX_ATTEMPTS=3):
+            self.assertEqual(drain_outbound_email(), {"sent": 1, "retried": 1, "failed": 0, "continued": False})
+            email = OutboundEmail.objects.get()
+            self.assertEqual((email.attempts, email.last_error), (1, "ConnectionError: mailbox unavailable"))
+            self.assertAlmostEqual((email.next_attempt_at - datetime.now(timezone.utc)).total_seconds(), 60, delta=5)
+            # not due yet
+            self.assertEqual(drain_outbound_email()["retried"], 0)
+
+            for attempts, delay in [(2, 120), (3, None)]:
+                OutboundEmail.objects.update(next_attempt_at=datetime.now(timezone.utc))
+                drain_outbound_email()
+                email.refresh_from_db()
+                self.assertEqual(email.attempts, attempts)
+                if delay:
+                    self.assertAlmostEqual((email.next_attempt_at - datetime.now(timezone.utc)).total_seconds(),
+                        delay, delta=5)
+        self.assertEqual(email.status, OutboundEmail.FAILED)
+        self.assertEqual((metrics.value("emails_retried"), metrics.value("emails_failed")), (2, 1))
+
+    def test_rate_limit(self):
+        # two workers' limiters, sharing the rate through the cache
+        limiters = [RateLimiter("test_rate"), RateLimiter("test_rate")]
+        start = time_module.monotonic()
+        for i in range(5):
+            limiters[i % 2].wait(20)
+        self.assertGreaterEqual(time_module.monotonic() - start, 0.15)
+
+    def test_one_drain_at_a_time(self):
+        queue_emails([("a", "body", ["one@example.com"])])
+        caches["throttle"].add("drain_outbound_email", 1)
+        self.addCleanup(caches["throttle"].delete, "drain_outbound_email")
+        self.assertIsNone(drain_outbound_email())
+        self.assertEqual((mail.outbox, metrics.value("email_drains_skipped")), ([], 1))
+        caches["throttle"].delete("drain_outbound_email")
+        self.assertEqual(drain_outbound_email()["sent"], 1)
+        self.assertIsNone(caches["throttle"].get("drain_outbound_email"))
+
+
+class TaskCardCacheTests(TestCase):
+    def setUp(self):
+        caches["fragments"].clear()
+        metrics.reset()
+        self.user = User.objects.create_user(username="cards", password="testpass")
+        self.client.login(username="cards", password="testpass")
+        self.task = Task.objects.create(title="<b>first</b>", description="d", priority=1, user=self.user)
+        Task.objects.create(title="done", description="d", priority=2, user=self.user, completed=True)
+
+    def test_cards_cached_until_changed(self):
+        body = self.client.get("/tasks/").content.decode()
+        self.assertIn("&lt;b&gt;first&lt;/b&gt;", body)
+        self.assertIn('line-through text-lg font-semibold">\n        done', body)
+        self.assertEqual(metrics.value("task_card_cache_misses"), 2)
+
+        self.client.get("/tasks/?cursor=pending")
+        self.assertEqual(metrics.value("task_card_cache_hits"), 2)
+
+        # update() leaves created_date alone, the title is part of the key
+        Task.objects.filter(pk=self.task.pk).update(title="renamed")
+        body = self.client.get("/tasks/").content.decode()
+        self.assertIn("renamed", body)
+        self.assertNotIn("first", body)
+        self.assertEqual(metrics.value("task_card_cache_misses"), 3)
+
+
+class TaskFragmentTests(TestCase):
+    def setUp(self):
+        caches["fragments"].clear()
+        self.user = User.objects.create_user(username="htmx", password="testpass")
+        self.client.login(username="htmx", password="testpass")
+
+    def post(self, url, data=None):
+        return self.client.post(url, data or {}, HTTP_HX_REQUEST="true")
+
+    def test_create_update_delete(self):
+        response = self.post("/create-task/", {"title": "a", "description": "d", "priority": 1, "status": "PENDING"})
+        self.assertEqual(response.status_code, 200)
+        task = Task.objects.get(title="a")
+        body = response.content.decode()
+        self.assertIn(f'<li id="task-{task.id}" class="mb-4">', body)
+        self.assertIn('<div id="task-counts" class="flex" hx-swap-oob="true">\n  0 of 1 tasks completed', body)
+
+        response = self.post(f"/update-task/{task.id}/",
+            {"title": "a", "description": "d", "priority": 1, "status": "COMPLETED", "completed": "on"})
+        body = response.content.decode()
+        self.assertIn(f'<li id="task-{task.id}" class="mb-1">', body)
+        self.assertIn("1 of 1 tasks completed", body)
+
+        response = self.post(f"/delete-task/{task.id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("<li", response.content.decode())
+        self.assertIn("0 of 0 tasks completed", response.content.decode())
+        self.assertFalse(Task.objects.exists())
+
+        # without htmx, still the redirect to the list
+        self.assertEqual(self.client.post("/create-task/",
+            {"title": "b", "description": "d", "priority": 1, "status": "PENDING"}).status_code, 302)
+
+    def test_edit_in_place(self):
+        task = Task.objects.create(title="a", description="d", priority=1, user=self.user)
+        self.assertContains(self.client.get("/tasks/"), f'hx-get="/update-task/{task.id}/"')
+        response = self.client.get(f"/update-task/{task.id}/", HTTP_HX_REQUEST="true")
+        self.assertTemplateUsed(response, "task_edit_card.html")
+        self.assertContains(response, f'hx-post="/update-task/{task.id}/"')
+        self.assertNotContains(response, "<html")
+
+        response = self.post(f"/update-task/{task.id}/", {"title": "", "description": "d", "priority": 1,
+            "status": "PENDING"})
+        self.assertTemplateUsed(response, "task_edit_card.html")
+        self.assertFalse(response.has_header("HX-Retarget"))
+        response = self.post(f"/update-task/{task.id}/", {"title": "b", "description": "d", "priority": 1,
+            "status": "PENDING"})
+        self.assertContains(response, f'<li id="task-{task.id}" class="mb-4">')
+        self.assertContains(response, "b</div>")
+
+    def test_invalid_form(self):
+        response = self.post("/create-task/", {"title": "a", "description": "d", "priority": 0, "status": "PENDING"})
+        self.assertEqual(response["HX-Retarget"], "#task-form-errors")
+        self.assertContains(response, "Priority should be higher than 0")
+        self.assertFalse(Task.objects.exists())
@@ -3,14 +3,54 @@ from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.forms import ModelForm
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
+from django.utils.decorators import method_decorator
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
 from django.views.generic.list import ListView
 from django import forms
 from tasks.models import Task, Report
+from tasks.dashboard import TaskDashboard, PENDING, COMPLETED, task_counts
+from tasks.priorities import shift_priorities
+from tasks.conditional import task_list_version, task_page_condition
+from tasks.cache import cached_task_list
 from django.contrib.auth.models import User
 from django.shortcuts import render
+from django.template.loader import render_to_string
+
+def is_htmx(request):
+    return request.headers.get("HX-Request") == "true"
+
+
+def task_fragment(request, task=None):
+    """
+    The answer to an htmx edit: the task's card (nothing once it is gone) and
+    the counters, swapped in out of band, instead of a redirect to the list.
+    """
+    context = {"tasks": [task] if task else [], "struck": bool(task and task.completed), **task_counts(request.user)}
+    return HttpResponse(render_to_string("task_fragment.html", context, request))
+
+
+def task_form_errors(request, form):
+    response = render(request, "task_form_errors.html", {"form": form})
+    # htmx swaps these next to the form rather than into the list
+    response["HX-Retarget"] = "#task-form-errors"
+    response["HX-Reswap"] = "innerHTML"
+    return response
+
+
+class TaskFragmentMixin:
+    def form_invalid(self, form):
+        if is_htmx(self.request):
+            return task_form_errors(self.request, form)
+        return super().form_invalid(form)
+
+    def saved(self):
+        if is_htmx(self.request):
+            return task_fragment(self.request, self.object)
+        return HttpResponseRedirect("/tasks")
+
 
 class AuthorisedTasksGenerator(LoginRequiredMixin):
     def get_queryset(self):
@@ -41,70 +81,57 @@ class TaskCreateForm(ModelForm):
         return priority
 
 
-class GenericAllTasksView(AuthorisedTasksGenerator,ListView):
+class TaskDashboardMixin(AuthorisedTasksGenerator):
     template_name = "user_tasks.html"
-    
-    def get_context_data(self, **kwargs):
-        tasks_list= Task.objects.filter(deleted=False, user= self.request.user, completed=False).order_by('priority')
-        completed_list= Task.objects.filter(deleted=False, user= self.request.user, completed=True).order_by('priority')
+    # sections rendered as (the "tasks" list, the struck-through "completed" list)
+    sections = (PENDING, COMPLETED)
 
-        return {"tasks" : tasks_list , 
-        "completed":completed_list, 
-        "completed_cnt": len(completed_list), 
-        "total_cnt": len(tasks_list)+len(completed_list),
-        "username": self.request.user}
+    def get_dashboard_data(self):
+        query = self.request.GET.get("q", "").strip()
+        dashboard = TaskDashboard(self.request.user, self.sections, self.request.GET.get("cursor"), query=query)
+        rows, next_cursor = dashboard.page()
+        tasks_section, *completed_section = self.sections
 
-class GenericPendingTasksView(AuthorisedTasksGenerator,ListView):
-    template_name = "user_tasks.html"
+        return {"tasks": rows[tasks_section],
+        "completed": rows[completed_section[0]] if completed_section else [],
+        "next_cursor": next_cursor,
+        **dashboard.counts()}
 
     def get_context_data(self, **kwargs):
-        tasks_list= Task.objects.filter(deleted=False, user= self.request.user, completed=False).order_by('priority')
-        completed_list= Task.objects.filter(deleted=False, user= self.request.user, completed=True).order_by('priority')
-
-        return {"tasks":tasks_list, 
-        "completed":[], 
-        "completed_cnt": len(completed_list), 
-        "total_cnt": len(tasks_list)+len(completed_list), "username": self.request.user}
-
-class GenericCompletedTasksView(AuthorisedTasksGenerator,ListView):
-    template_name = "user_tasks.html"
-
-    def get_context_data(self, **kwargs):
-        tasks_list= Task.objects.filter(deleted=False, user= self.request.user, completed=False).order_by('priority')
-        completed_list= Task.objects.filter(deleted=False, user= self.request.user, completed=True).order_by('priority')
-
-        return {"tasks":completed_list, 
-        "completed":[], 
-        "completed_cnt": len(completed_list), 
-        "total_cnt": len(tasks_list)+len(completed_list), "username": self.request.user}
-
-def update_priorities(user,priority_new):
-    tasks_to_update = []
-    all_task_list = Task.objects.filter(deleted=False,completed=False,user=user,priority__gte=priority_new).order_by('priority')
-    
-    for task in all_task_list:
-        if task.priority == priority_new:
-            task.priority += 1
-            priority_new += 1
-            tasks_to_update.append(task)
-    Task.objects.bulk_update(tasks_to_update,['priority'])     
-
-class GenericTaskCreateView(AuthorisedTasksGenerator,CreateView):
+        request = self.request
+        variant = f"{type(self).__name__}:{request.get_full_path()}"
+        data = cached_task_list(request.user.pk, task_list_version(request), variant, self.get_dashboard_data)
+        return {**data, "username": request.user, "q": request.GET.get("q", "")}
+
+@method_decorator(task_page_condition, name="get")
+class GenericAllTasksView(TaskDashboardMixin,ListView):
+    sections = (PENDING, COMPLETED)
+    query_budget = 6
+
+@method_decorator(task_page_condition, name="get")
+class GenericPendingTasksView(TaskDashboardMixin,ListView):
+    sections = (PENDING,)
+    query_budget = 5
+
+@method_decorator(task_page_condition, name="get")
+class GenericCompletedTasksView(TaskDashboardMixin,ListView):
+    sections = (COMPLETED,)
+    query_budget = 5
+
+class GenericTaskCreateView(TaskFragmentMixin, AuthorisedTasksGenerator,CreateView):
     form_class= TaskCreateForm
     template_name="task_create.html"
     success_url="/tasks"
+    query_budget = 15
 
     def form_valid(self, form):
-        priority_new = form.cleaned_data["priority"]
-        user = self.request.user
-        tasks = Task.objects.filter(deleted=False, user= self.request.user, completed=False, priority=priority_new)
-        if tasks.exists():
-            update_priorities(user , priority_new)
+        with transaction.atomic():
+            shift_priorities(self.request.user, form.cleaned_data["priority"])
 
-        self.object = form.save()
-        self.object.user = self.request.user
-        self.object.save()
-        return HttpResponseRedirect("/tasks")
+            self.object = form.save(commit=False)
+            self.object.user = self.request.user
+            self.object.save()
+        return self.saved()
 
 
 class GenericTaskDeleteView(AuthorisedTasksGenerator, DeleteView):
@@ -112,24 +139,38 @@ class GenericTaskDeleteView(AuthorisedTasksGenerator, DeleteView):
     template_name="task_delete.html"
     success_url="/tasks"
 
-class GenericTaskUpdateView(AuthorisedTasksGenerator, UpdateView):
+    def form_valid(self, form):
+        if not is_htmx(self.request):
+            return super().form_valid(form)
+        self.object.delete()
+        return task_fragment(self.request)
+
+class GenericTaskUpdateView(TaskFragmentMixin, AuthorisedTasksGenerator, UpdateView):
     model=Task
     form_class=TaskCreateForm
     template_name="task_update.html"
     success_url="/tasks"
+    query_budget = 18
+
+    def get_template_names(self):
+        # htmx swaps the form in place of the task's card
+        if is_htmx(self.request):
+            return ["task_edit_card.html"]
+        return super().get_template_names()
+
+    def form_invalid(self, form):
+        # the errors go back into the card's form, not next to the add form
+        return super(TaskFragmentMixin, self).form_invalid(form)
 
     def form_valid(self, form):
-        priority_new = form.cleaned_data["priority"]
-        user = self.request.user
-        if 'priority' in form.changed_data:
-            tasks = Task.objects.filter(deleted=False, user= self.request.user, completed=False, priority=priority_new)
-            if tasks.exists():
-                update_priorities(user , priority_new)
-
-        self.object = form.save()
-        self.object.user = self.request.user
-        self.object.save()
-        return HttpResponseRedirect("/tasks")
+        with transaction.atomic():
+            if 'priority' in form.changed_data:
+                shift_priorities(self.request.user, form.cleaned_data["priority"])
+
+            self.object = form.save(commit=False)
+            self.object.user = self.request.user
+            self.object.save()
+        return self.saved()
 
 class UserSignUpForm(UserCreationForm):
     report = forms.BooleanField(required=False)
@@ -166,16 +207,15 @@ class SetReportView(AuthorisedReportGenerator, UpdateView):
 
     def get_object(self):
         report_obj, created= Report.objects.get_or_create(user=self.request.user)
-        print("Inside get_object", created)
         return report_obj
         # return (Report.objects.get(user=self.request.user))[0]
 
     def form_valid(self, form):
-        send_time = form.cleaned_data["send_time"]
-        self.object = form.save()
+        self.object = form.save(commit=False)
         self.object.user = self.request.user
+        self.object.schedule()
         self.object.save()
-        return HttpResponseRedirect("/tasks")    
+        return HttpResponseRedirect("/tasks")
 
 def home_view(request):
     return render(request, "homepage.html")